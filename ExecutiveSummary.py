@@ -10,15 +10,17 @@ __version__ = "2.0.0"
 import argparse
 import os
 import shutil
-import subprocess
 from datetime import datetime
-from math import sqrt
 from os import path
-from re import split
-
-from PIL import Image  # for BrainSprite
 
+import assets
+import render_cache
+import tools
+import tracing
+import volumes
+from encode import FORMATS
 from layout_builder import layout_builder
+from preproc import preprocess
 
 
 def generate_parser():
@@ -83,6 +85,143 @@ def generate_parser():
     parser.add_argument(
         "--version", "-v", action="version", version="%(prog)s " + __version__
     )
+    parser.add_argument(
+        "--nprocs",
+        "-n",
+        dest="nprocs",
+        type=int,
+        metavar="NPROCS",
+        help="Optional. Maximum number of processes to use when rendering images. "
+        "Default is the number of CPUs allocated to the job (honors cgroup "
+        "and SLURM limits).",
+    )
+    parser.add_argument(
+        "--volume-sprite",
+        dest="volume_sprite",
+        action="store_true",
+        help="Optional. Build the BrainSprite mosaics directly from the T1w and "
+        "T2w volumes, without surfaces, instead of rendering 169 workbench "
+        "scenes for each. Much faster when the surface overlay is not needed.",
+    )
+    parser.add_argument(
+        "--clean",
+        dest="clean",
+        action="store_true",
+        help="Optional. Remove the images from prior runs and make all of them "
+        "again. By default, images are only made again when their inputs have "
+        "changed.",
+    )
+    parser.add_argument(
+        "--hash-inputs",
+        dest="hash_inputs",
+        action="store_true",
+        help="Optional. When deciding whether images from prior runs are up to "
+        "date, compare inputs by content as well as by size and time.",
+    )
+    parser.add_argument(
+        "--trace",
+        dest="trace",
+        metavar="TRACE_JSON",
+        help="Optional. Write a trace of where the time goes, in the Chrome "
+        "trace event format, to this file. Open it in Perfetto "
+        "(https://ui.perfetto.dev) or chrome://tracing.",
+    )
+    parser.add_argument(
+        "--tools",
+        dest="tools",
+        metavar="MODE[:DIR]",
+        help="Optional. How to run wb_command and the FSL tools: real (the "
+        "default), record:DIR to run them and record each call in DIR, or "
+        "replay[:DIR] to stand in for them with the calls recorded in DIR.",
+    )
+    parser.add_argument(
+        "--tool-latency",
+        dest="tool_latency",
+        type=float,
+        metavar="SECONDS",
+        help="Optional. With --tools replay, the time each call takes. "
+        "Default is the time the call took when it was recorded.",
+    )
+    parser.add_argument(
+        "--tool-limit",
+        dest="tool_limits",
+        action="append",
+        metavar="TOOL=N",
+        help="Optional. Most calls of a tool to run at once (e.g., "
+        "wb_command=2). May be given for more than one tool. Default is half "
+        "of the CPUs for wb_command, and twice the CPUs for other tools.",
+    )
+    parser.add_argument(
+        "--tool-timeout",
+        dest="tool_timeout",
+        type=float,
+        metavar="SECONDS",
+        help="Optional. Seconds a call of a tool may take before it is "
+        "killed. Default is 3600.",
+    )
+    parser.add_argument(
+        "--volume-cache-mb",
+        dest="volume_cache_mb",
+        type=float,
+        metavar="MB",
+        help="Optional. Most megabytes of decoded volumes to keep in memory, "
+        "so that each volume is only read once. Default is 2048.",
+    )
+    parser.add_argument(
+        "--render-cache",
+        dest="render_cache",
+        metavar="DIR",
+        help="Optional. Directory, shared by all of the subjects of a study, "
+        "in which to keep the slices of the atlas, so they are only rendered "
+        "once for the study.",
+    )
+    parser.add_argument(
+        "--encode",
+        dest="encoding",
+        choices=FORMATS,
+        help="Optional. Make compact copies of the images, and show them in "
+        "the page instead: webp (lossless, but for the BrainSprite mosaics) "
+        "or png (recompressed, nothing lost). A report of the size and "
+        "quality of each is written to encoding_<format>.json.",
+    )
+    parser.add_argument(
+        "--page",
+        dest="page",
+        choices=["html", "data"],
+        default="html",
+        help="Optional. html (the default) writes the whole page. data writes "
+        "only the data of the page, as JSON, and a renderer script that lays "
+        "it out in the browser; the page is much smaller and quicker to make. "
+        "Browsers keep the renderer for every subject that shares it (see "
+        "--static-dir and --assets-dir).",
+    )
+    parser.add_argument(
+        "--static-dir",
+        dest="static_dir",
+        metavar="STATIC_DIR",
+        help="Optional. With --page data, write the renderer to this directory "
+        "(which may be shared by all of the subjects of a study) rather than "
+        "to executivesummary/static. Not used with --assets-dir, which has "
+        "its own copy.",
+    )
+    parser.add_argument(
+        "--assets-dir",
+        dest="assets_dir",
+        metavar="ASSETS_DIR",
+        help="Optional. Load the style sheets and scripts of the page from "
+        "local copies in this directory (which may be shared by all of the "
+        "subjects of a study), instead of from CDNs, so the page can be viewed "
+        "offline. The copies must have been fetched (python assets.py fetch); "
+        "if they have not, nothing is run.",
+    )
+    parser.add_argument(
+        "--precompress",
+        dest="precompress",
+        action="store_true",
+        help="Optional. Also write .gz (and, if the brotli package is "
+        "installed, .br) copies of the page and of the local copies of the "
+        "style sheets and scripts, for web servers.",
+    )
     parser.add_argument(
         "--layout-only",
         dest="layout_only",
@@ -95,7 +234,8 @@ def generate_parser():
     return parser
 
 
-def init_summary(proc_files, summary_dir=None, layout_only=False):
+@tracing.traced("init_summary")
+def init_summary(proc_files, summary_dir=None, clean=False):
 
     summary_path = None
     html_path = None
@@ -110,8 +250,8 @@ def init_summary(proc_files, summary_dir=None, layout_only=False):
         # This also ensures we can write to the path.
         html_path = os.path.join(summary_path, "executivesummary")
 
-        # If we are going to create the files, need to clean up old files.
-        if path.exists(html_path) and not layout_only:
+        # Files from prior runs are kept unless the caller wants to start over.
+        if path.exists(html_path) and clean:
             shutil.rmtree(html_path)
 
         if not path.exists(html_path):
@@ -150,62 +290,6 @@ def init_summary(proc_files, summary_dir=None, layout_only=False):
     return summary_path, html_path, images_path
 
 
-def make_mosaic(png_path, mosaic_path):
-    # Takes path to .png anatomical slices, creates a mosaic that can be
-    # used in a BrainSprite viewer, and saves to a specified filename.
-
-    # Get the cwd so we can get back; then change directory.
-    cwd = os.getcwd()
-    os.chdir(png_path)
-
-    # Need this function so frames sort in correct order.
-    def natural_sort(l):
-        convert = lambda text: int(text) if text.isdigit() else text.lower()
-        alphanum_key = lambda key: [convert(c) for c in split("([0-9]+)", key)]
-        return sorted(l, key=alphanum_key)
-
-    files = os.listdir(png_path)
-    files = natural_sort(files)
-    files = files[::-1]
-
-    image_dim = 218
-    images_per_side = int(sqrt(len(files)))
-    square_dim = image_dim * images_per_side
-    result = Image.new("RGB", (square_dim, square_dim))
-
-    for index, file in enumerate(files):
-        path = os.path.expanduser(file)
-        img = Image.open(path)
-        img = img.transpose(Image.FLIP_LEFT_RIGHT)
-        img.thumbnail((image_dim, image_dim), resample=Image.ANTIALIAS)
-        x = index % images_per_side * image_dim
-        y = index // images_per_side * image_dim
-        w, h = img.size
-        result.paste(img, (x, y, x + w, y + h))
-
-    # Back to original working dir.
-    os.chdir(cwd)
-
-    quality_val = 95
-    dest = os.path.join(mosaic_path)
-    result.save(dest, "JPEG", quality=quality_val)
-
-
-def preprocess_tx(tx, files_path, images_path):
-    # If there are pngs for tx, make the mosaic file for the brainsprite.
-    # If not, no problem. Layout will use the mosaic if it is there.
-    pngs = tx + "_pngs"
-    pngs_dir = os.path.join(files_path, pngs)
-
-    if os.path.isdir(pngs_dir):
-        # Call the program to make the mosaic from the pngs. and write
-        mosaic = tx + "_mosaic.jpg"
-        mosaic_path = os.path.join(images_path, mosaic)
-        make_mosaic(pngs_dir, mosaic_path)
-    else:
-        print("There is no path: %s." % pngs_dir)
-
-
 def _cli():
     # Command line interface
     parser = generate_parser()
@@ -253,8 +337,80 @@ def _cli():
         assert os.path.exists(args.atlas), args.atlas + " does not exist!"
         kwargs["atlas"] = args.atlas
 
-    # Call the interface.
-    interface(**kwargs)
+    if args.volume_sprite:
+        print("\tBrainSprite:           from volumes")
+        kwargs["volume_sprite"] = True
+
+    if args.clean:
+        print("\tClean:                 True")
+        kwargs["clean"] = True
+
+    if args.hash_inputs:
+        kwargs["hash_inputs"] = True
+
+    try:
+        tool_limits = tools.parse_limits(",".join(args.tool_limits or []))
+    except ValueError as err:
+        parser.error(str(err))
+    if (
+        args.tools
+        or args.tool_latency is not None
+        or tool_limits
+        or args.tool_timeout is not None
+    ):
+        print("\tTools:                 %s" % (args.tools or "real"))
+        if tool_limits:
+            print("\tTool limits:           %s" % tools.format_limits(tool_limits))
+        if args.tool_timeout is not None:
+            print("\tTool timeout:          %g s" % args.tool_timeout)
+        tools.configure(args.tools, args.tool_latency, tool_limits, args.tool_timeout)
+
+    if args.volume_cache_mb is not None:
+        print("\tVolume cache:          %g MB" % args.volume_cache_mb)
+        volumes.configure(args.volume_cache_mb)
+
+    if args.render_cache is not None:
+        print("\tRender cache:          %s" % args.render_cache)
+        render_cache.configure(args.render_cache)
+
+    if args.encoding is not None:
+        print("\tEncoding:              %s" % args.encoding)
+        kwargs["encoding"] = args.encoding
+
+    if args.assets_dir is not None:
+        # Before any work is done: without the files, the page would need
+        # the CDNs after all.
+        try:
+            assets.check_vendored()
+        except assets.MissingAssetError as err:
+            parser.error(str(err))
+        print("\tAssets:                %s" % args.assets_dir)
+        kwargs["assets_dir"] = os.path.abspath(args.assets_dir)
+
+    if args.static_dir is not None:
+        print("\tStatic:                %s" % args.static_dir)
+        kwargs["static_dir"] = os.path.abspath(args.static_dir)
+
+    if args.precompress:
+        kwargs["precompress"] = True
+
+    if args.page != "html":
+        print("\tPage:                  %s" % args.page)
+        kwargs["page"] = args.page
+
+    if args.nprocs is not None:
+        print("\tProcesses:             %s" % args.nprocs)
+        kwargs["nprocs"] = args.nprocs
+
+    # Call the interface, tracing it if asked.
+    if args.trace:
+        print("\tTrace:                 %s" % args.trace)
+        tracing.start()
+    try:
+        interface(**kwargs)
+    finally:
+        if args.trace:
+            tracing.stop(args.trace)
 
 
 def interface(
@@ -265,6 +421,15 @@ def interface(
     session_id=None,
     atlas=None,
     layout_only=False,
+    nprocs=None,
+    volume_sprite=False,
+    clean=False,
+    hash_inputs=False,
+    encoding=None,
+    page="html",
+    assets_dir=None,
+    precompress=False,
+    static_dir=None,
 ):
 
     # Most of the data needed is in the summary directory. Also, it is where the
@@ -273,34 +438,31 @@ def interface(
     if summary_dir is not None:
         print("summary_dir is %s" % summary_dir)
     summary_path, html_path, images_path = init_summary(
-        files_path, summary_dir, layout_only
+        files_path, summary_dir, clean and not layout_only
     )
     if summary_path is None:
         # We were not able to find and/or write to the path.
         print("Exiting.")
-        return
+        return False
+
+    preproc_ok = True
 
     if not layout_only:
-        preproc_cmd = (
-            os.path.dirname(os.path.abspath(__file__)) + "/executivesummary_preproc.sh "
+        # Make the images (including the mosaics for the BrainSprites). Jobs
+        # that do not depend on each other are run at the same time.
+        preproc_ok = preprocess(
+            files_path,
+            subject_id,
+            hash_inputs=hash_inputs,
+            html_path=html_path,
+            session_id=session_id,
+            bids_input=func_path,
+            atlas=atlas,
+            nprocs=nprocs,
+            volume_sprite=volume_sprite,
         )
-        preproc_cmd += "--output-dir %s " % files_path
-        preproc_cmd += "--html-path %s " % html_path
-        preproc_cmd += "--subject-id %s " % subject_id
-        if session_id is not None:
-            preproc_cmd += "--session-id %s " % session_id
-        if func_path is not None:
-            preproc_cmd += "--bids-input %s " % func_path
-        if atlas is not None:
-            preproc_cmd += "--atlas %s " % atlas
-
-        subprocess.call(preproc_cmd, shell=True)
-
-        # Make mosaic(s) for brainsprite(s).
-        print("Making mosaic for T1 BrainSprite.")
-        preprocess_tx("T1", files_path, images_path)
-        print("Making mosaic for T2 BrainSprite.")
-        preprocess_tx("T2", files_path, images_path)
+        if not preproc_ok:
+            print("Some of the images could not be made.")
         print("Finished with preprocessing.")
 
     # Done with preproc (or skipped it). Call the page layout to make the page.
@@ -313,9 +475,19 @@ def interface(
         "images_path": images_path,
         "subject_id": subject_id,
         "session_id": session_id,
+        "encoding": encoding,
+        "page": page,
+        "assets_dir": assets_dir,
+        "precompress": precompress,
+        "static_dir": static_dir,
+        "nprocs": nprocs,
     }
 
-    layout_builder(**kwargs)
+    with tracing.span("layout", "layout"):
+        layout_builder(**kwargs)
+
+    # Let callers (e.g., batch.py) know whether everything worked.
+    return preproc_ok
 
 
 if __name__ == "__main__":
@@ -0,0 +1,346 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Local copies of the style sheets, fonts, and scripts the page loads from CDNs
+(w3.css, Font Awesome 4.7 and 5.7, and jQuery), so that the Executive Summary
+can be viewed with no access to the internet.
+
+    python assets.py fetch
+        Downloads them (and the fonts the style sheets use) into vendor/, next
+        to this file. Do this once, on a machine that can reach the CDNs; then
+        the copy of the Executive Summary in use has them.
+
+    python assets.py build ASSETS_DIR [--precompress]
+        Writes them to ASSETS_DIR, minified, and named by their content (e.g.,
+        w3.1a2b3c4d5e6f.css), so that one directory can be shared by all of
+        the subjects of a study, and browsers may keep each file for good.
+        ExecutiveSummary.py does this with --assets-dir.
+
+With --precompress, a .gz copy (and a .br copy, if the brotli package is
+installed) is written next to each file, for web servers that serve them.
+"""
+
+import argparse
+import base64
+import gzip
+import hashlib
+import os
+import posixpath
+import re
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+
+import constants
+
+VENDOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vendor")
+FONTS_DIR = "fonts"
+
+# The files the page loads from CDNs, by the name of the local copy. The
+# integrity of a file, if given, is checked when it is downloaded.
+VENDORED = OrderedDict(
+    [
+        ("w3.css", {"url": "https://www.w3schools.com/w3css/4/w3.css"}),
+        (
+            "font-awesome-4.7.0.min.css",
+            {
+                "url": "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/4.7.0/"
+                "css/font-awesome.min.css"
+            },
+        ),
+        (
+            "fontawesome-5.7.0-all.css",
+            {
+                "url": "https://use.fontawesome.com/releases/v5.7.0/css/all.css",
+                "integrity": "sha384-lZN37f5QGtY3VHgisS14W3ExzMWZxybE1SJSEsQp9S+o"
+                "qd12jhcu+A56Ebc1zFSJ",
+            },
+        ),
+        (
+            "jquery-2.1.1.min.js",
+            {"url": "https://ajax.googleapis.com/ajax/libs/jquery/2.1.1/jquery.min.js"},
+        ),
+        (
+            "jquery-ui-1.9.1.min.js",
+            {
+                "url": "https://ajax.googleapis.com/ajax/libs/jqueryui/1.9.1/"
+                "jquery-ui.min.js"
+            },
+        ),
+    ]
+)
+
+STYLE_SHEETS = [
+    "w3.css",
+    "font-awesome-4.7.0.min.css",
+    "fontawesome-5.7.0-all.css",
+]
+JQUERY_SCRIPTS = ["jquery-2.1.1.min.js", "jquery-ui-1.9.1.min.js"]
+
+# Files that are already compressed are not precompressed.
+COMPRESSED_EXTS = [".woff", ".woff2", ".png", ".gif", ".jpg", ".webp"]
+
+# url(...) in a style sheet. Data URLs are left alone.
+CSS_URL_RE = re.compile(r"url\(\s*(['\"]?)(?!data:)([^'\")]+)\1\s*\)")
+
+
+class MissingAssetError(IOError):
+    # A file that should be in vendor/ is not; run: python assets.py fetch.
+    pass
+
+
+def write_file(file_path, data):
+    # Writes bytes to a temporary file, and renames it into place.
+    tmp_path = "%s.%d.tmp" % (file_path, os.getpid())
+    with open(tmp_path, "wb") as fd:
+        fd.write(data)
+    os.replace(tmp_path, file_path)
+
+
+def download(url):
+    with urllib.request.urlopen(url, timeout=60) as response:
+        return response.read()
+
+
+def check_integrity(name, data, integrity):
+    algorithm, _, expected = integrity.partition("-")
+    digest = base64.b64encode(hashlib.new(algorithm, data).digest()).decode()
+    if digest != expected:
+        raise ValueError("%s does not match its integrity, %s." % (name, integrity))
+
+
+def fetch(vendor_dir=VENDOR_DIR):
+    """
+    Downloads the files of VENDORED, and the fonts their style sheets use,
+    into vendor_dir. The fonts are kept in vendor_dir/fonts, and the style
+    sheets are changed to find them there.
+
+    :parameter: vendor_dir: directory in which to keep the files.
+    :return: list of the names of the files, relative to vendor_dir.
+    """
+    os.makedirs(os.path.join(vendor_dir, FONTS_DIR), exist_ok=True)
+    fetched = []
+    for name, values in VENDORED.items():
+        print("Fetching %s" % values["url"])
+        data = download(values["url"])
+        if "integrity" in values:
+            check_integrity(name, data, values["integrity"])
+
+        if name.endswith(".css"):
+            fonts = {}
+
+            def local_font(match):
+                # Keep the #fragment (used by the svg fonts); drop the query.
+                ref = match.group(2).strip()
+                path, _, fragment = ref.partition("#")
+                path = path.partition("?")[0]
+                font_name = posixpath.basename(path)
+                fonts[font_name] = urllib.parse.urljoin(values["url"], path)
+                local = posixpath.join(FONTS_DIR, font_name)
+                return "url(%s%s)" % (local, "#" + fragment if fragment else "")
+
+            data = CSS_URL_RE.sub(local_font, data.decode("utf-8")).encode("utf-8")
+            for font_name, url in sorted(fonts.items()):
+                print("Fetching %s" % url)
+                write_file(
+                    os.path.join(vendor_dir, FONTS_DIR, font_name), download(url)
+                )
+                fetched.append(posixpath.join(FONTS_DIR, font_name))
+
+        write_file(os.path.join(vendor_dir, name), data)
+        fetched.append(name)
+    return fetched
+
+
+def generated_assets():
+    # The files made by the Executive Summary itself, by name.
+    return {
+        "brainsprite.js": constants.BRAINSPRITE_JS,
+        "execsummary-renderer.js": constants.BRAINSPRITE_JS + constants.RENDERER_JS,
+        "execsummary-renderer.css": constants.PAGE_CSS,
+    }
+
+
+def minify_css(text):
+    # Takes out comments (but not /*! license notices */) and the white space
+    # around punctuation.
+    text = re.sub(r"/\*(?!!).*?\*/", "", text, flags=re.S)
+    text = re.sub(r"\s+", " ", text)
+    text = re.sub(r"\s*([{};,>])\s*", r"\1", text)
+    # Not before a colon, which may start a pseudo-class (a :hover).
+    text = re.sub(r":\s+", ":", text)
+    return text.replace(";}", "}").strip()
+
+
+def minify_js(text):
+    # Takes out indentation, blank lines, and lines that are only comments.
+    # Lines are kept, so that statements without semicolons still end.
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith("//"):
+            lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def content_name(name, data):
+    # The name of a file, with the hash of its content before the extension.
+    stem, ext = os.path.splitext(name)
+    if stem.endswith(".min"):
+        stem, ext = stem[: -len(".min")], ".min" + ext
+    return "%s.%s%s" % (stem, hashlib.sha1(data).hexdigest()[:12], ext)
+
+
+def precompress(file_path):
+    """
+    Writes file_path.gz and, if the brotli package is installed,
+    file_path.br, unless they are newer than the file.
+
+    :parameter: file_path: path to the file.
+    :return: None
+    """
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    encoders = [(".gz", lambda data: gzip.compress(data, 9, mtime=0))]
+    if brotli is not None:
+        encoders.append((".br", brotli.compress))
+
+    mtime = os.stat(file_path).st_mtime_ns
+    data = None
+    for ext, encoder in encoders:
+        out_path = file_path + ext
+        if os.path.exists(out_path) and os.stat(out_path).st_mtime_ns >= mtime:
+            continue
+        if data is None:
+            with open(file_path, "rb") as fd:
+                data = fd.read()
+        write_file(out_path, encoder(data))
+
+
+def check_vendored(vendor_dir=VENDOR_DIR):
+    """
+    Makes sure the files of VENDORED have been fetched, so a page that is to
+    load them from an assets directory never needs the CDNs.
+
+    :parameter: vendor_dir: directory to which the files were fetched.
+    :return: None
+    :raises: MissingAssetError, if any of them is not in vendor_dir.
+    """
+    missing = [
+        name for name in VENDORED if not os.path.isfile(os.path.join(vendor_dir, name))
+    ]
+    if missing:
+        raise MissingAssetError(
+            "Missing from %s: %s. Run: python assets.py fetch"
+            % (vendor_dir, ", ".join(missing))
+        )
+
+
+def build_assets(assets_dir, generated=None, compress=False, vendor_dir=VENDOR_DIR):
+    """
+    Writes the vendored files, and any generated ones, to assets_dir,
+    minified and named by their content. Files that are already there are
+    not written again, so many subjects may share (and build) the same
+    directory at once.
+
+    :parameter: assets_dir: directory to which to write the files.
+    :parameter: generated: optional dictionary of name: text of files made
+                by the Executive Summary itself (e.g., the renderer of data
+                pages). Their names end with .css or .js.
+    :parameter: compress: whether to write .gz and .br copies of the files.
+    :parameter: vendor_dir: directory to which the files were fetched.
+    :return: dictionary of the name of each file in assets_dir, by the name
+             of the vendored or generated file.
+    :raises: MissingAssetError, if the files have not been fetched.
+    """
+    check_vendored(vendor_dir)
+
+    os.makedirs(assets_dir, exist_ok=True)
+    names = {}
+
+    def put(name, data):
+        out_name = content_name(posixpath.basename(name), data)
+        out_path = os.path.join(assets_dir, out_name)
+        if not os.path.exists(out_path):
+            write_file(out_path, data)
+        if compress and os.path.splitext(name)[1] not in COMPRESSED_EXTS:
+            precompress(out_path)
+        names[name] = out_name
+
+    # The fonts first, so the style sheets can be changed to use their names.
+    fonts_dir = os.path.join(vendor_dir, FONTS_DIR)
+    if os.path.isdir(fonts_dir):
+        for font_name in sorted(os.listdir(fonts_dir)):
+            with open(os.path.join(fonts_dir, font_name), "rb") as fd:
+                put(posixpath.join(FONTS_DIR, font_name), fd.read())
+
+    def hashed_font(match):
+        path, _, fragment = match.group(2).partition("#")
+        return "url(%s%s)" % (
+            names.get(path, path),
+            "#" + fragment if fragment else "",
+        )
+
+    sources = []
+    for name in VENDORED:
+        with open(os.path.join(vendor_dir, name), "rb") as fd:
+            sources.append((name, fd.read().decode("utf-8")))
+    sources.extend(sorted((generated or {}).items()))
+
+    for name, text in sources:
+        if name.endswith(".css"):
+            text = CSS_URL_RE.sub(hashed_font, minify_css(text))
+        elif not name.endswith(".min.js"):
+            text = minify_js(text)
+        put(name, text.encode("utf-8"))
+
+    return names
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+        prog="assets",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    subparsers.add_parser("fetch", help="Download the files into vendor/.")
+
+    build = subparsers.add_parser("build", help="Write the files to a directory.")
+    build.add_argument(
+        "assets_dir",
+        metavar="ASSETS_DIR",
+        help="directory to which to write the files.",
+    )
+    build.add_argument(
+        "--precompress",
+        dest="precompress",
+        action="store_true",
+        help="Optional. Also write .gz (and .br) copies of the files.",
+    )
+
+    return parser
+
+
+def _cli():
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    if args.command == "fetch":
+        fetch()
+        print("Files written to: %s" % VENDOR_DIR)
+    else:
+        names = build_assets(args.assets_dir, generated_assets(), args.precompress)
+        for name, out_name in sorted(names.items()):
+            print("%-30s %s" % (name, out_name))
+
+
+if __name__ == "__main__":
+
+    _cli()
@@ -0,0 +1,505 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Runs the Executive Summary for many participants and sessions of a study with
+a pool of worker processes. Each participant/session is run in a process of
+its own, and everything it prints (including the output of the tools run by
+the preprocessor) goes to a log file of its own. A summary of successes and
+failures is printed at the end.
+
+Participants and sessions are read from a list, or found under the study
+root, which must be laid out as:
+    <study-root>/sub-<label>/ses-<id>/files    or
+    <study-root>/sub-<label>/files
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import traceback
+from multiprocessing import Pool
+
+import assets
+import render_cache
+import tools
+import tracing
+import volumes
+from ExecutiveSummary import interface
+from encode import FORMATS
+from helpers import available_cpus
+
+# Directory, under the study root, of the renderer of data pages.
+STATIC_DIR_NAME = "executivesummary_static"
+
+
+def files_path_for(study_root, subject_id, session_id=None):
+    # Path to the 'files' directory of a participant/session.
+    sub_dir = os.path.join(study_root, "sub-" + subject_id)
+    if session_id is None:
+        return os.path.join(sub_dir, "files")
+    return os.path.join(sub_dir, "ses-" + session_id, "files")
+
+
+def discover_subjects(study_root):
+    """
+    Finds all participants and sessions under study_root that have a 'files'
+    directory.
+
+    :parameter: study_root: directory that holds the sub-<label> directories.
+    :return: sorted list of (subject_id, session_id) tuples. session_id is
+             None when there is no ses- level.
+    """
+    found = set()
+
+    pattern = os.path.join(study_root, "sub-*", "ses-*", "files")
+    for files_path in glob.glob(pattern):
+        ses_dir = os.path.dirname(files_path)
+        sub_dir = os.path.dirname(ses_dir)
+        subject_id = os.path.basename(sub_dir)[len("sub-") :]
+        session_id = os.path.basename(ses_dir)[len("ses-") :]
+        found.add((subject_id, session_id))
+
+    pattern = os.path.join(study_root, "sub-*", "files")
+    for files_path in glob.glob(pattern):
+        subject_id = os.path.basename(os.path.dirname(files_path))[len("sub-") :]
+        found.add((subject_id, None))
+
+    return sorted(found, key=lambda job: (job[0], job[1] or ""))
+
+
+def read_subject_list(list_file):
+    """
+    Reads participants (and, optionally, sessions) from a file with one
+    participant per line. The session, if any, follows the participant,
+    separated by a comma or white space. The sub- and ses- prefixes are
+    optional. Blank lines and lines starting with # are ignored.
+
+    :parameter: list_file: path to the list.
+    :return: list of (subject_id, session_id) tuples.
+    """
+    jobs = []
+    with open(list_file) as fd:
+        for line in fd:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.replace(",", " ").split()
+            subject_id = fields[0]
+            if subject_id.startswith("sub-"):
+                subject_id = subject_id[len("sub-") :]
+            session_id = None
+            if len(fields) > 1:
+                session_id = fields[1]
+                if session_id.startswith("ses-"):
+                    session_id = session_id[len("ses-") :]
+            jobs.append((subject_id, session_id))
+    return jobs
+
+
+def job_label(subject_id, session_id=None):
+    # E.g., sub-01_ses-A, used for log names and messages.
+    if session_id is None:
+        return "sub-%s" % subject_id
+    return "sub-%s_ses-%s" % (subject_id, session_id)
+
+
+def run_one(job):
+    """
+    Runs the interface for one participant/session. Called in a worker
+    process, so it may change the working directory and redirect stdout and
+    stderr (at the file descriptor level, so that tools run by the
+    preprocessor are captured too).
+
+    :parameter: job: dict with the kwargs for interface, the log path, and
+                the path of the trace, if one is to be written.
+    :return: dict with subject, session, status, elapsed seconds, and log.
+    """
+    kwargs = dict(job["kwargs"])
+    log_path = job["log_path"]
+    trace_path = job.get("trace_path")
+
+    result = {
+        "subject": kwargs["subject_id"],
+        "session": kwargs.get("session_id"),
+        "log": log_path,
+        "ok": False,
+        "error": None,
+    }
+
+    start = time.time()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o664)
+    saved = (os.dup(1), os.dup(2))
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    try:
+        if not os.path.isdir(kwargs["files_path"]):
+            raise OSError("%s is not a directory!" % kwargs["files_path"])
+        if trace_path is not None:
+            tracing.start()
+        try:
+            result["ok"] = bool(interface(**kwargs))
+        finally:
+            if trace_path is not None:
+                tracing.stop(trace_path)
+        if not result["ok"]:
+            result["error"] = "see log"
+    except Exception as err:
+        traceback.print_exc()
+        result["error"] = "%s: %s" % (type(err).__name__, err)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved + (log_fd,):
+            os.close(fd)
+
+    result["seconds"] = round(time.time() - start, 1)
+    return result
+
+
+def run_batch(jobs, workers):
+    """
+    Runs the jobs with a pool of worker processes. Each worker process runs
+    only one job, so nothing (working directory, open files, memory) leaks
+    from one participant to the next.
+
+    :parameter: jobs: list of job dicts (see run_one).
+    :parameter: workers: maximum number of jobs to run at once.
+    :return: list of result dicts, in the order the jobs finished.
+    """
+    results = []
+    with Pool(processes=max(1, workers), maxtasksperchild=1) as pool:
+        for result in pool.imap_unordered(run_one, jobs):
+            status = "done" if result["ok"] else "FAILED"
+            label = job_label(result["subject"], result["session"])
+            print(
+                "[%d/%d] %s: %s in %ss"
+                % (len(results) + 1, len(jobs), label, status, result["seconds"])
+            )
+            sys.stdout.flush()
+            results.append(result)
+    return results
+
+
+def print_summary(results):
+    failed = [r for r in results if not r["ok"]]
+    print("\n%d of %d succeeded." % (len(results) - len(failed), len(results)))
+    if failed:
+        print("Failures:")
+        for result in failed:
+            label = job_label(result["subject"], result["session"])
+            print("\t%s: %s (log: %s)" % (label, result["error"], result["log"]))
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+        prog="batch",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--study-root",
+        "-r",
+        dest="study_root",
+        required=True,
+        metavar="STUDY_ROOT",
+        help="directory that holds the sub-<label> directories.",
+    )
+    parser.add_argument(
+        "--subjects-file",
+        "-l",
+        dest="subjects_file",
+        metavar="SUBJECTS_FILE",
+        help="Optional. File listing participant labels (and session ids), one "
+        "per line. Default is every participant/session found under the study "
+        "root.",
+    )
+    parser.add_argument(
+        "--bids-root",
+        "-b",
+        dest="bids_root",
+        metavar="BIDS_ROOT",
+        help="Optional. Root of the bids dataset used as input. The func "
+        "directory of each participant/session is used as its --bids-input.",
+    )
+    parser.add_argument(
+        "--dcan-summary",
+        "-d",
+        dest="summary_dir",
+        metavar="DCAN_SUMMARY",
+        help="Optional. Name of the summary subdirectory, relative to 'files'.",
+    )
+    parser.add_argument(
+        "--atlas",
+        "-a",
+        dest="atlas",
+        metavar="ATLAS_PATH",
+        help="Optional. Path to the atlas to register to the images.",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        dest="jobs",
+        type=int,
+        metavar="JOBS",
+        help="Optional. Number of participants/sessions to run at once. Default "
+        "is the number of CPUs allocated to the job.",
+    )
+    parser.add_argument(
+        "--nprocs",
+        "-n",
+        dest="nprocs",
+        type=int,
+        metavar="NPROCS",
+        help="Optional. Processes used by each participant/session. Default "
+        "shares the CPUs evenly between the jobs.",
+    )
+    parser.add_argument(
+        "--log-dir",
+        dest="log_dir",
+        default="executivesummary_logs",
+        metavar="LOG_DIR",
+        help="Optional. Directory for the log of each participant/session. "
+        "Default: executivesummary_logs.",
+    )
+    parser.add_argument(
+        "--summary-json",
+        dest="summary_json",
+        metavar="SUMMARY_JSON",
+        help="Optional. Write the result of each participant/session to this file.",
+    )
+    parser.add_argument(
+        "--encode",
+        dest="encoding",
+        choices=FORMATS,
+        help="Optional. Same as --encode of ExecutiveSummary.py.",
+    )
+    parser.add_argument(
+        "--page",
+        dest="page",
+        choices=["html", "data"],
+        default="html",
+        help="Optional. Same as --page of ExecutiveSummary.py.",
+    )
+    parser.add_argument(
+        "--assets-dir",
+        dest="assets_dir",
+        metavar="ASSETS_DIR",
+        help="Optional. Directory of the local copies of the style sheets and "
+        "scripts, shared by all of the participants/sessions (e.g., "
+        "STUDY_ROOT/executivesummary_assets). Same as --assets-dir of "
+        "ExecutiveSummary.py.",
+    )
+    parser.add_argument(
+        "--static-dir",
+        dest="static_dir",
+        metavar="STATIC_DIR",
+        help="Optional. With --page data, the directory of the renderer, "
+        "shared by all of the participants/sessions. Default is "
+        "STUDY_ROOT/executivesummary_static. Same as --static-dir of "
+        "ExecutiveSummary.py.",
+    )
+    parser.add_argument(
+        "--render-cache",
+        dest="render_cache",
+        metavar="DIR",
+        help="Optional. Directory in which to keep the slices of the atlas, "
+        "so they are rendered once for the study rather than once for each "
+        "participant/session (e.g., STUDY_ROOT/executivesummary_renders).",
+    )
+    parser.add_argument(
+        "--trace",
+        dest="trace",
+        action="store_true",
+        help="Optional. Write a trace of each participant/session, next to its "
+        "log (LOG_DIR/<label>.trace.json). See --trace of ExecutiveSummary.py.",
+    )
+    # These are put in the environment, which is how the worker processes
+    # get them. See ExecutiveSummary.py for what they do.
+    parser.add_argument(
+        "--tools",
+        dest="tools",
+        metavar="MODE[:DIR]",
+        help="Optional. Same as --tools of ExecutiveSummary.py.",
+    )
+    parser.add_argument(
+        "--tool-latency",
+        dest="tool_latency",
+        type=float,
+        metavar="SECONDS",
+        help="Optional. Same as --tool-latency of ExecutiveSummary.py.",
+    )
+    parser.add_argument(
+        "--tool-limit",
+        dest="tool_limits",
+        action="append",
+        metavar="TOOL=N",
+        help="Optional. Same as --tool-limit of ExecutiveSummary.py. The "
+        "limits apply to each participant/session.",
+    )
+    parser.add_argument(
+        "--tool-timeout",
+        dest="tool_timeout",
+        type=float,
+        metavar="SECONDS",
+        help="Optional. Same as --tool-timeout of ExecutiveSummary.py.",
+    )
+    parser.add_argument(
+        "--volume-cache-mb",
+        dest="volume_cache_mb",
+        type=float,
+        metavar="MB",
+        help="Optional. Same as --volume-cache-mb of ExecutiveSummary.py, for "
+        "each participant/session.",
+    )
+    # These are passed along to each participant/session as is. See
+    # ExecutiveSummary.py for what they do.
+    for flag in [
+        "--volume-sprite",
+        "--clean",
+        "--hash-inputs",
+        "--precompress",
+        "--layout-only",
+    ]:
+        parser.add_argument(
+            flag,
+            dest=flag[2:].replace("-", "_"),
+            action="store_true",
+            help="Optional. Same as %s of ExecutiveSummary.py." % flag,
+        )
+
+    return parser
+
+
+def make_jobs(args, subjects, nprocs):
+    jobs = []
+    for subject_id, session_id in subjects:
+        kwargs = {
+            "files_path": files_path_for(args.study_root, subject_id, session_id),
+            "subject_id": subject_id,
+            "session_id": session_id,
+            "layout_only": args.layout_only,
+            "volume_sprite": args.volume_sprite,
+            "clean": args.clean,
+            "hash_inputs": args.hash_inputs,
+            "page": args.page,
+            "precompress": args.precompress,
+            "nprocs": nprocs,
+        }
+        if args.summary_dir is not None:
+            kwargs["summary_dir"] = args.summary_dir
+        if args.atlas is not None:
+            kwargs["atlas"] = args.atlas
+        if args.encoding is not None:
+            kwargs["encoding"] = args.encoding
+        if args.assets_dir is not None:
+            kwargs["assets_dir"] = os.path.abspath(args.assets_dir)
+        elif args.page == "data":
+            # One renderer for the study, so browsers fetch it once.
+            static_dir = args.static_dir or os.path.join(
+                args.study_root, STATIC_DIR_NAME
+            )
+            kwargs["static_dir"] = os.path.abspath(static_dir)
+        if args.bids_root is not None:
+            func_path = os.path.dirname(
+                files_path_for(args.bids_root, subject_id, session_id)
+            )
+            func_path = os.path.join(func_path, "func")
+            if os.path.isdir(func_path):
+                kwargs["func_path"] = func_path
+
+        log_stem = os.path.join(
+            os.path.abspath(args.log_dir), job_label(subject_id, session_id)
+        )
+        job = {"kwargs": kwargs, "log_path": log_stem + ".log"}
+        if args.trace:
+            job["trace_path"] = log_stem + ".trace.json"
+        jobs.append(job)
+    return jobs
+
+
+def _cli():
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.study_root), args.study_root + " is not a directory!"
+    args.study_root = os.path.abspath(args.study_root)
+    if args.atlas is not None:
+        assert os.path.exists(args.atlas), args.atlas + " does not exist!"
+    if args.assets_dir is not None:
+        try:
+            assets.check_vendored()
+        except assets.MissingAssetError as err:
+            parser.error(str(err))
+    try:
+        tool_limits = tools.parse_limits(",".join(args.tool_limits or []))
+    except ValueError as err:
+        parser.error(str(err))
+
+    if args.subjects_file is not None:
+        subjects = read_subject_list(args.subjects_file)
+    else:
+        subjects = discover_subjects(args.study_root)
+    if not subjects:
+        print("No participants found. Exiting.")
+        return
+
+    cpus = available_cpus()
+    workers = min(args.jobs if args.jobs else cpus, len(subjects))
+    nprocs = args.nprocs if args.nprocs else max(1, cpus // workers)
+
+    print("Executive Summary batch of %d participants/sessions:" % len(subjects))
+    print("\tStudy root:            %s" % args.study_root)
+    print("\tJobs at once:          %s" % workers)
+    print("\tProcesses per job:     %s" % nprocs)
+    print("\tLogs:                  %s" % os.path.abspath(args.log_dir))
+    if args.render_cache is not None:
+        # The workers get it from the environment.
+        cache = render_cache.configure(args.render_cache)
+        print("\tRender cache:          %s" % cache.cache_dir)
+    if (
+        args.tools
+        or args.tool_latency is not None
+        or tool_limits
+        or args.tool_timeout is not None
+    ):
+        # So do these.
+        try:
+            tools.configure(
+                args.tools, args.tool_latency, tool_limits, args.tool_timeout
+            )
+        except ValueError as err:
+            parser.error(str(err))
+        print("\tTools:                 %s" % (args.tools or "real"))
+        if tool_limits:
+            print("\tTool limits:           %s" % tools.format_limits(tool_limits))
+        if args.tool_timeout is not None:
+            print("\tTool timeout:          %g s" % args.tool_timeout)
+    if args.volume_cache_mb is not None:
+        volumes.configure(args.volume_cache_mb)
+        print("\tVolume cache:          %g MB" % args.volume_cache_mb)
+    if args.trace:
+        print("\tTraces:                %s" % os.path.abspath(args.log_dir))
+
+    os.makedirs(args.log_dir, exist_ok=True)
+    results = run_batch(make_jobs(args, subjects, nprocs), workers)
+    print_summary(results)
+
+    if args.summary_json is not None:
+        with open(args.summary_json, "w") as fd:
+            json.dump(results, fd, indent=1)
+
+    if any(not result["ok"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    _cli()
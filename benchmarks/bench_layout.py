@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Times the layout step for a fake session with more and more tasks, to show
+that building the HTML scales linearly with the number of tasks. Every task
+has all of the images the layout looks for; the session is made by
+synthetic.make_dataset.
+
+Prints the time per task for each number of tasks. If the layout scales
+linearly, the time per task stays about the same as the tasks increase.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from layout_builder import layout_builder  # noqa: E402
+from synthetic import SUBJECT_ID, make_dataset  # noqa: E402
+
+
+def time_layout(paths, repeat):
+    # Best of repeat runs, with the output of the layout thrown away.
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            layout_builder(*paths, SUBJECT_ID)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+        prog="bench_layout",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--tasks",
+        dest="tasks",
+        type=int,
+        nargs="+",
+        default=[50, 100, 200, 400, 800, 1600],
+        metavar="NUM_TASKS",
+        help="Optional. Numbers of tasks to time. Default: 50 ... 1600.",
+    )
+    parser.add_argument(
+        "--repeat",
+        dest="repeat",
+        type=int,
+        default=3,
+        metavar="REPEAT",
+        help="Optional. Runs per number of tasks; the best is kept. Default: 3.",
+    )
+
+    return parser
+
+
+def _cli():
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    print("%8s %10s %14s" % ("tasks", "seconds", "ms per task"))
+    for num_tasks in args.tasks:
+        root = tempfile.mkdtemp(prefix="bench_layout_")
+        try:
+            dataset = make_dataset(root, num_tasks)
+            paths = [dataset[key] for key in ["files", "summary", "html", "images"]]
+            seconds = time_layout(paths, args.repeat)
+        finally:
+            shutil.rmtree(root)
+        print("%8d %10.3f %14.3f" % (num_tasks, seconds, 1000.0 * seconds / num_tasks))
+
+
+if __name__ == "__main__":
+
+    _cli()
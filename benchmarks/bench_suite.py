@@ -0,0 +1,397 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Times the layout and the helpers it uses on synthetic subjects (see
+synthetic.py) with more and more runs, and make_mosaic on a set of
+brainsprite frames. Results are written as JSON, with the commit they were
+run on, so that runs on two commits can be compared:
+
+    python benchmarks/bench_suite.py --out before.json
+    (check out another commit)
+    python benchmarks/bench_suite.py --out after.json --compare before.json
+
+Benchmarks:
+    layout_builder        the whole layout, with no scan cache.
+    layout_builder_warm   the whole layout, with the scan cache of a prior run.
+                          On a local disk, listing a directory is cheap, so
+                          this is about the same as layout_builder; the cache
+                          pays on network file systems.
+    get_list_of_tasks     finding the task directories.
+    image_index           listing and sorting the images of the layout.
+    find_one_file         one lookup per run with helpers.find_one_file.
+    find_files            one glob per run with helpers.find_files.
+    make_mosaic           the brainsprite mosaic from the frames (does not
+                          depend on the number of runs).
+
+Only with --bench, as they take longer (the subjects have volumes):
+    preprocess            the whole preprocessor, from scratch, with the
+                          tools replayed (see tools.py), each call taking
+                          --tool-latency seconds.
+    preprocess_warm       the preprocessor, with every image up to date.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import constants  # noqa: E402
+from helpers import ImageIndex, available_cpus, find_files, find_one_file  # noqa: E402
+from layout_builder import layout_builder  # noqa: E402
+import tools  # noqa: E402
+from mosaic import make_mosaic  # noqa: E402
+from preproc import preprocess  # noqa: E402
+from scan_cache import SCAN_CACHE_NAME, ScanCache  # noqa: E402
+from synthetic import SUBJECT_ID, make_dataset, make_frames, task_runs  # noqa: E402
+
+DEFAULT_SIZES = [1, 10, 50, 100, 250, 500]
+
+BENCHMARKS = [
+    "layout_builder",
+    "layout_builder_warm",
+    "get_list_of_tasks",
+    "image_index",
+    "find_one_file",
+    "find_files",
+    "make_mosaic",
+    "preprocess",
+    "preprocess_warm",
+]
+DEFAULT_BENCHMARKS = BENCHMARKS[:-2]
+
+
+def time_calls(func, repeat, setup=None):
+    """
+    Times func repeat times, with anything it prints thrown away.
+
+    :parameter: func: function of no arguments.
+    :parameter: repeat: number of times to call it.
+    :parameter: setup: optional function called before each call, not timed.
+    :return: list of seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def layout_benchmarks(paths, num_runs):
+    # The benchmarks that depend on the number of runs, as name: (func, setup).
+    cache_path = os.path.join(paths["html"], SCAN_CACHE_NAME)
+
+    def run_layout():
+        layout_builder(
+            paths["files"], paths["summary"], paths["html"], paths["images"], SUBJECT_ID
+        )
+
+    def remove_cache():
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+    def list_tasks():
+        # get_list_of_tasks only needs the files path and a scan cache.
+        builder = SimpleNamespace(files_path=paths["files"], scan_cache=ScanCache())
+        layout_builder.get_list_of_tasks(builder)
+
+    def index_images():
+        ImageIndex(paths["images"], constants.IMAGE_INFO, ScanCache())
+
+    runs = ["task-%s%02d" % run for run in task_runs(num_runs)]
+
+    def find_one_per_run():
+        for run in runs:
+            find_one_file(paths["images"], "*%s*_desc-TaskInT1.gif" % run)
+
+    def find_per_run():
+        for run in runs:
+            find_files(paths["summary"], "*DVARS_and_FD*%s*.png" % run)
+
+    return {
+        "layout_builder": (run_layout, remove_cache),
+        "layout_builder_warm": (run_layout, None),
+        "get_list_of_tasks": (list_tasks, None),
+        "image_index": (index_images, None),
+        "find_one_file": (find_one_per_run, None),
+        "find_files": (find_per_run, None),
+    }
+
+
+def preproc_benchmarks(paths, workers):
+    # The preprocessor on a subject with volumes, as name: (func, setup).
+    made = [
+        paths["html"],
+        os.path.join(paths["files"], "resampled"),
+        os.path.join(paths["files"], "T1_pngs"),
+        os.path.join(paths["files"], "T2_pngs"),
+    ]
+
+    def run_preproc():
+        preprocess(
+            paths["files"],
+            SUBJECT_ID,
+            bids_input=paths["func"],
+            atlas=paths["atlas"],
+            pngs_template=paths["pngs_template"],
+            brainsprite_template=paths["brainsprite_template"],
+            nprocs=workers,
+        )
+
+    def remove_images():
+        for dir_path in made:
+            shutil.rmtree(dir_path, ignore_errors=True)
+
+    return {
+        "preprocess": (run_preproc, remove_images),
+        "preprocess_warm": (run_preproc, None),
+    }
+
+
+def run_benchmarks(sizes, benchmarks, repeat, num_frames, workers):
+    """
+    Runs the benchmarks.
+
+    :parameter: sizes: numbers of runs of the synthetic subjects.
+    :parameter: benchmarks: names of the benchmarks to run.
+    :parameter: repeat: number of times each benchmark is timed.
+    :parameter: num_frames: number of frames for make_mosaic.
+    :parameter: workers: number of threads make_mosaic may use.
+    :return: list of result dictionaries.
+    """
+    results = []
+
+    def record(name, num_runs, times):
+        results.append(
+            {
+                "benchmark": name,
+                "runs": num_runs,
+                "repeat": len(times),
+                "best": min(times),
+                "median": statistics.median(times),
+                "times": times,
+            }
+        )
+        print(
+            "%-20s %6s %10.4f %10.4f"
+            % (
+                name,
+                "-" if num_runs is None else num_runs,
+                min(times),
+                results[-1]["median"],
+            )
+        )
+        sys.stdout.flush()
+
+    print("%-20s %6s %10s %10s" % ("benchmark", "runs", "best (s)", "median (s)"))
+    for num_runs in sizes:
+        root = tempfile.mkdtemp(prefix="bench_suite_")
+        try:
+            paths = make_dataset(root, num_runs)
+            for name, (func, setup) in layout_benchmarks(paths, num_runs).items():
+                if name in benchmarks:
+                    record(name, num_runs, time_calls(func, repeat, setup))
+        finally:
+            shutil.rmtree(root)
+
+        if "preprocess" not in benchmarks and "preprocess_warm" not in benchmarks:
+            continue
+        root = tempfile.mkdtemp(prefix="bench_suite_")
+        try:
+            paths = make_dataset(root, num_runs, volumes=True)
+            for name, (func, setup) in preproc_benchmarks(paths, workers).items():
+                if name in benchmarks:
+                    record(name, num_runs, time_calls(func, repeat, setup))
+        finally:
+            shutil.rmtree(root)
+
+    if "make_mosaic" in benchmarks and num_frames:
+        root = tempfile.mkdtemp(prefix="bench_suite_")
+        try:
+            pngs_dir = os.path.join(root, "T1_pngs")
+            make_frames(pngs_dir, num_frames)
+            mosaic_path = os.path.join(root, "T1_mosaic.jpg")
+            times = time_calls(
+                lambda: make_mosaic(pngs_dir, mosaic_path, workers=workers), repeat
+            )
+            record("make_mosaic", None, times)
+        finally:
+            shutil.rmtree(root)
+
+    return results
+
+
+def git_commit():
+    # The commit the benchmarks were run on, if this is a git checkout.
+    try:
+        out = subprocess.run(
+            ["git", "-C", REPO_DIR, "describe", "--always", "--dirty"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        return out.stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """
+    Prints how the results compare with those in a prior JSON file.
+
+    :parameter: results: list of result dictionaries.
+    :parameter: baseline_path: path to the JSON written by a prior run.
+    :return: None
+    """
+    with open(baseline_path) as fd:
+        baseline = json.load(fd)
+    before = dict(((r["benchmark"], r["runs"]), r["best"]) for r in baseline["results"])
+
+    print(
+        "\nCompared with %s (commit %s):"
+        % (baseline_path, baseline["meta"].get("commit"))
+    )
+    print("%-20s %6s %10s %10s %8s" % ("benchmark", "runs", "before", "after", "ratio"))
+    for result in results:
+        key = (result["benchmark"], result["runs"])
+        if key not in before:
+            continue
+        print(
+            "%-20s %6s %10.4f %10.4f %7.2fx"
+            % (
+                result["benchmark"],
+                "-" if result["runs"] is None else result["runs"],
+                before[key],
+                result["best"],
+                before[key] / result["best"] if result["best"] else float("inf"),
+            )
+        )
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+        prog="bench_suite",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--sizes",
+        dest="sizes",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SIZES,
+        metavar="NUM_RUNS",
+        help="Optional. Numbers of runs of the synthetic subjects. "
+        "Default: 1 10 50 100 250 500.",
+    )
+    parser.add_argument(
+        "--bench",
+        dest="benchmarks",
+        nargs="+",
+        choices=BENCHMARKS,
+        default=DEFAULT_BENCHMARKS,
+        metavar="NAME",
+        help="Optional. Benchmarks to run. Default: all but preprocess and "
+        "preprocess_warm.",
+    )
+    parser.add_argument(
+        "--repeat",
+        dest="repeat",
+        type=int,
+        default=5,
+        help="Optional. Number of times each benchmark is timed. Default: 5.",
+    )
+    parser.add_argument(
+        "--frames",
+        dest="frames",
+        type=int,
+        default=169,
+        help="Optional. Number of frames for make_mosaic. Default: 169.",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        help="Optional. Threads make_mosaic, and jobs the preprocessor, may "
+        "use. Default: number of CPUs.",
+    )
+    parser.add_argument(
+        "--tool-latency",
+        dest="tool_latency",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="Optional. Time each replayed tool call takes, for the "
+        "preprocess benchmarks. Default: 0.",
+    )
+    parser.add_argument(
+        "--out",
+        dest="out",
+        metavar="RESULTS_JSON",
+        help="Optional. Write the results to this JSON file.",
+    )
+    parser.add_argument(
+        "--compare",
+        dest="compare",
+        metavar="BASELINE_JSON",
+        help="Optional. Compare the results with those of a prior run.",
+    )
+
+    return parser
+
+
+def _cli():
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    # The preprocess benchmarks never run the real tools.
+    tools.configure("replay", args.tool_latency)
+
+    results = run_benchmarks(
+        args.sizes, args.benchmarks, max(1, args.repeat), args.frames, args.workers
+    )
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": available_cpus(),
+            "repeat": args.repeat,
+            "frames": args.frames,
+            "tool_latency": args.tool_latency,
+        },
+        "results": results,
+    }
+
+    if args.out:
+        with open(args.out, "w") as fd:
+            json.dump(report, fd, indent=1)
+        print("\nResults written to: %s" % args.out)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+
+    _cli()
@@ -0,0 +1,367 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Makes a fake, but realistic, 'files' directory for one subject, as left by the
+DCAN-Labs fMRI pipelines and the executivesummary preprocessor, for
+benchmarks. For a given number of runs, it makes:
+    MNINonLinear/Results/task-<name><run>/    with a small BOLD volume,
+    summary/                                   DVARS and FD plots,
+    executivesummary/img/                      registration gifs, BOLD and
+                                               SBRef pngs, and the T1/T2 pngs,
+    T1_pngs/, T2_pngs/                         brainsprite frames,
+and, optionally, small synthetic volumes for the anatomy, the subcorticals,
+and the BIDS func directory, with scene templates for the pngs and the
+brainsprite (with tools.py replay, the preprocessor can then be run without
+workbench or FSL). The images are tiny, but valid, pngs and gifs;
+only the brainsprite frames are full size, as make_mosaic reads them.
+
+Task names have no digits in them, and each task has up to runs_per_task
+runs, as the layout expects.
+"""
+
+import argparse
+import io
+import os
+import time
+
+import nibabel as nib
+import numpy as np
+from PIL import Image
+
+SUBJECT_ID = "01"
+
+# Size, in pixels, of a frame rendered by wb_command -show-scene.
+FRAME_SIZE = (900, 800)
+
+# Shape of the synthetic anatomical volumes (2 mm voxels).
+VOLUME_SHAPE = (48, 56, 48)
+
+# Names of the images made for each run, by the preprocessor and by
+# DCAN-BOLD processing.
+TASK_IMAGES = [
+    "sub-{subject}_task-{task}{run:02d}_desc-TaskInT1.gif",
+    "sub-{subject}_task-{task}{run:02d}_desc-T1InTask.gif",
+    "sub-{subject}_task-{task}{run:02d}_desc-TaskInT2.gif",
+    "sub-{subject}_task-{task}{run:02d}_desc-T2InTask.gif",
+    "sub-{subject}_task-{task}_run-{run:02d}_bold.png",
+    "sub-{subject}_task-{task}_run-{run:02d}_sbref.png",
+]
+SUMMARY_IMAGES = [
+    "DVARS_and_FD_task-{task}{run:02d}.png",
+    "postreg_DVARS_and_FD_task-{task}{run:02d}.png",
+]
+ANAT_IMAGES = [
+    "sub-{subject}_desc-AtlasInT1w.gif",
+    "sub-{subject}_desc-T1wInAtlas.gif",
+    "sub-{subject}_desc-AtlasInSubcort.gif",
+    "sub-{subject}_desc-SubcortInAtlas.gif",
+]
+ANAT_VOLUMES = [
+    "T1w_restore.nii.gz",
+    "T1w_restore_brain.nii.gz",
+    "T2w_restore.nii.gz",
+    "T2w_restore_brain.nii.gz",
+    os.path.join("ROIs", "sub2atl_ROI.2.nii.gz"),
+    os.path.join("ROIs", "Atlas_ROIs.2.nii.gz"),
+]
+SURFACES = ["R.white", "R.pial", "L.white", "L.pial"]
+
+# Number of scenes in the pngs template and in the brainsprite template.
+PNGS_SCENES = 18
+SPRITE_SCENES = 169
+
+
+def task_name(idx):
+    # Task names must not have digits in them: 0 -> taska, 12 -> taskbc.
+    return "task" + "".join(chr(ord("a") + int(d)) for d in str(idx))
+
+
+def task_runs(num_runs, runs_per_task=4):
+    """
+    Names the runs of a fake session.
+
+    :parameter: num_runs: total number of runs.
+    :parameter: runs_per_task: number of runs of each task.
+    :return: list of (task, run) tuples; runs start at 1.
+    """
+    return [
+        (task_name(idx // runs_per_task), idx % runs_per_task + 1)
+        for idx in range(num_runs)
+    ]
+
+
+def image_bytes(fmt, size=(64, 16)):
+    # A small, valid image, encoded once and written as many times as needed.
+    img = Image.new("L", size)
+    img.putdata([(x * 4) % 256 for x in range(size[0] * size[1])])
+    buf = io.BytesIO()
+    img.save(buf, fmt)
+    return buf.getvalue()
+
+
+def write_bytes(file_path, data):
+    with open(file_path, "wb") as fd:
+        fd.write(data)
+
+
+def make_frames(pngs_dir, num_frames, size=FRAME_SIZE):
+    """
+    Makes brainsprite frames: a bright ellipse, which moves from frame to
+    frame, on a dark background, like a sagittal slice of a head.
+
+    :parameter: pngs_dir: directory in which to make the frames.
+    :parameter: num_frames: number of frames.
+    :parameter: size: (width, height) of each frame.
+    :return: None
+    """
+    os.makedirs(pngs_dir, exist_ok=True)
+    width, height = size
+    yy, xx = np.mgrid[0:height, 0:width]
+    for num in range(1, num_frames + 1):
+        radius = 0.25 + 0.15 * np.sin(np.pi * num / (num_frames + 1))
+        inside = ((xx - width / 2.0) / (radius * width)) ** 2 + (
+            (yy - height / 2.0) / (radius * height)
+        ) ** 2
+        gray = np.clip(255 * (1.2 - inside), 0, 255).astype(np.uint8)
+        Image.fromarray(np.dstack([gray] * 3), "RGB").save(
+            os.path.join(pngs_dir, "P_%03d.png" % num), compress_level=1
+        )
+
+
+def make_volume(file_path, shape=VOLUME_SHAPE, vols=None, seed=0):
+    """
+    Makes a small volume: a smooth blob with noise, with 2 mm voxels centered
+    on the origin.
+
+    :parameter: file_path: path to the .nii.gz.
+    :parameter: shape: shape of the volume.
+    :parameter: vols: optional number of time points.
+    :parameter: seed: seed of the noise.
+    :return: None
+    """
+    rng = np.random.RandomState(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, dim) for dim in shape], indexing="ij")
+    blob = np.exp(-2 * sum(axis**2 for axis in grid)) * 1000
+    data = (blob + rng.normal(0, 20, shape)).astype(np.float32)
+    if vols is not None:
+        data = np.repeat(data[..., np.newaxis], vols, axis=3)
+
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    affine[:3, 3] = -np.array(shape, dtype=float)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    nib.save(nib.Nifti1Image(data, affine), file_path)
+
+
+def make_template(file_path, num_scenes, placeholders):
+    """
+    Makes a scene template with the placeholders the preprocessor fills in,
+    and num_scenes scenes. Only its scenes are counted, and only the
+    stand-in for wb_command (see tools.py) reads it.
+
+    :parameter: file_path: path to the .scene file.
+    :parameter: num_scenes: number of scenes.
+    :parameter: placeholders: list of placeholders.
+    :return: None
+    """
+    lines = ["<SceneFile>"] + ["<!-- %s -->" % text for text in placeholders]
+    for idx in range(num_scenes):
+        lines.append('<Scene Index="%d"><SceneInfo Index="%d"/></Scene>' % (idx, idx))
+    lines.append("</SceneFile>")
+    with open(file_path, "w") as fd:
+        fd.write("\n".join(lines) + "\n")
+
+
+def age_tree(root, seconds):
+    """
+    Sets the times of everything under root back by seconds, as if the
+    pipelines had run a while ago. Directories modified in the last moments
+    are always listed again by the scan cache, so a fresh tree never shows
+    the effect of the cache.
+
+    :parameter: root: top of the tree.
+    :parameter: seconds: how far back to set the times.
+    :return: None
+    """
+    when = time.time() - seconds
+    for dir_path, _, names in os.walk(root):
+        for name in names:
+            os.utime(os.path.join(dir_path, name), (when, when))
+        os.utime(dir_path, (when, when))
+
+
+def make_dataset(
+    root,
+    num_runs,
+    runs_per_task=4,
+    subject_id=SUBJECT_ID,
+    num_frames=0,
+    volumes=False,
+):
+    """
+    Makes a fake subject under root.
+
+    :parameter: root: directory in which to make the subject.
+    :parameter: num_runs: total number of runs (task/run pairs).
+    :parameter: runs_per_task: number of runs of each task.
+    :parameter: subject_id: subject id without sub- prefix.
+    :parameter: num_frames: number of T1 and T2 brainsprite frames (0 for
+                none).
+    :parameter: volumes: if True, make the anatomical, subcortical, task, and
+                BIDS func volumes (and empty surfaces), so the preprocessor
+                can be run on the subject.
+    :return: dictionary of the paths: files, summary, html, images, func,
+             atlas, pngs_template, and brainsprite_template (the last four
+             are None without volumes).
+    """
+    files_path = os.path.join(root, "files")
+    atlas_space = os.path.join(files_path, "MNINonLinear")
+    results_path = os.path.join(atlas_space, "Results")
+    summary_path = os.path.join(files_path, "summary")
+    html_path = os.path.join(files_path, "executivesummary")
+    images_path = os.path.join(html_path, "img")
+    func_path = os.path.join(root, "func")
+    for dir_path in [results_path, summary_path, images_path]:
+        os.makedirs(dir_path, exist_ok=True)
+
+    png = image_bytes("PNG")
+    gif = image_bytes("GIF")
+
+    def write_image(dir_path, name):
+        write_bytes(os.path.join(dir_path, name), gif if name.endswith(".gif") else png)
+
+    for tx in ["T1", "T2"]:
+        for num in range(1, 10):
+            write_image(images_path, "sub-%s_%s-%d.png" % (subject_id, tx, num))
+    for name in ANAT_IMAGES:
+        write_image(images_path, name.format(subject=subject_id))
+    for name in [
+        "DVARS_and_FD_CONCA_task-rest.png",
+        "DVARS_and_FD_CONCP_task-rest.png",
+    ]:
+        write_image(summary_path, name)
+
+    for task, run in task_runs(num_runs, runs_per_task):
+        values = {"subject": subject_id, "task": task, "run": run}
+        run_dir = "task-%s%02d" % (task, run)
+        os.makedirs(os.path.join(results_path, run_dir), exist_ok=True)
+        for name in TASK_IMAGES:
+            write_image(images_path, name.format(**values))
+        for name in SUMMARY_IMAGES:
+            write_image(summary_path, name.format(**values))
+
+        if volumes:
+            task_shape = tuple(dim // 2 for dim in VOLUME_SHAPE)
+            make_volume(
+                os.path.join(results_path, run_dir, run_dir + ".nii.gz"), task_shape
+            )
+            bids_name = "sub-%s_task-%s_run-%02d" % (subject_id, task, run)
+            for suffix, vols in [("_bold", 4), ("_sbref", None)]:
+                make_volume(
+                    os.path.join(func_path, bids_name + suffix + ".nii.gz"),
+                    task_shape,
+                    vols,
+                )
+
+    if volumes:
+        for seed, name in enumerate(ANAT_VOLUMES):
+            make_volume(os.path.join(atlas_space, name), seed=seed)
+        surf_dir = os.path.join(atlas_space, "fsaverage_LR32k")
+        os.makedirs(surf_dir, exist_ok=True)
+        for surf in SURFACES:
+            # Only workbench reads these; they just need to exist.
+            write_bytes(
+                os.path.join(surf_dir, "%s.%s.32k_fs_LR.surf.gii" % (subject_id, surf)),
+                b"",
+            )
+
+        surfaces = ["RPIAL", "LPIAL", "RWHITE", "LWHITE"]
+        make_template(
+            os.path.join(root, "pngs.scene"),
+            PNGS_SCENES,
+            ["T2_IMG_PATH", "T1_IMG_PATH"] + [name + "_PATH" for name in surfaces],
+        )
+        make_template(
+            os.path.join(root, "brainsprite.scene"),
+            SPRITE_SCENES,
+            ["TX_IMG_NAME_and_PATH"],
+        )
+
+    if num_frames:
+        for tx in ["T1", "T2"]:
+            make_frames(os.path.join(files_path, tx + "_pngs"), num_frames)
+
+    age_tree(root, 3600)
+
+    return {
+        "files": files_path,
+        "summary": summary_path,
+        "html": html_path,
+        "images": images_path,
+        "func": func_path if volumes else None,
+        "atlas": os.path.join(atlas_space, ANAT_VOLUMES[1]) if volumes else None,
+        "pngs_template": os.path.join(root, "pngs.scene") if volumes else None,
+        "brainsprite_template": (
+            os.path.join(root, "brainsprite.scene") if volumes else None
+        ),
+    }
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+        prog="synthetic",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("root", metavar="ROOT", help="directory in which to make it.")
+    parser.add_argument(
+        "--runs",
+        dest="runs",
+        type=int,
+        default=8,
+        help="Optional. Total number of runs. Default: 8.",
+    )
+    parser.add_argument(
+        "--runs-per-task",
+        dest="runs_per_task",
+        type=int,
+        default=4,
+        help="Optional. Number of runs of each task. Default: 4.",
+    )
+    parser.add_argument(
+        "--frames",
+        dest="frames",
+        type=int,
+        default=169,
+        help="Optional. Number of brainsprite frames for each of T1 and T2 "
+        "(0 for none). Default: 169.",
+    )
+    parser.add_argument(
+        "--volumes",
+        dest="volumes",
+        action="store_true",
+        help="Optional. Make synthetic volumes too, so that the preprocessor "
+        "can be run.",
+    )
+
+    return parser
+
+
+def _cli():
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    paths = make_dataset(
+        args.root,
+        args.runs,
+        runs_per_task=args.runs_per_task,
+        num_frames=args.frames,
+        volumes=args.volumes,
+    )
+    for key in sorted(paths):
+        print("%-21s %s" % (key, paths[key]))
+
+
+if __name__ == "__main__":
+
+    _cli()
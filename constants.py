@@ -28,17 +28,19 @@ IMAGE_INFO = {
     "bold": {"pattern": "*%s*bold.png", "title": "BOLD"},
 }
 
+# The images of each part of the page, by key in IMAGE_INFO, in the order in
+# which they are shown.
+ATLAS_ROW_KEYS = ["atlas_in_t1", "t1_in_atlas", "atlas_in_subcort", "subcort_in_atlas"]
+CONCAT_GRAY_KEYS = ["concat_pre_reg_gray", "concat_post_reg_gray"]
+TASK_REG_KEYS = ["task_in_t1", "t1_in_task"]
+BOLD_KEYS = ["bold", "ref"]
+TASK_GRAY_KEYS = ["task_pre_reg_gray", "task_post_reg_gray"]
+
 # HTML constants:
-HTML_START = """
-<!DOCTYPE html>
-<html>
-<meta name="viewport" content="width=device-width, initial-scale=1">
-<link rel="stylesheet" href="https://www.w3schools.com/w3css/4/w3.css">
-<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/4.7.0/css/font-awesome.min.css">
-<link rel="stylesheet" href="https://use.fontawesome.com/releases/v5.7.0/css/all.css"
-    integrity="sha384-lZN37f5QGtY3VHgisS14W3ExzMWZxybE1SJSEsQp9S+oqd12jhcu+A56Ebc1zFSJ" crossorigin="anonymous">
-<style type="text/css">
-    header, footer, section, article, nav, aside { display: block; }
+
+# The style of the page. Also written to the style sheet of the renderer of
+# data pages (see RENDERER_JS).
+PAGE_CSS = """    header, footer, section, article, nav, aside { display: block; }
     h1, h2, h3, body, button, p, w3-btn { font-family: Verdana, Helvetica, Arial, Bookman, sans-serif; }
     h1 { text-align: center; font-size: 2.5em; }
     h2{ text-align: center; font-size: 2.00em; }
@@ -55,9 +57,42 @@ HTML_START = """
     .T1pngs, .T2pngs, .Registrations, .Images { display: none; }
     .modal { vertical-align: top; margin-top:0; border-top-style:none; padding-top:0; top:0; height: 100%; width: auto; }
     .Images{ height: 100%; width: auto; }
-</style>
+"""
+
+# The style sheets of the page, from their CDNs. When the page uses local
+# copies of them (see assets.py), it links to those instead.
+CDN_STYLE_SHEETS = """<link rel="stylesheet" href="https://www.w3schools.com/w3css/4/w3.css">
+<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/4.7.0/css/font-awesome.min.css">
+<link rel="stylesheet" href="https://use.fontawesome.com/releases/v5.7.0/css/all.css"
+    integrity="sha384-lZN37f5QGtY3VHgisS14W3ExzMWZxybE1SJSEsQp9S+oqd12jhcu+A56Ebc1zFSJ" crossorigin="anonymous">
+"""
+
+# Needs the following value:
+#    href.
+STYLE_SHEET = """<link rel="stylesheet" href="{href}">
+"""
+
+# Needs the following value:
+#    src.
+SCRIPT = """<script src="{src}"></script>
+"""
+
+HTML_HEAD_START = """
+<!DOCTYPE html>
+<html>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+"""
+
+HTML_HEAD_END = (
+    """<style type="text/css">
+"""
+    + PAGE_CSS
+    + """</style>
 <body>
 """
+)
+
+HTML_START = HTML_HEAD_START + CDN_STYLE_SHEETS + HTML_HEAD_END
 
 # Make the html 'title' (what will be seen on the tab, etc.),
 # as well as the page header.
@@ -96,28 +131,30 @@ TX_SECTION = """
 
 # Layout images in different formats - row, half, quarter.
 # Needs the following values:
-#    row_label, row_img, row_modal, row_idx
+#    row_label, row_img, row_srcset, row_modal, row_idx
 # Modal and idx are the slider and the index into the slider (or other modal
 # container) to which the image was added. If the user clicks on the image, html
 # will open the modal container to the index.
+# The rows show thumbnails (row_img is the smallest, row_srcset lists them all),
+# and are loaded lazily; sizes is the width of the image in each w3 layout.
 LAYOUT_ROW = """
         <div  class="w3-row-padding">
             <div class="w3-col l1 label2">{row_label}</div>
-            <div class="w3-col l11"><img src="{row_img}" onclick="open_{row_modal}_to_index({row_idx})"></div>
+            <div class="w3-col l11"><img src="{row_img}" srcset="{row_srcset}" sizes="(min-width: 993px) 92vw, 100vw" loading="lazy" onclick="open_{row_modal}_to_index({row_idx})"></div>
         </div>
         """
 
 LAYOUT_HALF_ROW = """
         <div  class="w3-row-padding">
             <div class="w3-col l2 label2">{row_label}</div>
-            <div class="w3-col l9"><img src="{row_img}" onclick="open_{row_modal}_to_index({row_idx})"></div>
+            <div class="w3-col l9"><img src="{row_img}" srcset="{row_srcset}" sizes="(min-width: 993px) 38vw, (min-width: 601px) 50vw, 100vw" loading="lazy" onclick="open_{row_modal}_to_index({row_idx})"></div>
         </div>
         """
 
 LAYOUT_QUARTER_ROW = """
             <div class="w3-quarter">
                 <div class="w3-row w3-center label1">{row_label}</div>
-                <div class="w3-row"><img src="{row_img}" onclick="open_{row_modal}_to_index({row_idx})"></div>
+                <div class="w3-row"><img src="{row_img}" srcset="{row_srcset}" sizes="(min-width: 601px) 25vw, 100vw" loading="lazy" onclick="open_{row_modal}_to_index({row_idx})"></div>
             </div>
             """
 
@@ -275,38 +312,49 @@ MODAL_END = """
 """
 
 
-# Add an image in a container with its filename displayed in the
+# The image shown in a container, with its filename displayed in the
 # upper left corner. The filename is 'w3-black' so that the text
 # will be white and show up against the fMRI image without being
 # too obtrusive.
-# We assign a specific class so that scripts can find the images
-# by calling getElementsByClassName().
+# There is one of these per container, no matter how many images it
+# has: the scripts put the URL and name of the image to show into it.
+# (The class is hidden by the page style; this one is always shown.)
 # Needs the following values:
-#    image_class, image_file, display_name.
-IMAGE_WITH_CLASS = """
-                <div class="w3-display-container {image_class}">
-                    <img src="{image_file}">
-                    <div class="w3-display-topleft w3-black"><p>{display_name}</p></div>
+#    image_class.
+SLIDE_VIEWER = """
+                <div class="w3-display-container {image_class}" style="display: block">
+                    <img id="{image_class}-img" alt="">
+                    <div class="w3-display-topleft w3-black"><p id="{image_class}-name"></p></div>
                 </div>
                 """
 
 # The modal scripts that will show the chosen image.
+# The images of the container are a list of [URL, name] (slides). Showing an
+# image only sets the URL of the one <img> in the container, and starts
+# fetching and decoding the images on either side of it, so that stepping to
+# them is quick. Nothing is fetched until the container is opened.
 # Needs the following values:
-#    modal_id, image_class.
+#    modal_id, image_class, slides (JSON).
 MODAL_SCRIPTS = """
 <script>
+    var %(image_class)sSlides = %(slides)s;
     var %(image_class)sIdx = 1;
-    show_%(image_class)s(%(image_class)sIdx)
+    var %(image_class)sNear = [];
 
     function show_%(image_class)s(n) {
-        var i;
-        var x = document.getElementsByClassName("%(image_class)s");
+        var x = %(image_class)sSlides;
+        if (x.length == 0) { return }
         if (n > x.length) { %(image_class)sIdx = 1 }
         if (n < 1) { %(image_class)sIdx = x.length }
-        for (i = 0; i < x.length; i++) {
-            x[i].style.display = "none";
-        }
-        x[%(image_class)sIdx-1].style.display = "block";
+        var slide = x[%(image_class)sIdx-1];
+        document.getElementById("%(image_class)s-img").src = slide[0];
+        document.getElementById("%(image_class)s-name").textContent = slide[1];
+        %(image_class)sNear = [-1, 1].map(function (step) {
+            var img = new Image();
+            img.src = x[(%(image_class)sIdx - 1 + step + x.length) %% x.length][0];
+            if (img.decode) { img.decode().catch(function () {}) }
+            return img;
+        });
     }
 
     function open_%(modal_id)s_to_index(idx) {
@@ -317,33 +365,14 @@ MODAL_SCRIPTS = """
 """
 
 # The slider scripts that will show the next or previous image
-# in a given class.
+# in a given class. Used along with MODAL_SCRIPTS.
 # Needs the following values:
-#    modal_id, image_class.
+#    image_class.
 SLIDER_SCRIPTS = """
 <script>
-    var %(image_class)sIdx = 1;
-    show_%(image_class)s(%(image_class)sIdx)
-
     function change_%(image_class)s(n) {
         show_%(image_class)s(%(image_class)sIdx += n)
     }
-
-    function show_%(image_class)s(n) {
-        var i;
-        var x = document.getElementsByClassName("%(image_class)s");
-        if (n > x.length) { %(image_class)sIdx = 1 }
-        if (n < 1) { %(image_class)sIdx = x.length }
-        for (i = 0; i < x.length; i++) {
-            x[i].style.display = "none";
-        }
-        x[%(image_class)sIdx-1].style.display = "block";
-    }
-
-    function open_%(modal_id)s_to_index(idx) {
-        show_%(image_class)s(%(image_class)sIdx = idx)
-        document.getElementById("%(modal_id)s").style.display='block'
-    }
 </script>
 """
 
@@ -382,8 +411,7 @@ SPRITE_LOAD_SCRIPT = """
 # This contant is only needed once (thank goodness) and does not need
 # any values inserted. Just include it in the HTML whereever you have
 # your scripts.
-BRAINSPRITE_SCRIPTS = """
-<script>
+BRAINSPRITE_JS = """
 function brainsprite(params) {
 
   // Function to add nearest neighbour interpolation to a canvas
@@ -859,7 +887,223 @@ function brainsprite(params) {
 
   return brain;
 };
-</script>
-<script src="http://ajax.googleapis.com/ajax/libs/jquery/2.1.1/jquery.min.js"></script>
-<script src="http://ajax.googleapis.com/ajax/libs/jqueryui/1.9.1/jquery-ui.min.js"></script>
+"""
+
+# jQuery, from its CDN, for the loader scripts of the BrainSprites.
+CDN_JQUERY_SCRIPTS = """<script src="https://ajax.googleapis.com/ajax/libs/jquery/2.1.1/jquery.min.js"></script>
+<script src="https://ajax.googleapis.com/ajax/libs/jqueryui/1.9.1/jquery-ui.min.js"></script>
+"""
+
+BRAINSPRITE_SCRIPTS = (
+    """
+<script>"""
+    + BRAINSPRITE_JS
+    + """</script>
+"""
+    + CDN_JQUERY_SCRIPTS
+)
+
+
+# DATA PAGE STUFF
+
+# A data page holds only the data of the page (the sections, rows, and images
+# of the modal containers, as JSON), and is laid out in the browser by the
+# renderer: a script and style sheet shared by all of the pages. Change
+# RENDERER_VERSION whenever the renderer changes, so that browsers do not use
+# a copy of the old one.
+RENDERER_VERSION = "1"
+RENDERER_NAME = "execsummary-renderer-" + RENDERER_VERSION
+
+# Needs the following values:
+#    style_sheets, renderer_css, subject, session, data, renderer_js.
+DATA_PAGE = """<!DOCTYPE html>
+<html>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+{style_sheets}<link rel="stylesheet" href="{renderer_css}">
+<title>Executive Summary: {subject} {session}</title>
+<body>
+<script type="application/json" id="summary-data">{data}</script>
+<script src="{renderer_js}"></script>
+</body>
+</html>
+"""
+
+# The renderer lays out the same page as the HTML constants above, from the
+# data in the summary-data element. Clicks are handled in one place, by the
+# data-open, data-change, and data-close attributes of what was clicked.
+# Used after BRAINSPRITE_JS, in the same script.
+RENDERER_JS = """
+var summary = (function () {
+  "use strict";
+
+  var SIZES = {
+    row: "(min-width: 993px) 92vw, 100vw",
+    half: "(min-width: 993px) 38vw, (min-width: 601px) 50vw, 100vw",
+    quarter: "(min-width: 601px) 25vw, 100vw"
+  };
+  var ESCAPES = { "&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;" };
+
+  // The slides of each container, as [URL, name], and the image being
+  // shown; and the title of each kind of image.
+  var containers = {};
+  var titles = {};
+
+  function esc(text) {
+    return String(text).replace(/[&<>"]/g, function (c) { return ESCAPES[c]; });
+  }
+
+  function image(row, layout) {
+    if (!row.modal) {
+      return '<div class="w3-container w3-pale-red label3">Image Not Available</div>' +
+        '<div class="w3-container w3-pale-red label3"><br></div>';
+    }
+    var src = row.src || containers[row.modal].slides[row.idx - 1][0];
+    return '<img src="' + esc(src) + '" srcset="' + esc(row.srcset || src) +
+      '" sizes="' + SIZES[layout] + '" loading="lazy" data-open="' + esc(row.modal) +
+      '" data-idx="' + row.idx + '">';
+  }
+
+  function fullRow(row) {
+    return '<div class="w3-row-padding"><div class="w3-col l1 label2">' + esc(titles[row.key]) +
+      '</div><div class="w3-col l11">' + image(row, "row") + '</div></div>';
+  }
+
+  function halfRow(row) {
+    return '<div class="w3-row-padding"><div class="w3-col l2 label2">' + esc(titles[row.key]) +
+      '</div><div class="w3-col l9">' + image(row, "half") + '</div></div>';
+  }
+
+  function quarterRow(row) {
+    return '<div class="w3-quarter"><div class="w3-row w3-center label1">' +
+      esc(titles[row.key]) + '</div><div class="w3-row">' + image(row, "quarter") + '</div></div>';
+  }
+
+  function heading(text) {
+    return '<div class="w3-row-padding"><div class="w3-center"><h2>' + text +
+      '</h2></div></div>';
+  }
+
+  var SECTIONS = {
+    tx: function (section) {
+      var tx = esc(section.tx), label = "", viewer = "";
+      if (section.sprite) {
+        label = "<h6>BrainSprite Viewer: " + tx + "</h6>";
+        viewer = '<div class="w3-row w3-hide-small"><canvas id="' + tx +
+          '-viewer" style="max-width: 100%"><img id="' + tx +
+          '-spriteImg" class="hidden" src="' + esc(section.sprite) + '"></canvas></div>';
+      }
+      return '<section id="' + tx + '"><div class="w3-container">' +
+        '<div class="w3-cell w3-left label3">' + label + '</div>' +
+        '<div class="w3-cell w3-right"><button class="w3-btn w3-teal" data-open="' +
+        esc(section.slider) + '" data-idx="1">View ' + tx + ' pngs</button></div>' +
+        '</div><div class="w3-container">' + viewer + '</div></section>';
+    },
+    anat: function (section) {
+      return '<section id="Anat"><div class="w3-container">' +
+        heading("Anatomical Data") + section.rows.map(fullRow).join("") +
+        '<div class="w3-row-padding"><div class="w3-col l1 label2">' +
+        '<br>Combined Resting State Data</div>' + section.gray.map(quarterRow).join("") +
+        '</div></div></section>';
+    },
+    tasks: function (section) {
+      return '<section id="Tasks"><div class="w3-container">' +
+        heading("Functional Data") + section.tasks.map(function (task) {
+          return '<div class="w3-row"><div class="w3-left label2">task-' +
+            esc(task.name) + " run-" + esc(task.run) + ":</div></div>" +
+            task.regs.map(fullRow).join("") +
+            '<div class="w3-row-padding"><div class="w3-half">' +
+            task.bold.map(halfRow).join("") + "</div>" +
+            task.gray.map(quarterRow).join("") + "</div>";
+        }).join("") + "</div></section>";
+    }
+  };
+
+  function container(c) {
+    var name = esc(c.name), buttons = "";
+    if (c.slider) {
+      buttons = '<button class="w3-button w3-black w3-display-bottomleft w3-xxlarge" ' +
+        'data-change="' + name + '" data-step="-1"><i class="fas fa-angle-left"></i></button>' +
+        '<button class="w3-button w3-black w3-display-bottomright w3-xxlarge" ' +
+        'data-change="' + name + '" data-step="1"><i class="fas fa-angle-right"></i></button>';
+    }
+    return '<div id="' + esc(c.modal) + '" class="w3-modal"><div class="w3-modal-content">' +
+      '<div class="w3-content w3-display-container">' +
+      '<div class="w3-display-container ' + name + '" style="display: block">' +
+      '<img id="' + name + '-img" alt=""><div class="w3-display-topleft w3-black">' +
+      '<p id="' + name + '-name"></p></div></div>' + buttons +
+      '<button class="w3-btn w3-red w3-display-topright w3-large" data-close="' + name +
+      '"><i class="fa fa-close"></i></button></div></div></div>';
+  }
+
+  // Shows slide n (from 1) of a container, and starts fetching and decoding
+  // the slides on either side of it.
+  function show(name, n) {
+    var c = containers[name], x = c.slides;
+    if (x.length === 0) { return; }
+    c.idx = (((n - 1) % x.length) + x.length) % x.length + 1;
+    document.getElementById(name + "-img").src = x[c.idx - 1][0];
+    document.getElementById(name + "-name").textContent = x[c.idx - 1][1];
+    c.near = [-1, 1].map(function (step) {
+      var img = new Image();
+      img.src = x[(c.idx - 1 + step + x.length) % x.length][0];
+      if (img.decode) { img.decode().catch(function () {}); }
+      return img;
+    });
+  }
+
+  function open(name, idx) {
+    show(name, idx);
+    document.getElementById(containers[name].modal).style.display = "block";
+  }
+
+  function click(event) {
+    var el = event.target.closest("[data-open], [data-change], [data-close]");
+    if (!el) { return; }
+    if (el.dataset.open) {
+      open(el.dataset.open, Number(el.dataset.idx));
+    } else if (el.dataset.change) {
+      show(el.dataset.change, containers[el.dataset.change].idx + Number(el.dataset.step));
+    } else {
+      document.getElementById(containers[el.dataset.close].modal).style.display = "none";
+    }
+  }
+
+  function render(data) {
+    var html = ["<header> <h1>" + esc(data.title) + "</h1> </header>"];
+    titles = data.titles;
+    data.containers.forEach(function (c) {
+      var slides = c.slides.map(function (slide) {
+        return typeof slide === "string" ? [slide, slide.split("/").pop()] : slide;
+      });
+      containers[c.name] = { modal: c.modal, slides: slides, idx: 1, near: [] };
+    });
+    data.sections.forEach(function (section) {
+      html.push(SECTIONS[section.kind](section));
+    });
+    data.containers.forEach(function (c) {
+      html.push(container(c));
+    });
+    var page = document.createElement("div");
+    page.innerHTML = html.join("");
+    document.body.appendChild(page);
+    document.addEventListener("click", click);
+
+    window.addEventListener("load", function () {
+      data.sections.forEach(function (section) {
+        if (section.kind === "tx" && section.sprite) {
+          brainsprite({
+            canvas: section.tx + "-viewer",
+            sprite: section.tx + "-spriteImg",
+            nbSlice: { "Y": 218, "Z": 218 },
+            flagCoordinates: true
+          });
+        }
+      });
+    });
+  }
+
+  render(JSON.parse(document.getElementById("summary-data").textContent));
+
+  return { open: open, show: show };
+})();
 """
@@ -0,0 +1,420 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Makes compact copies of the images of the Executive Summary, in a pool of
+processes, and writes a report of the size and quality of each. The page
+then shows the compact copies instead of the images they were made from.
+
+Formats:
+    webp   PNGs and GIFs (including the animated registration GIFs) become
+           lossless WebP. JPEGs (the BrainSprite mosaics) become lossy WebP,
+           at WEBP_QUALITY; the report gives the PSNR of each.
+    png    PNGs are compressed again, as hard as they can be: with zopfli if
+           the zopfli package is installed, or with the best zlib setting of
+           PIL if not. GIFs are saved again with an optimized palette.
+           Nothing is lost. JPEGs are left as they are.
+
+Compact copies are kept in img/compact, and are only made again when the
+image is newer than its copy. A copy that would not be smaller than its
+image is not kept; the page shows the image. Copies whose image is gone are
+removed.
+
+The report is written to the directory of the HTML, as
+encoding_<format>.json.
+"""
+
+import argparse
+import io
+import json
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+import tracing
+from helpers import available_cpus
+
+COMPACT_DIR = "compact"
+FORMATS = ["webp", "png"]
+
+# Extensions of the images that are encoded, and of the copy, by format.
+EXTENSIONS = {
+    "webp": {".png": ".webp", ".gif": ".webp", ".jpg": ".webp", ".jpeg": ".webp"},
+    "png": {".png": ".png", ".gif": ".gif"},
+}
+
+WEBP_QUALITY = 90
+
+# Effort of the WebP encoder, from 0 (fast) to 6 (small), and, for lossless
+# WebP, how hard it tries (0 to 100). Going higher takes many times as long
+# for a few percent.
+WEBP_METHOD = 4
+WEBP_LOSSLESS_EFFORT = 80
+
+REPORT_NAME = "encoding_%s.json"
+
+
+def compact_path(image_file, fmt):
+    """
+    Gets the path of the compact copy of an image.
+
+    :parameter: image_file: path to the image.
+    :parameter: fmt: "webp" or "png".
+    :return: path to the copy, relative to the same directory as image_file,
+             or None if images like this one are not encoded in fmt.
+    """
+    dir_path, name = os.path.split(image_file)
+    stem, ext = os.path.splitext(name)
+    new_ext = EXTENSIONS[fmt].get(ext.lower())
+    if new_ext is None:
+        return None
+    return os.path.join(dir_path, COMPACT_DIR, stem + new_ext)
+
+
+def is_current(image_file, copy_file):
+    # The copy exists, and was made after the image was last changed.
+    return (
+        os.path.exists(copy_file)
+        and os.stat(copy_file).st_mtime_ns >= os.stat(image_file).st_mtime_ns
+    )
+
+
+def frames_of(img):
+    # The frames of an image, as RGB arrays.
+    frames = []
+    for frame in ImageSequence.Iterator(img):
+        frames.append(np.asarray(frame.convert("RGB"), dtype=np.float64))
+    return frames
+
+
+def psnr(image_file, copy_file):
+    """
+    Compares a copy with its image, frame by frame.
+
+    :parameter: image_file: path to the image.
+    :parameter: copy_file: path to the copy.
+    :return: PSNR in dB of the worst frame, or None if the copy is identical.
+    """
+    with Image.open(image_file) as img:
+        before = frames_of(img)
+    with Image.open(copy_file) as img:
+        after = frames_of(img)
+    if len(before) != len(after):
+        raise ValueError(
+            "%s has %d frames, not %d." % (copy_file, len(after), len(before))
+        )
+
+    worst = None
+    for frame_before, frame_after in zip(before, after):
+        mse = np.mean((frame_before - frame_after) ** 2)
+        if mse == 0:
+            continue
+        value = 10 * math.log10(255.0**2 / mse)
+        worst = value if worst is None else min(worst, value)
+    return worst
+
+
+def optimize_png(img, out_file):
+    # Compresses a PNG as hard as we can. zopfli is optional.
+    buf = io.BytesIO()
+    img.save(buf, "PNG", optimize=True)
+    try:
+        from zopfli.png import optimize
+    except ImportError:
+        data = buf.getvalue()
+    else:
+        data = optimize(buf.getvalue())
+    with open(out_file, "wb") as fd:
+        fd.write(data)
+
+
+def save_copy(image_file, out_file, fmt):
+    # Writes the compact copy of image_file to out_file. Returns whether
+    # anything may have been lost.
+    ext = os.path.splitext(image_file)[1].lower()
+    with Image.open(image_file) as img:
+        if fmt == "png":
+            if ext == ".gif":
+                frames = [frame.copy() for frame in ImageSequence.Iterator(img)]
+                frames[0].save(
+                    out_file,
+                    "GIF",
+                    save_all=len(frames) > 1,
+                    append_images=frames[1:],
+                    optimize=True,
+                    duration=img.info.get("duration", 100),
+                    loop=img.info.get("loop", 0),
+                )
+            else:
+                optimize_png(img, out_file)
+            return False
+
+        lossy = ext in [".jpg", ".jpeg"]
+        frames = []
+        for frame in ImageSequence.Iterator(img):
+            if frame.mode not in ["RGB", "RGBA"]:
+                frame = frame.convert("RGBA" if "transparency" in frame.info else "RGB")
+            frames.append(frame.copy())
+        frames[0].save(
+            out_file,
+            "WEBP",
+            save_all=len(frames) > 1,
+            append_images=frames[1:],
+            lossless=not lossy,
+            quality=WEBP_QUALITY if lossy else WEBP_LOSSLESS_EFFORT,
+            method=WEBP_METHOD,
+            duration=img.info.get("duration", 100),
+            loop=img.info.get("loop", 0),
+        )
+        return lossy
+
+
+def encode_image(image_file, copy_file, fmt):
+    """
+    Makes the compact copy of an image. The copy is written to a temporary
+    file, and only renamed into place if it is smaller than the image. Runs
+    in a worker process.
+
+    :parameter: image_file: path to the image.
+    :parameter: copy_file: path to which to write the copy.
+    :parameter: fmt: "webp" or "png".
+    :return: dictionary for the report.
+    """
+    dir_path, name = os.path.split(copy_file)
+    os.makedirs(dir_path, exist_ok=True)
+    tmp_file = os.path.join(dir_path, ".tmp_%d_%s" % (os.getpid(), name))
+
+    start = time.time()
+    try:
+        lossy = save_copy(image_file, tmp_file, fmt)
+        before = os.path.getsize(image_file)
+        after = os.path.getsize(tmp_file)
+        entry = {
+            "image": os.path.basename(image_file),
+            "mtime_ns": os.stat(image_file).st_mtime_ns,
+            "bytes": before,
+            "lossless": not lossy,
+            "seconds": round(time.time() - start, 3),
+        }
+        if after < before:
+            entry["psnr"] = psnr(image_file, tmp_file) if lossy else None
+            os.replace(tmp_file, copy_file)
+            entry["copy"] = os.path.join(COMPACT_DIR, name)
+            entry["copy_bytes"] = after
+        else:
+            # Not worth it; the page shows the image.
+            if os.path.exists(copy_file):
+                os.remove(copy_file)
+            entry["copy"] = None
+            entry["copy_bytes"] = before
+        return entry
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+class CompactImages(object):
+    # Tells the layout which file to show for each image: its compact copy,
+    # if there is one that is up to date, or else the image.
+    #
+    # Image paths are relative to base_dir (the directory of the HTML), as
+    # they are in the page.
+    #
+    def __init__(self, base_dir, fmt):
+
+        self.base_dir = base_dir
+        self.fmt = fmt
+
+    def find(self, image_file):
+        copy_file = compact_path(image_file, self.fmt)
+        if copy_file is None:
+            return image_file
+        if is_current(
+            os.path.join(self.base_dir, image_file),
+            os.path.join(self.base_dir, copy_file),
+        ):
+            return copy_file
+        return image_file
+
+
+def remove_stale(images_path):
+    """
+    Removes the compact copies whose image is no longer in images_path.
+    Copies that are already gone (removed by another process) are ignored.
+
+    :parameter: images_path: path to the img directory.
+    :return: list of the paths removed.
+    """
+    compact_dir = os.path.join(images_path, COMPACT_DIR)
+    if not os.path.isdir(compact_dir):
+        return []
+    stems = set(
+        os.path.splitext(name)[0]
+        for name in os.listdir(images_path)
+        if os.path.isfile(os.path.join(images_path, name))
+    )
+    removed = []
+    for name in sorted(os.listdir(compact_dir)):
+        # Temporary files are those of copies being made.
+        if name.startswith(".") or os.path.splitext(name)[0] in stems:
+            continue
+        old_path = os.path.join(compact_dir, name)
+        try:
+            os.remove(old_path)
+        except OSError:
+            continue
+        removed.append(old_path)
+    return removed
+
+
+def load_report(report_path):
+    # The entries of a prior report, by image.
+    try:
+        with open(report_path) as fd:
+            return dict((entry["image"], entry) for entry in json.load(fd)["images"])
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+@tracing.traced("encode_images", "encode")
+def encode_images(images_path, report_path, fmt="webp", workers=None):
+    """
+    Makes compact copies of the images in images_path, and writes the
+    report. Images that have not changed since the prior report are not
+    encoded again; their entries are taken from it.
+
+    :parameter: images_path: path to the img directory.
+    :parameter: report_path: path to which to write the report (JSON).
+    :parameter: fmt: "webp" or "png".
+    :parameter: workers: size of the pool. Default is the number of CPUs
+                available to this process.
+    :return: the report, as a dictionary.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unknown format: %s" % fmt)
+    if workers is None:
+        workers = available_cpus()
+
+    remove_stale(images_path)
+
+    prior = load_report(report_path)
+    entries = []
+    todo = []
+    for name in sorted(os.listdir(images_path)):
+        image_file = os.path.join(images_path, name)
+        if name.startswith(".") or not os.path.isfile(image_file):
+            continue
+        copy_name = compact_path(name, fmt)
+        if copy_name is None:
+            continue
+        copy_file = os.path.join(images_path, copy_name)
+        entry = prior.get(name)
+        if (
+            entry is not None
+            and entry.get("mtime_ns") == os.stat(image_file).st_mtime_ns
+            and (entry["copy"] is None or is_current(image_file, copy_file))
+        ):
+            entries.append(entry)
+        else:
+            todo.append((image_file, copy_file))
+
+    # Worker processes of batch.py may not start processes of their own;
+    # PIL lets go of the GIL while encoding, so threads do nearly as well.
+    if multiprocessing.current_process().daemon:
+        pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    else:
+        pool = ProcessPoolExecutor(max_workers=max(1, workers))
+    with pool:
+        futures = [
+            (image_file, pool.submit(encode_image, image_file, copy_file, fmt))
+            for image_file, copy_file in todo
+        ]
+        for image_file, future in futures:
+            try:
+                entries.append(future.result())
+            except (OSError, ValueError) as err:
+                print("Unable to encode %s: %s" % (image_file, err))
+
+    entries.sort(key=lambda entry: entry["image"])
+    total_before = sum(entry["bytes"] for entry in entries)
+    total_after = sum(entry["copy_bytes"] for entry in entries)
+    lossy = [entry["psnr"] for entry in entries if entry.get("psnr") is not None]
+    report = {
+        "format": fmt,
+        "encoded": len(todo),
+        "bytes": total_before,
+        "copy_bytes": total_after,
+        "ratio": round(total_after / float(total_before), 4) if total_before else None,
+        "min_psnr": round(min(lossy), 2) if lossy else None,
+        "images": entries,
+    }
+
+    tmp_path = "%s.%d.tmp" % (report_path, os.getpid())
+    with open(tmp_path, "w") as fd:
+        json.dump(report, fd, indent=1)
+    os.replace(tmp_path, report_path)
+
+    print(
+        "Encoded %d of %d images as %s: %.1f MB -> %.1f MB%s"
+        % (
+            len(todo),
+            len(entries),
+            fmt,
+            total_before / 1e6,
+            total_after / 1e6,
+            "" if not lossy else ", lowest PSNR %.1f dB" % min(lossy),
+        )
+    )
+    return report
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+        prog="encode",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "html_path",
+        metavar="HTML_PATH",
+        help="path to the executivesummary directory, which holds img.",
+    )
+    parser.add_argument(
+        "--format",
+        dest="fmt",
+        choices=FORMATS,
+        default="webp",
+        help="Optional. Format of the compact copies. Default: webp.",
+    )
+    parser.add_argument(
+        "--nprocs",
+        "-n",
+        dest="nprocs",
+        type=int,
+        metavar="NPROCS",
+        help="Optional. Number of processes. Default is the number of CPUs.",
+    )
+
+    return parser
+
+
+def _cli():
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    encode_images(
+        os.path.join(args.html_path, "img"),
+        os.path.join(args.html_path, REPORT_NAME % args.fmt),
+        args.fmt,
+        args.nprocs,
+    )
+
+
+if __name__ == "__main__":
+
+    _cli()
@@ -1,27 +1,52 @@
+import fnmatch
 import glob
+import math
 import os
+import re
 import shutil
 from os import path
 
 
-def find_files(seek_dir, pattern):
+def glob_files(seek_dir, pattern, scan_cache=None):
+    """
+    Finds the entries of seek_dir that match the glob-style pattern. Uses
+    the listing in scan_cache, if given, instead of listing the directory.
+
+    :parameter: seek_dir: directory to be searched.
+    :parameter: pattern: Unix shell pattern for finding files.
+    :parameter: scan_cache: optional ScanCache.
+    :return: list of paths (may be empty).
+    """
+    if scan_cache is None:
+        return glob.glob(os.path.join(seek_dir, pattern))
+
+    try:
+        names = scan_cache.listdir(seek_dir)
+    except OSError:
+        return []
+    # Like glob, leave out hidden files.
+    names = [name for name in names if not name.startswith(".")]
+    return [os.path.join(seek_dir, name) for name in fnmatch.filter(names, pattern)]
+
+
+def find_files(seek_dir, pattern, scan_cache=None):
     """
     Finds all files within the directory specified that match
     the glob-style pattern.
 
     :parameter: seek_dir: directory to be searched.
     :parameter: pattern: Unix shell pattern for finding files.
+    :parameter: scan_cache: optional ScanCache.
     :return: list of relative paths of copied files (may be empty).
     """
     paths = []
-    glob_pattern = os.path.join(seek_dir, pattern)
-    for found_file in glob.glob(glob_pattern):
+    for found_file in glob_files(seek_dir, pattern, scan_cache):
         paths.append(found_file)
 
     return paths
 
 
-def find_and_copy_files(seek_dir, pattern, output_dir):
+def find_and_copy_files(seek_dir, pattern, output_dir, scan_cache=None):
     """
     Finds all files within the directory specified that match
     the glob-style pattern. Copies each file to the output
@@ -30,22 +55,29 @@ def find_and_copy_files(seek_dir, pattern, output_dir):
     :parameter: seek_dir: directory to be searched.
     :parameter: pattern: Unix shell pattern for finding files.
     :parameter: output_dir: directory to which to copy files.
+    :parameter: scan_cache: optional ScanCache.
     :return: list of relative paths of copied files (may be empty).
     """
     rel_paths = []
 
-    glob_pattern = os.path.join(seek_dir, pattern)
-    for found_file in glob.glob(glob_pattern):
+    for found_file in glob_files(seek_dir, pattern, scan_cache):
         # TODO: change name to BIDS name?
         filename = os.path.basename(found_file)
         rel_path = os.path.relpath(os.path.join(output_dir, filename), os.getcwd())
-        shutil.copy(found_file, rel_path)
+        # Keep the time of the file, so that copies (and their thumbnails)
+        # are only made again when the file has changed.
+        src = os.stat(found_file)
+        if not os.path.exists(rel_path) or (
+            os.stat(rel_path).st_size,
+            os.stat(rel_path).st_mtime_ns,
+        ) != (src.st_size, src.st_mtime_ns):
+            shutil.copy2(found_file, rel_path)
         rel_paths.append(rel_path)
 
     return rel_paths
 
 
-def find_and_copy_file(seek_dir, pattern, output_dir):
+def find_and_copy_file(seek_dir, pattern, output_dir, scan_cache=None):
     """
     Finds a single file within seek_dir, using the pattern.
     If found, copies the file to the output_dir.
@@ -53,10 +85,11 @@ def find_and_copy_file(seek_dir, pattern, output_dir):
     :parameter: seek_dir: directory to be searched.
     :parameter: pattern: Unix shell pattern for finding files.
     :parameter: output_dir: directory to which to copy the file.
+    :parameter: scan_cache: optional ScanCache.
     :return: relative path to copied file, or None.
     """
 
-    found_path = find_one_file(seek_dir, pattern)
+    found_path = find_one_file(seek_dir, pattern, scan_cache)
 
     if found_path:
         # TODO: change name to BIDS name?
@@ -70,13 +103,13 @@ def find_and_copy_file(seek_dir, pattern, output_dir):
         return None
 
 
-def find_one_file(seek_dir, pattern):
+def find_one_file(seek_dir, pattern, scan_cache=None):
 
     one_file = None
 
     # Try to find a file with the pattern given in the directory given.
     glob_pattern = path.join(seek_dir, pattern)
-    filelist = glob.glob(glob_pattern)
+    filelist = glob_files(seek_dir, pattern, scan_cache)
 
     # Make sure we got exactly one file.
     numfiles = len(filelist)
@@ -87,3 +120,168 @@ def find_one_file(seek_dir, pattern):
         print("info: Found %s files with pattern: %s" % (numfiles, glob_pattern))
 
     return one_file
+
+
+# Gets the task name and (optional) run number from a file name, the same way
+# the names of the task directories are read: the word after 'task-', then
+# all of the digits that follow, if any.
+TASK_RUN_RE = re.compile(r"task-([^_\d]+)(?:\D*(\d+))?")
+
+
+def task_and_run(name):
+    """
+    Gets the task name and run number from the name of a file or directory.
+
+    :parameter: name: file name, e.g., sub-01_task-rest_run-01_bold.png.
+    :return: (task, run) tuple; run is an int, or None if there are no digits
+             after the task name. None if there is no task in the name.
+    """
+    match = TASK_RUN_RE.search(name)
+    if match is None:
+        return None
+    task, run = match.group(1, 2)
+    if run is not None:
+        run = int(run)
+    return task, run
+
+
+class ImageIndex(object):
+    # Classifies all of the files in a directory of images, in one pass, by
+    # the kinds of image in constants.IMAGE_INFO.
+    #
+    # The directory is listed only once (or not at all, if the listing in
+    # the scan cache is still good). Each pattern in IMAGE_INFO is
+    # compiled to a regular expression; a pattern with %s (a task pattern)
+    # is compiled with a wildcard in its place. Every file that matches the
+    # pattern of a kind is put into the buckets of that kind: for task
+    # patterns, one bucket per (task, run) and one per task.
+    #
+    # Lookups then return the single file in a bucket, just as find_one_file
+    # does for a glob, without touching the disk.
+    #
+    def __init__(self, img_path, image_info, scan_cache=None):
+
+        self.img_path = img_path
+
+        if scan_cache is None:
+            names = os.listdir(img_path)
+        else:
+            names = scan_cache.listdir(img_path)
+
+        # Like glob, leave out hidden files.
+        self.names = sorted(name for name in names if not name.startswith("."))
+
+        self.buckets = {}
+        for kind, values in image_info.items():
+            pattern = values["pattern"]
+            is_task = "%s" in pattern
+            if is_task:
+                pattern = pattern % "*"
+            matcher = re.compile(fnmatch.translate(pattern))
+
+            for name in self.names:
+                if not matcher.match(name):
+                    continue
+                if not is_task:
+                    self.add(kind, name)
+                    continue
+                found = task_and_run(name)
+                if found is None:
+                    continue
+                task, run = found
+                self.add((kind, task), name)
+                if run is not None:
+                    self.add((kind, task, run), name)
+
+    def add(self, key, name):
+        self.buckets.setdefault(key, []).append(os.path.join(self.img_path, name))
+
+    def find_one(self, kind, task=None, run=None):
+        """
+        Finds the single image of a kind (and, for task images, of the task
+        and run).
+
+        :parameter: kind: key of constants.IMAGE_INFO.
+        :parameter: task: name of the task, for task images.
+        :parameter: run: run number, for task images. If None, any image of
+                    the task is a match.
+        :return: path to the image, or None if there is not exactly one.
+        """
+        if task is None:
+            key = kind
+        elif run is None:
+            key = (kind, task)
+        else:
+            key = (kind, task, int(run))
+
+        filelist = self.buckets.get(key, [])
+        numfiles = len(filelist)
+        if numfiles == 1:
+            return filelist[0]
+
+        # TODO: Log info in errorfile.
+        print("info: Found %s files of kind %s in: %s" % (numfiles, key, self.img_path))
+        return None
+
+    def find(self, pattern):
+        """
+        Finds all files in the directory that match the glob-style pattern,
+        without listing the directory again.
+
+        :parameter: pattern: Unix shell pattern for finding files.
+        :return: list of paths of the files (may be empty).
+        """
+        return [
+            os.path.join(self.img_path, name)
+            for name in fnmatch.filter(self.names, pattern)
+        ]
+
+
+def cgroup_cpu_limit():
+    """
+    Reads the CPU quota of the cgroup this process runs in (cgroup v2, then
+    cgroup v1).
+
+    :return: number of CPUs allowed by the quota, or None if there is no quota.
+    """
+    quota = period = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as fd:
+            fields = fd.read().split()
+        if fields and fields[0] != "max":
+            quota, period = int(fields[0]), int(fields[1])
+    except (OSError, ValueError, IndexError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as fd:
+                quota = int(fd.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as fd:
+                period = int(fd.read())
+        except (OSError, ValueError):
+            pass
+
+    if quota is None or period is None or quota <= 0 or period <= 0:
+        return None
+    return max(1, int(math.ceil(quota / period)))
+
+
+def available_cpus():
+    """
+    Finds the number of CPUs this process may use: the smallest of the CPU
+    affinity mask, the cgroup CPU quota, and the SLURM allocation.
+
+    :return: number of CPUs (at least 1).
+    """
+    try:
+        counts = [len(os.sched_getaffinity(0))]
+    except AttributeError:
+        counts = [os.cpu_count() or 1]
+
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        counts.append(limit)
+
+    slurm_cpus = os.environ.get("SLURM_CPUS_PER_TASK")
+    if slurm_cpus is not None and slurm_cpus.isdigit():
+        counts.append(int(slurm_cpus))
+
+    return max(1, min(counts))
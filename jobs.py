@@ -0,0 +1,255 @@
+__doc__ = """
+Runs a graph of jobs. Each job declares the files it reads (inputs) and the
+files it makes (outputs); a job that reads a file made by another job runs
+after that job. Jobs that do not depend on each other run at the same time,
+on a pool of threads.
+
+A job is not run when the manifest says its outputs were made from the same,
+unchanged, inputs, and none of the jobs it depends on had to run. When a job
+fails, the jobs that depend on it are skipped, but all other jobs still run.
+"""
+
+import os
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import tools
+import tracing
+from helpers import available_cpus
+
+# Status of each job after the graph has been run.
+DONE = "done"
+CURRENT = "up to date"
+FAILED = "FAILED"
+SKIPPED = "skipped"
+
+
+class MissingInputError(IOError):
+    # An input of a job does not exist, and no job makes it.
+    pass
+
+
+def log(message):
+    # Print whole lines, even when many jobs (and the tools they run) print
+    # at once.
+    tools.log(message)
+
+
+class Job(object):
+    # A unit of work: a function and its arguments, with the files it reads
+    # and makes.
+    #
+    # By default, whether the outputs are up to date is decided by the
+    # manifest. A job with use_manifest=False is up to date when all of its
+    # outputs exist; use it for outputs whose names already say what they
+    # were made from.
+    #
+    # Jobs are named. Jobs must be named uniquely within a graph, as the
+    # name is used to refer to the job in messages and in after=[...].
+    #
+    def __init__(
+        self,
+        name,
+        func,
+        args=(),
+        kwargs=None,
+        inputs=(),
+        outputs=(),
+        after=(),
+        use_manifest=True,
+    ):
+
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+        # Each input once, in order; the same file may be passed twice.
+        self.inputs = list(OrderedDict.fromkeys(i for i in inputs if i is not None))
+        self.outputs = list(outputs)
+        self.after = list(after)
+        self.use_manifest = use_manifest
+
+    def is_current(self, manifest):
+        if not self.outputs:
+            return False
+        if not self.use_manifest:
+            return all(os.path.exists(output) for output in self.outputs)
+        if manifest is None:
+            return False
+        return all(manifest.is_current(output, self.inputs) for output in self.outputs)
+
+    def run(self):
+        missing = [i for i in self.inputs if not os.path.exists(i)]
+        if missing:
+            raise MissingInputError("Missing input(s): %s" % ", ".join(missing))
+        self.func(*self.args, **self.kwargs)
+
+
+class JobGraph(object):
+    # The jobs, in the order they were added, and the job that makes each
+    # output. Jobs are run in the order they were added, as far as their
+    # dependencies allow.
+    #
+    def __init__(self):
+
+        self.jobs = OrderedDict()
+        self.producers = {}
+
+    def add(self, job):
+        """
+        Adds a job to the graph. If there is already a job with the same
+        name, the job is not added again (e.g., a volume resampled onto a
+        grid shared by many runs).
+
+        :parameter: job: Job.
+        :return: the job in the graph with that name.
+        """
+        if job.name in self.jobs:
+            return self.jobs[job.name]
+
+        for output in job.outputs:
+            output = os.path.abspath(output)
+            if output in self.producers:
+                raise ValueError(
+                    "%s is made by both %s and %s."
+                    % (output, self.producers[output], job.name)
+                )
+            self.producers[output] = job.name
+
+        self.jobs[job.name] = job
+        return job
+
+    def dependencies(self, job):
+        # Jobs that make the inputs of job, and the jobs it must come after.
+        deps = set(job.after)
+        for input_path in job.inputs:
+            producer = self.producers.get(os.path.abspath(input_path))
+            if producer is not None and producer != job.name:
+                deps.add(producer)
+        return deps
+
+    def validate(self):
+        """
+        Makes sure every job named in after=[...] is in the graph, and that
+        there are no cycles.
+
+        :return: dictionary of the dependencies of each job.
+        """
+        deps = {}
+        for name, job in self.jobs.items():
+            deps[name] = self.dependencies(job)
+            unknown = [dep for dep in deps[name] if dep not in self.jobs]
+            if unknown:
+                raise ValueError(
+                    "%s must run after unknown job(s): %s" % (name, unknown)
+                )
+
+        # Take away jobs with no unmet dependencies until there are none left.
+        # Anything left over is in a cycle.
+        remaining = dict((name, set(dep)) for name, dep in deps.items())
+        while remaining:
+            ready = [name for name, dep in remaining.items() if not dep]
+            if not ready:
+                raise ValueError("Jobs depend on each other: %s" % sorted(remaining))
+            for name in ready:
+                del remaining[name]
+            for dep in remaining.values():
+                dep.difference_update(ready)
+
+        return deps
+
+    def run(self, workers=None, manifest=None):
+        """
+        Runs the jobs, with at most workers jobs running at once.
+
+        :parameter: workers: size of the pool. Default is the number of CPUs
+                    available to this process.
+        :parameter: manifest: optional Manifest; jobs whose outputs are up to
+                    date are not run, and the inputs of the outputs of jobs
+                    that are run are recorded.
+        :return: dictionary of the status of each job.
+        """
+        if workers is None:
+            workers = available_cpus()
+        workers = max(1, workers)
+
+        deps = self.validate()
+        dependents = dict((name, []) for name in self.jobs)
+        for name, dep in deps.items():
+            for dep_name in dep:
+                dependents[dep_name].append(name)
+
+        status = {}
+        waiting = dict((name, set(dep)) for name, dep in deps.items())
+        ready = [name for name in self.jobs if not waiting[name]]
+
+        def finish(name, result):
+            # Record the status of a job, and find the jobs that can now run.
+            status[name] = result
+            for dependent in dependents[name]:
+                if dependent in status:
+                    continue
+                if result in [FAILED, SKIPPED]:
+                    log(
+                        "[job] %s: skipped, as %s did not complete." % (dependent, name)
+                    )
+                    finish(dependent, SKIPPED)
+                    continue
+                waiting[dependent].discard(name)
+                if not waiting[dependent]:
+                    ready.append(dependent)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            running = {}
+            while ready or running:
+                while ready:
+                    name = ready.pop(0)
+                    # When anything it depends on was made again, so must this.
+                    force = any(status[dep] == DONE for dep in deps[name])
+                    future = pool.submit(self.run_job, self.jobs[name], manifest, force)
+                    running[future] = name
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    finish(running.pop(future), future.result())
+
+        failed = [
+            name
+            for name, result in status.items()
+            if result != DONE and result != CURRENT
+        ]
+        log(
+            "[job] %d jobs: %d done, %d up to date, %d failed or skipped."
+            % (
+                len(status),
+                list(status.values()).count(DONE),
+                list(status.values()).count(CURRENT),
+                len(failed),
+            )
+        )
+        return status
+
+    def run_job(self, job, manifest, force):
+        # Runs in a worker thread. Never raises; returns the status.
+        if not force and job.is_current(manifest):
+            return CURRENT
+
+        start = time.time()
+        try:
+            with tracing.span(job.name, "job"):
+                job.run()
+        except MissingInputError as err:
+            log("[job] %s: FAILED: %s" % (job.name, err))
+            return FAILED
+        except Exception as err:
+            log("[job] %s: FAILED: %s: %s" % (job.name, type(err).__name__, err))
+            log(traceback.format_exc().rstrip())
+            return FAILED
+
+        if manifest is not None and job.use_manifest:
+            for output in job.outputs:
+                manifest.record(output, job.inputs)
+        log("[job] %s: done in %.1fs" % (job.name, time.time() - start))
+        return DONE
@@ -7,12 +7,20 @@ the DCAN-Labs fMRI pipelines.
 
 __version__ = "2.0.0"
 
+import json
 import os
 import re
-import stat
 
+import assets
 import constants
-from helpers import find_and_copy_files, find_files, find_one_file
+import tracing
+from encode import REPORT_NAME, CompactImages, encode_images
+from helpers import ImageIndex, find_and_copy_files
+from scan_cache import SCAN_CACHE_NAME, ScanCache
+from thumbnails import Thumbnailer
+
+# Directory, next to the HTML, of the renderer of data pages.
+STATIC_DIR = "static"
 
 
 class ModalContainer(object):
@@ -33,17 +41,31 @@ class ModalContainer(object):
     # buttons or clickable images or whatever, can display the
     # correct container.
     #
-    def __init__(self, modal_id, image_class):
+    # The container holds a single image. The images added to it
+    # are kept as slides, a URL and a name each, which the scripts
+    # show one at a time; so the page does not hold (or load) an
+    # element for every image.
+    #
+    # If given CompactImages, the container shows the compact copy
+    # of each image, when there is one.
+    #
+    def __init__(self, modal_id, image_class, compact=None):
 
         self.modal_id = modal_id
-        self.modal_container = constants.MODAL_START.format(modal_id=self.modal_id)
+        self.modal_container = [
+            constants.MODAL_START.format(modal_id=self.modal_id),
+            constants.SLIDE_VIEWER.format(image_class=image_class),
+        ]
         self.button = ""
+        self.slides = []
 
         self.image_class = image_class
         self.image_class_idx = 0
 
         self.scripts = ""
 
+        self.compact = compact
+
         self.state = "open"
 
     def get_modal_id(self):
@@ -65,10 +87,10 @@ class ModalContainer(object):
         self.state = "closed"
 
         # Close up the elements.
-        self.modal_container += constants.MODAL_END.format(modal_id=self.modal_id)
+        self.modal_container.append(constants.MODAL_END.format(modal_id=self.modal_id))
 
         # Return the HTML.
-        return self.modal_container
+        return "".join(self.modal_container)
 
     def get_scripts(self):
         # The containter needs the scripts to show the correct
@@ -76,10 +98,15 @@ class ModalContainer(object):
         self.scripts += constants.MODAL_SCRIPTS % {
             "modal_id": self.modal_id,
             "image_class": self.image_class,
+            "slides": self.get_slides(),
         }
 
         return self.scripts
 
+    def get_slides(self):
+        # The slides as JSON, safe to put in a script element.
+        return json.dumps(self.slides).replace("</", "<\\/")
+
     def add_images(self, image_list):
         # Add each image in the list to the slider.
         for image_file in image_list:
@@ -97,14 +124,11 @@ class ModalContainer(object):
         # Will display the name of the file on the image,
         # so get the filename by itself.
         display_name = os.path.basename(image_file)
+        if self.compact is not None:
+            image_file = self.compact.find(image_file)
 
-        # Add the image to container, and assign the class.
-        self.modal_container += constants.IMAGE_WITH_CLASS.format(
-            modal_id=self.modal_id,
-            image_class=self.image_class,
-            image_file=image_file,
-            display_name=display_name,
-        )
+        # Add the image to the slides of the container.
+        self.slides.append([image_file, display_name])
 
         self.image_class_idx += 1
         return self.image_class_idx
@@ -123,39 +147,93 @@ class ModalSlider(ModalContainer):
     # The image class must be unique to this slider so that
     # the scripts can find the images used by the slider.
     #
-    def __init__(self, modal_id, image_class):
-        ModalContainer.__init__(self, modal_id, image_class)
+    def __init__(self, modal_id, image_class, compact=None):
+        ModalContainer.__init__(self, modal_id, image_class, compact)
 
     def get_container(self):
         # Must add buttons after all images have been added.
         self.state = "closed"
 
         # Add the buttons and close up the elements.
-        self.modal_container += constants.SLIDER_END.format(image_class=self.image_class)
-        self.modal_container += constants.MODAL_END.format(modal_id=self.modal_id)
+        self.modal_container.append(
+            constants.SLIDER_END.format(image_class=self.image_class)
+        )
+        self.modal_container.append(constants.MODAL_END.format(modal_id=self.modal_id))
         # Return the HTML.
-        return self.modal_container
+        return "".join(self.modal_container)
 
     def get_scripts(self):
         # The slider needs the scripts to go along with the
         # right and left buttons.
-        self.scripts += constants.SLIDER_SCRIPTS % {
-            "modal_id": self.modal_id,
-            "image_class": self.image_class,
-        }
+        ModalContainer.get_scripts(self)
+        self.scripts += constants.SLIDER_SCRIPTS % {"image_class": self.image_class}
         return self.scripts
 
 
 class Section(object):
-    def __init__(self, img_path="./img", regs_slider=None, img_modal=None, **kwargs):
-        self.section = ""
+    def __init__(
+        self,
+        img_path="./img",
+        regs_slider=None,
+        img_modal=None,
+        image_index=None,
+        out=None,
+        thumbnails=None,
+        compact=None,
+        **kwargs
+    ):
+        # The HTML of the section is kept as a list of fragments, and joined
+        # once, when the section is complete.
+        self.section = []
         self.scripts = ""
+
+        # If given an HtmlWriter, the section writes its HTML out as soon as
+        # each part is complete, instead of keeping it until get_section.
+        self.out = out
         self.img_path = img_path
         self.regs_slider = regs_slider
         self.img_modal = img_modal
 
+        # All sections find their images in the same index, so that the
+        # directory of images is only listed once.
+        if image_index is None:
+            image_index = ImageIndex(img_path, constants.IMAGE_INFO)
+        self.image_index = image_index
+
+        # If given a Thumbnailer, rows show thumbnails of their images.
+        self.thumbnails = thumbnails
+
+        # If given CompactImages, images are shown by their compact copies.
+        self.compact = compact
+
     def get_section(self):
-        return self.section
+        return "".join(self.section)
+
+    def compact_file(self, img_file):
+        # The file to show for an image.
+        if self.compact is None:
+            return img_file
+        return self.compact.find(img_file)
+
+    def set_row_image(self, row_data, img_file):
+        # The image of a row, and the thumbnails the browser may pick from.
+        # Thumbnails are made from the image, not from its compact copy.
+        if self.thumbnails is None:
+            row_data["row_img"] = row_data["row_srcset"] = self.compact_file(img_file)
+        else:
+            row_data["row_img"], row_data["row_srcset"] = self.thumbnails.srcset(
+                img_file
+            )
+            if row_data["row_img"] == img_file:
+                row_data["row_img"] = row_data["row_srcset"] = self.compact_file(
+                    img_file
+                )
+
+    def flush(self):
+        # Write out the HTML so far, if streaming.
+        if self.out is not None:
+            self.out.write(self.section)
+            self.section = []
 
     def get_scripts(self):
         return self.scripts
@@ -198,7 +276,7 @@ class TxSection(Section):
             spriteviewer += constants.SPRITE_VIEWER_HTML.format(
                 viewer=viewer,
                 spriteImg=spriteImg,
-                mosaic_path=mosaic_path,
+                mosaic_path=self.compact_file(mosaic_path),
                 width="100%",
             )
 
@@ -221,7 +299,7 @@ class TxSection(Section):
         # The pngs for the slider are already in the img_path. Get the pngs that start
         # with 'tx' so users can view the higher resolution pngs.
         pngs_glob = "*_" + self.tx + "-*.png"
-        pngs_list = sorted(find_files(self.img_path, pngs_glob))
+        pngs_list = sorted(self.image_index.find(pngs_glob))
 
         # Just a sanity check, since we happen to know how many to expect.
         if len(pngs_list) != 9:
@@ -230,28 +308,31 @@ class TxSection(Section):
             )  # TODO: log WARNING
 
         # Make a modal container with a slider and add the pngs.
-        pngs_slider = ModalSlider(self.modal_id, self.image_class)
+        pngs_slider = ModalSlider(self.modal_id, self.image_class, self.compact)
         pngs_slider.add_images(pngs_list)
 
         # Add HTML for the bar with the brainsprite label and pngs button,
         # and for the brainsprite viewer.
         btn_label = "View %s pngs" % self.tx
-        self.section += constants.TX_SECTION.format(
-            tx=self.tx,
-            brainsprite_label=brainsprite_label,
-            pngs_button=pngs_slider.get_button(btn_label),
-            brainsprite_viewer=brainsprite_viewer,
+        self.section.append(
+            constants.TX_SECTION.format(
+                tx=self.tx,
+                brainsprite_label=brainsprite_label,
+                pngs_button=pngs_slider.get_button(btn_label),
+                brainsprite_viewer=brainsprite_viewer,
+            )
         )
 
         # HTML for the modal container should be tacked on the end.
-        self.section += pngs_slider.get_container()
+        self.section.append(pngs_slider.get_container())
+        self.flush()
 
         self.scripts = brainsprite_loader + pngs_slider.get_scripts()
 
 
 class AnatSection(Section):
     def __init__(self, img_path="./img", **kwargs):
-        Section.__init__(self, **kwargs)
+        Section.__init__(self, img_path=img_path, **kwargs)
 
         self.img_path = img_path
 
@@ -263,58 +344,55 @@ class AnatSection(Section):
         row_data["row_modal"] = self.regs_slider.get_modal_id()
 
         # Add a row for each atlas-registered image.
-        for key in [
-            "atlas_in_t1",
-            "t1_in_atlas",
-            "atlas_in_subcort",
-            "subcort_in_atlas",
-        ]:
+        for key in constants.ATLAS_ROW_KEYS:
             values = constants.IMAGE_INFO[key]
-            pattern = values["pattern"]
-            img_file = find_one_file(self.img_path, pattern)
+            img_file = self.image_index.find_one(key)
             if img_file is not None:
                 # Add image to data and to slider.
                 row_data["row_label"] = values["title"]
-                row_data["row_img"] = img_file
+                self.set_row_image(row_data, img_file)
                 row_data["row_idx"] = self.regs_slider.add_image(img_file)
-                self.section += constants.LAYOUT_ROW.format(**row_data)
+                self.section.append(constants.LAYOUT_ROW.format(**row_data))
             else:
-                self.section += constants.PLACEHOLDER_ROW.format(row_label=values["title"])
+                self.section.append(
+                    constants.PLACEHOLDER_ROW.format(row_label=values["title"])
+                )
 
     def write_gray_row(self):
-        self.section += constants.GRAY_ROW_START
+        self.section.append(constants.GRAY_ROW_START)
 
         # Get gray-ordinates plots.
         gray_data = {}
         gray_data["row_modal"] = self.img_modal.get_modal_id()
 
-        for key in ["concat_pre_reg_gray", "concat_post_reg_gray"]:
+        for key in constants.CONCAT_GRAY_KEYS:
             values = constants.IMAGE_INFO[key]
-            img_file = find_one_file(self.img_path, values["pattern"])
+            img_file = self.image_index.find_one(key)
             if img_file is not None:
                 # Add image to data, and to the 'generic' images container.
                 gray_data["row_label"] = values["title"]
-                gray_data["row_img"] = img_file
+                self.set_row_image(gray_data, img_file)
                 gray_data["row_idx"] = self.img_modal.add_image(img_file)
-                self.section += constants.LAYOUT_QUARTER_ROW.format(**gray_data)
+                self.section.append(constants.LAYOUT_QUARTER_ROW.format(**gray_data))
             else:
-                self.section += constants.PLACEHOLDER_QUARTER_ROW.format(
-                    row_label=values["title"]
+                self.section.append(
+                    constants.PLACEHOLDER_QUARTER_ROW.format(row_label=values["title"])
                 )
 
-        self.section += constants.GRAY_ROW_END
+        self.section.append(constants.GRAY_ROW_END)
 
     def run(self):
         # Write the HTML for the section.
-        self.section += constants.ANAT_SECTION_START
+        self.section.append(constants.ANAT_SECTION_START)
         self.write_atlas_rows()
         self.write_gray_row()
-        self.section += constants.ANAT_SECTION_END
+        self.section.append(constants.ANAT_SECTION_END)
+        self.flush()
 
 
 class TasksSection(Section):
     def __init__(self, tasks=[], img_path="./img", **kwargs):
-        Section.__init__(self, **kwargs)
+        Section.__init__(self, img_path=img_path, **kwargs)
 
         self.img_path = img_path
 
@@ -323,88 +401,79 @@ class TasksSection(Section):
     def write_T1_reg_rows(self, task_name, task_num):
 
         # Write the header for the next few rows.
-        self.section += constants.TASK_LABEL_ROW.format(task_name=task_name, task_num=task_num)
+        self.section.append(
+            constants.TASK_LABEL_ROW.format(task_name=task_name, task_num=task_num)
+        )
 
         row_data = {}
         row_data["row_modal"] = self.regs_slider.get_modal_id()
 
-        # Using glob patterns to find the files for this task; start
-        # with a pattern for the task/run itself.
-        task_pattern = task_name + "*" + task_num
-
-        # For the processed files, it's as simple as looking for the pattern in
-        # the source-directory. When found and copied to the directory of images,
-        # add the row.
-        for key in ["task_in_t1", "t1_in_task"]:
+        # For the processed files, it's as simple as looking up the task/run
+        # in the index of the directory of images. When found, add the row.
+        for key in constants.TASK_REG_KEYS:
             values = constants.IMAGE_INFO[key]
-            pattern = values["pattern"] % task_pattern
-            task_file = find_one_file(self.img_path, pattern)
+            task_file = self.image_index.find_one(key, task_name, task_num)
             if task_file:
                 # Add image to data and to slider.
                 row_data["row_label"] = values["title"]
-                row_data["row_img"] = task_file
+                self.set_row_image(row_data, task_file)
                 row_data["row_idx"] = self.regs_slider.add_image(task_file)
-                self.section += constants.LAYOUT_ROW.format(**row_data)
+                self.section.append(constants.LAYOUT_ROW.format(**row_data))
             else:
-                self.section += constants.PLACEHOLDER_ROW.format(row_label=values["title"])
+                self.section.append(
+                    constants.PLACEHOLDER_ROW.format(row_label=values["title"])
+                )
 
     def write_bold_gray_row(self, task_name, task_num):
         bold_data = {}
         bold_data["row_modal"] = self.img_modal.get_modal_id()
 
-        # Using glob patterns to find the files for this task; start
-        # with a pattern for the task/run itself.
-        task_pattern = task_name + "*" + task_num
-
         # Make the first half of the row - bold and ref data.
-        self.section += constants.BOLD_GRAY_START
+        self.section.append(constants.BOLD_GRAY_START)
 
         # For bold and ref files, may include run number or not.
-        for key in ["bold", "ref"]:
+        for key in constants.BOLD_KEYS:
             values = constants.IMAGE_INFO[key]
-            pattern = values["pattern"] % task_pattern
-            task_file = find_one_file(self.img_path, pattern)
+            task_file = self.image_index.find_one(key, task_name, task_num)
             if task_file:
                 # Add image to data, and to the 'generic' images container.
                 bold_data["row_label"] = values["title"]
-                bold_data["row_img"] = task_file
+                self.set_row_image(bold_data, task_file)
                 bold_data["row_idx"] = self.img_modal.add_image(task_file)
-                self.section += constants.LAYOUT_HALF_ROW.format(**bold_data)
+                self.section.append(constants.LAYOUT_HALF_ROW.format(**bold_data))
             else:
                 # File was not found with both task name and run number.
                 # Try again with task name only (no run number).
-                pattern = values["pattern"] % task_name
-                task_file = find_one_file(self.img_path, pattern)
+                task_file = self.image_index.find_one(key, task_name)
                 if task_file:
                     # Add image to data, and to the 'generic' images container.
                     bold_data["row_label"] = values["title"]
-                    bold_data["row_img"] = task_file
+                    self.set_row_image(bold_data, task_file)
                     bold_data["row_idx"] = self.img_modal.add_image(task_file)
-                    self.section += constants.LAYOUT_HALF_ROW.format(**bold_data)
+                    self.section.append(constants.LAYOUT_HALF_ROW.format(**bold_data))
                 else:
-                    self.section += constants.PLACEHOLDER_HALF_ROW.format(
-                        row_label=values["title"]
+                    self.section.append(
+                        constants.PLACEHOLDER_HALF_ROW.format(row_label=values["title"])
                     )
 
-        self.section += constants.BOLD_GRAY_SPLIT
+        self.section.append(constants.BOLD_GRAY_SPLIT)
 
         # For each gray-plot, there is only one name to look for.
-        for key in ["task_pre_reg_gray", "task_post_reg_gray"]:
+        for key in constants.TASK_GRAY_KEYS:
             values = constants.IMAGE_INFO[key]
-            pattern = values["pattern"] % task_pattern
-            task_file = find_one_file(self.img_path, pattern)
+            task_file = self.image_index.find_one(key, task_name, task_num)
             if task_file:
                 # Add image to data, and to the 'generic' images container.
                 bold_data["row_label"] = values["title"]
-                bold_data["row_img"] = task_file
+                self.set_row_image(bold_data, task_file)
                 bold_data["row_idx"] = self.img_modal.add_image(task_file)
-                self.section += constants.LAYOUT_QUARTER_ROW.format(**bold_data)
+                self.section.append(constants.LAYOUT_QUARTER_ROW.format(**bold_data))
             else:
-                self.section += constants.PLACEHOLDER_QUARTER_ROW.format(
-                    row_label=values["title"]
+                self.section.append(
+                    constants.PLACEHOLDER_QUARTER_ROW.format(row_label=values["title"])
                 )
 
-        self.section += constants.BOLD_GRAY_END
+        self.section.append(constants.BOLD_GRAY_END)
 
     def run(self, tasks):
         if len(tasks) == 0:
@@ -412,16 +481,209 @@ class TasksSection(Section):
             return
 
         # Write the column headings.
-        self.section += constants.TASKS_SECTION_START
+        self.section.append(constants.TASKS_SECTION_START)
 
         # Each entry in task_entries is a tuple of the task-name (without
         # task-) and run number (without run-).
+        # When streaming, the rows of each task are written out as soon as
+        # they are made, so the section never holds more than one task.
         for task_name, task_num in tasks:
-            self.write_T1_reg_rows(task_name, task_num)
-            self.write_bold_gray_row(task_name, task_num)
+            with tracing.span("task-%s%s" % (task_name, task_num), "layout"):
+                self.write_T1_reg_rows(task_name, task_num)
+                self.write_bold_gray_row(task_name, task_num)
+                self.flush()
 
         # Add the end of the tasks section.
-        self.section += constants.TASKS_SECTION_END
+        self.section.append(constants.TASKS_SECTION_END)
+        self.flush()
+
+
+class PageData(Section):
+    # The page as data, for the renderer (see constants.RENDERER_JS) to lay
+    # out in the browser: the sections, their rows, and the slides of the
+    # modal containers. It has the same sections, rows, and images as the
+    # page that the sections above write as HTML.
+    #
+    # A row is {"key", "modal", "idx", "src", "srcset"}, where key is the
+    # key of the image in IMAGE_INFO (the data has the title of each key),
+    # modal is the container the image was added to, and idx its index
+    # there. src is left out when the row shows the image of that slide,
+    # and srcset when there are no thumbnails. A row with no image is just
+    # {"key"}.
+    #
+    # A slide is the URL of the image, or [URL, name] when the name shown
+    # is not the name of the file.
+    #
+    def __init__(self, tasks=[], **kwargs):
+        Section.__init__(self, **kwargs)
+
+        self.sections = []
+        self.containers = []
+
+        self.run(tasks)
+
+    def row(self, key, img_file, container):
+        # A row showing img_file, or a placeholder if it is None.
+        row = {"key": key}
+        if img_file is not None:
+            row_data = {}
+            self.set_row_image(row_data, img_file)
+            row["modal"] = container.get_image_class()
+            row["idx"] = container.add_image(img_file)
+            if row_data["row_img"] != container.slides[-1][0]:
+                row["src"] = row_data["row_img"]
+            if row_data["row_srcset"] != row_data["row_img"]:
+                row["srcset"] = row_data["row_srcset"]
+        return row
+
+    def tx_section(self, tx):
+        # The BrainSprite and slider of the T1 or T2 pngs.
+        pngs_list = sorted(self.image_index.find("*_" + tx + "-*.png"))
+        if len(pngs_list) != 9:
+            print("Expected 9 %s pngs but found %s." % (tx, len(pngs_list)))
+        pngs_slider = ModalSlider(tx + "_modal", tx + "pngs", self.compact)
+        pngs_slider.add_images(pngs_list)
+        self.containers.append(pngs_slider)
+
+        sprite = None
+        mosaic_path = os.path.join(self.img_path, "%s_mosaic.jpg" % tx)
+        if os.path.isfile(mosaic_path):
+            sprite = self.compact_file(mosaic_path)
+
+        return {
+            "kind": "tx",
+            "tx": tx,
+            "sprite": sprite,
+            "slider": pngs_slider.get_image_class(),
+        }
+
+    def anat_section(self):
+        find_one = self.image_index.find_one
+        return {
+            "kind": "anat",
+            "rows": [
+                self.row(key, find_one(key), self.regs_slider)
+                for key in constants.ATLAS_ROW_KEYS
+            ],
+            "gray": [
+                self.row(key, find_one(key), self.img_modal)
+                for key in constants.CONCAT_GRAY_KEYS
+            ],
+        }
+
+    def task_entry(self, task_name, task_num):
+        find_one = self.image_index.find_one
+        return {
+            "name": task_name,
+            "run": task_num,
+            "regs": [
+                self.row(key, find_one(key, task_name, task_num), self.regs_slider)
+                for key in constants.TASK_REG_KEYS
+            ],
+            # BOLD and reference files may or may not have the run number.
+            "bold": [
+                self.row(
+                    key,
+                    find_one(key, task_name, task_num) or find_one(key, task_name),
+                    self.img_modal,
+                )
+                for key in constants.BOLD_KEYS
+            ],
+            "gray": [
+                self.row(key, find_one(key, task_name, task_num), self.img_modal)
+                for key in constants.TASK_GRAY_KEYS
+            ],
+        }
+
+    def run(self, tasks):
+        self.sections.append(self.tx_section("T1"))
+        self.sections.append(self.tx_section("T2"))
+        self.sections.append(self.anat_section())
+        if len(tasks) == 0:
+            print("No tasks were found.")
+        else:
+            self.sections.append(
+                {
+                    "kind": "tasks",
+                    "tasks": [self.task_entry(*task) for task in tasks],
+                }
+            )
+        self.containers.extend([self.img_modal, self.regs_slider])
+
+    def get_data(self, title):
+        def slide(image_file, display_name):
+            if os.path.basename(image_file) == display_name:
+                return image_file
+            return [image_file, display_name]
+
+        return {
+            "title": title,
+            "titles": dict(
+                (key, values["title"]) for key, values in constants.IMAGE_INFO.items()
+            ),
+            "sections": self.sections,
+            "containers": [
+                {
+                    "name": container.get_image_class(),
+                    "modal": container.get_modal_id(),
+                    "slider": isinstance(container, ModalSlider),
+                    "slides": [slide(*entry) for entry in container.slides],
+                }
+                for container in self.containers
+            ],
+        }
+
+
+class HtmlWriter(object):
+    # Writes an HTML document piece by piece, as it is made, to a temporary
+    # file in the same directory as the document. When everything has been
+    # written, the temporary file is renamed to the document, so anyone
+    # reading the document sees either the old page or the new one, never
+    # a page that is half written.
+    #
+    # Use as a context manager: if an error occurs before the end of the
+    # with block, the temporary file is removed and the old document, if
+    # any, is left as it was.
+    #
+    def __init__(self, filepath):
+
+        self.filepath = filepath
+        dir_name, base_name = os.path.split(filepath)
+        self.tmp_path = os.path.join(dir_name, ".%s.%d.tmp" % (base_name, os.getpid()))
+
+        try:
+            self.fd = open(self.tmp_path, "w")
+        except OSError as err:
+            print("Unable to open %s for write.\n" % self.tmp_path)
+            print("Error: {0}".format(err))
+            raise
+
+    def write(self, document):
+        # Write a string, or a list of fragments.
+        if isinstance(document, str):
+            self.fd.write(document)
+        else:
+            self.fd.writelines(document)
+
+    def close(self):
+        # Finish the document and put it in place.
+        self.fd.close()
+        os.replace(self.tmp_path, self.filepath)
+
+    def abort(self):
+        self.fd.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
 
 
 class layout_builder(object):
@@ -433,6 +695,12 @@ class layout_builder(object):
         images_path,
         subject_id,
         session_id=None,
+        encoding=None,
+        page="html",
+        assets_dir=None,
+        precompress=False,
+        static_dir=None,
+        nprocs=None,
     ):
 
         self.working_dir = os.getcwd()
@@ -446,6 +714,27 @@ class layout_builder(object):
         else:
             self.session_id = None
 
+        # Format of the compact copies of the images to show, if any (see
+        # encode.py), and how many processes make them.
+        self.encoding = encoding
+        self.nprocs = nprocs
+
+        # "html" writes the whole page. "data" writes only the data of the
+        # page, which the shared renderer lays out in the browser.
+        self.page = page
+
+        # If given, the style sheets and scripts are loaded from local copies
+        # in assets_dir (see assets.py), which may be shared by many subjects,
+        # instead of from CDNs. The page, and the copies, may be precompressed.
+        self.assets_dir = assets_dir
+        self.precompress = precompress
+        self.asset_urls = None
+
+        # Without assets_dir, the renderer of data pages is written to
+        # static_dir, which may be shared by many subjects so that browsers
+        # fetch it once. Default is the static directory next to the page.
+        self.static_dir = static_dir
+
         # For the directory where the images used by the HTML are stored,  use
         # the relative path only, as the HTML will need to access it's images
         # using the relative path.
@@ -459,9 +748,17 @@ class layout_builder(object):
         # As we write the HTML, we use the relative paths to the image files that
         # the HTML will reference. Therefore, best to be in the directory to which
         # the HTML will be written.
+        # Listings of the directories we look in are kept between runs, so
+        # that directories that have not changed are not walked again.
+        self.scan_cache = ScanCache(
+            os.path.abspath(os.path.join(self.html_path, SCAN_CACHE_NAME))
+        )
+
         os.chdir(self.html_path)
 
     def teardown(self):
+        self.scan_cache.save()
+
         # Go back to the path where we started.
         os.chdir(self.working_dir)
 
@@ -480,118 +777,283 @@ class layout_builder(object):
             use_path = self.files_path
             print("\nProcessed tasks will be found in path:\n\t%s" % use_path)
 
-        for name in os.listdir(use_path):
-
-            # Only deal with subdirectories.
-            pathname = os.path.join(use_path, name)
-            if stat.S_ISDIR(os.stat(pathname).st_mode):
+        # Only deal with subdirectories. The scan cache knows which entries
+        # are directories, so there is no need to stat each one.
+        for name in self.scan_cache.subdirs(use_path):
 
-                # The name must match task- something. Ignore anything else.
-                # The name may contain other information  and it may or may not
-                # have '_run-' in it. For example:
-                #      ses-TWO_task-rest_run-01
-                #      task-rest01
-                # We want to capture the name of the task (word after 'task-'),
-                # lose anything between that name and the digits, and capture
-                # all of the digits:
+            # The name must match task- something. Ignore anything else.
+            # The name may contain other information  and it may or may not
+            # have '_run-' in it. For example:
+            #      ses-TWO_task-rest_run-01
+            #      task-rest01
+            # We want to capture the name of the task (word after 'task-'),
+            # lose anything between that name and the digits, and capture
+            # all of the digits:
 
-                task_re = re.compile("task-([^_\d]+)\D*(\d+).*")
-                match = task_re.search(name)
+            task_re = re.compile("task-([^_\d]+)\D*(\d+).*")
+            match = task_re.search(name)
 
-                if match is not None:
-                    # Add this tuple to the set of tasks.
-                    taskset.add(match.group(1, 2))
+            if match is not None:
+                # Add this tuple to the set of tasks.
+                taskset.add(match.group(1, 2))
 
         return sorted(taskset)
 
-    def write_html(self, document, filename):
-        """
-        Writes an html document to a filename.
-
-        :parameter: document: html document.
-        :parameter: filename: name of html file.
-        :return: None
-        """
-        filepath = os.path.join(os.getcwd(), filename)
-        try:
-            fd = open(filepath, "w")
-        except OSError as err:
-            print("Unable to open %s for write.\n" % filepath)
-            print("Error: {0}".format(err))
-
-        fd.writelines(document)
+    def print_location(self, filename):
         print(
             "\nExecutive summary can be found in path:\n\t%s/%s"
             % (os.getcwd(), filename)
         )
-        fd.close()
+
+    def get_html_filename(self):
+        if self.session_id is None:
+            return "executive_summary_%s.html" % (self.subject_id)
+        return "executive_summary_%s_%s.html" % (self.subject_id, self.session_id)
 
     def run(self):
 
         # Copy gray plot pngs, generated by DCAN-BOLD processing, to the
         # directory of images used by the HTML.
-        find_and_copy_files(self.summary_path, "*DVARS_and_FD*.png", self.images_path)
+        with tracing.span("copy gray plots", "layout"):
+            find_and_copy_files(
+                self.summary_path,
+                "*DVARS_and_FD*.png",
+                self.images_path,
+                self.scan_cache,
+            )
+
+        # Now that all of the images are in place, make the compact copies.
+        # Only images that changed since the last run are encoded again.
+        if self.encoding is not None:
+            encode_images(
+                self.images_path,
+                os.path.join(os.getcwd(), REPORT_NAME % self.encoding),
+                self.encoding,
+                self.nprocs,
+            )
+
+        # The HTML is written out as it is made: each section as soon as it
+        # is complete (and the tasks section, a task at a time). Only the
+        # modal containers, which collect images from all of the sections,
+        # and the scripts are kept until the end. The page is put in place
+        # when everything has been written.
+        if self.assets_dir is not None:
+            with tracing.span("assets", "layout"):
+                self.asset_urls = self.build_assets()
+
+        filename = self.get_html_filename()
+        with tracing.span("write_html", "layout", filename=filename):
+            with HtmlWriter(os.path.join(os.getcwd(), filename)) as out:
+                if self.page == "data":
+                    self.write_data_page(out)
+                else:
+                    self.write_document(out)
+            if self.precompress:
+                assets.precompress(os.path.join(os.getcwd(), filename))
+        self.print_location(filename)
+
+    def build_assets(self):
+        # Writes the local copies of the style sheets and scripts, and gets
+        # the URL of each, relative to the page. If they have not been
+        # fetched, MissingAssetError is raised: a page made to be viewed
+        # offline must not load anything from the CDNs.
+        names = assets.build_assets(
+            self.assets_dir, assets.generated_assets(), self.precompress
+        )
+        rel_path = os.path.relpath(os.path.abspath(self.assets_dir), os.getcwd())
+        rel_path = rel_path.replace(os.sep, "/")
+        return dict(
+            (name, rel_path + "/" + out_name) for name, out_name in names.items()
+        )
+
+    def get_style_sheets(self):
+        # The links to w3.css and Font Awesome.
+        if self.asset_urls is None:
+            return constants.CDN_STYLE_SHEETS
+        return "".join(
+            constants.STYLE_SHEET.format(href=self.asset_urls[name])
+            for name in assets.STYLE_SHEETS
+        )
+
+    def get_library_scripts(self):
+        # BrainSprite and jQuery.
+        if self.asset_urls is None:
+            return constants.BRAINSPRITE_SCRIPTS
+        return "".join(
+            constants.SCRIPT.format(src=self.asset_urls[name])
+            for name in ["brainsprite.js"] + assets.JQUERY_SCRIPTS
+        )
+
+    def write_renderer(self):
+        # Writes the renderer of data pages to the static directory, unless
+        # it is already there, and gets its URL (without the extension),
+        # relative to the page. Its name has its version, so browsers may
+        # keep it for good.
+        static_dir = self.static_dir or os.path.join(os.getcwd(), STATIC_DIR)
+        os.makedirs(static_dir, exist_ok=True)
+        for ext, content in [
+            (".js", constants.BRAINSPRITE_JS + constants.RENDERER_JS),
+            (".css", constants.PAGE_CSS),
+        ]:
+            file_path = os.path.join(static_dir, constants.RENDERER_NAME + ext)
+            if os.path.isfile(file_path):
+                with open(file_path) as fd:
+                    if fd.read() == content:
+                        continue
+            with HtmlWriter(file_path) as static_out:
+                static_out.write(content)
+
+        rel_path = os.path.relpath(os.path.abspath(static_dir), os.getcwd())
+        return rel_path.replace(os.sep, "/") + "/" + constants.RENDERER_NAME
+
+    def write_data_page(self, out):
+        # The page is the data of the sections, as JSON, and the renderer.
+        # The images are found, and the thumbnails made, as for the HTML.
+        with tracing.span("ImageIndex", "layout"):
+            image_index = ImageIndex(
+                self.images_path, constants.IMAGE_INFO, self.scan_cache
+            )
+        with tracing.span("get_list_of_tasks", "layout"):
+            tasks_list = self.get_list_of_tasks()
+
+        compact = None
+        if self.encoding is not None:
+            compact = CompactImages(os.getcwd(), self.encoding)
+        thumbnails = Thumbnailer(os.getcwd())
+
+        with tracing.span("PageData", "layout", tasks=len(tasks_list)):
+            page_data = PageData(
+                tasks=tasks_list,
+                img_path=self.images_path,
+                regs_slider=ModalSlider("regs_modal", "Registrations", compact),
+                img_modal=ModalContainer("img_modal", "Images", compact),
+                image_index=image_index,
+                thumbnails=thumbnails,
+                compact=compact,
+            )
+
+        title = self.subject_id
+        if self.session_id is not None:
+            title += ": " + self.session_id
+        data = json.dumps(page_data.get_data(title), separators=(",", ":"))
+
+        if self.asset_urls is None:
+            renderer_url = self.write_renderer()
+            renderer_css = renderer_url + ".css"
+            renderer_js = renderer_url + ".js"
+        else:
+            renderer_css = self.asset_urls["execsummary-renderer.css"]
+            renderer_js = self.asset_urls["execsummary-renderer.js"]
+        out.write(
+            constants.DATA_PAGE.format(
+                style_sheets=self.get_style_sheets(),
+                renderer_css=renderer_css,
+                renderer_js=renderer_js,
+                subject=self.subject_id,
+                session=self.session_id or "",
+                # Keep the JSON from closing the script element.
+                data=data.replace("</", "<\\/"),
+            )
+        )
+
+        with tracing.span("thumbnails", "layout", count=len(thumbnails.futures)):
+            thumbnails.wait()
 
-        # Start building the HTML document, and put the subject and session
-        # into the title and page header.
-        head = constants.HTML_START
+    def write_document(self, out):
+
+        # Start the HTML document, and put the subject and session into the
+        # title and page header.
+        out.write(
+            [
+                constants.HTML_HEAD_START,
+                self.get_style_sheets(),
+                constants.HTML_HEAD_END,
+            ]
+        )
         if self.session_id is None:
-            head += constants.TITLE.format(subject=self.subject_id, sep="", session="")
+            out.write(
+                constants.TITLE.format(subject=self.subject_id, sep="", session="")
+            )
         else:
-            head += constants.TITLE.format(
-                subject=self.subject_id, sep=": ", session=self.session_id
+            out.write(
+                constants.TITLE.format(
+                    subject=self.subject_id, sep=": ", session=self.session_id
+                )
             )
-        body = ""
+
+        # Images are shown by their compact copies, if they were encoded.
+        compact = None
+        if self.encoding is not None:
+            compact = CompactImages(os.getcwd(), self.encoding)
 
         # Images included in the Registrations slider and the Images container
         # are found in multiple sections. Create the objects now and add the files
         # as we get them.
-        regs_slider = ModalSlider("regs_modal", "Registrations")
+        regs_slider = ModalSlider("regs_modal", "Registrations", compact)
 
         # Any image that is not shown in the sliders will be shown in a modal
         # container when clicked. Create that container now.
-        img_modal = ModalContainer("img_modal", "Images")
+        img_modal = ModalContainer("img_modal", "Images", compact)
+
+        # List the directory of images once, now that the gray plots have
+        # been copied, and sort the images by kind, task and run. All of the
+        # sections find their images in this index.
+        with tracing.span("ImageIndex", "layout"):
+            image_index = ImageIndex(
+                self.images_path, constants.IMAGE_INFO, self.scan_cache
+            )
+
+        # Rows show thumbnails of their images, which are made in the
+        # background while the rest of the page is laid out.
+        thumbnails = Thumbnailer(os.getcwd())
 
         # Some sections require more args, but most will need these:
         kwargs = {
             "img_path": self.images_path,
             "regs_slider": regs_slider,
             "img_modal": img_modal,
+            "image_index": image_index,
+            "out": out,
+            "thumbnails": thumbnails,
+            "compact": compact,
         }
 
         # Make sections for 'T1' and 'T2' images. Include pngs slider and
         # BrainSprite for each.
-        t1_section = TxSection(tx="T1", **kwargs)
-        t2_section = TxSection(tx="T2", **kwargs)
-        body += t1_section.get_section() + t2_section.get_section()
+        with tracing.span("TxSection T1", "layout"):
+            t1_section = TxSection(tx="T1", **kwargs)
+        with tracing.span("TxSection T2", "layout"):
+            t2_section = TxSection(tx="T2", **kwargs)
 
         # Data for this subject/session: i.e., concatenated gray plots and atlas
         # images. (The atlas images will be added to the Registrations slider.)
-        anat_section = AnatSection(**kwargs)
-        body += anat_section.get_section()
+        with tracing.span("AnatSection", "layout"):
+            AnatSection(**kwargs)
 
         # Tasks section: data specific to each task/run. Get a list of tasks processed
         # for this subject. (The <task>-in-T1 and T1-in-<task> images will be added to
         # the Registrations slider.)
-        tasks_list = self.get_list_of_tasks()
-        tasks_section = TasksSection(tasks=tasks_list, **kwargs)
-        body += tasks_section.get_section()
+        with tracing.span("get_list_of_tasks", "layout"):
+            tasks_list = self.get_list_of_tasks()
+        with tracing.span("TasksSection", "layout", tasks=len(tasks_list)):
+            TasksSection(tasks=tasks_list, **kwargs)
 
-        # Close up the Registrations elements and get the HTML.
-        body += img_modal.get_container() + regs_slider.get_container()
+        # Close up the Registrations elements and write the HTML.
+        out.write([img_modal.get_container(), regs_slider.get_container()])
 
         # There are a bunch of scripts used in this page. Keep their HTML together.
-        scripts = (
-            constants.BRAINSPRITE_SCRIPTS + t1_section.get_scripts() + t2_section.get_scripts()
+        out.write(
+            [
+                self.get_library_scripts(),
+                t1_section.get_scripts(),
+                t2_section.get_scripts(),
+                img_modal.get_scripts(),
+                regs_slider.get_scripts(),
+            ]
         )
-        scripts += img_modal.get_scripts() + regs_slider.get_scripts()
 
-        # Assemble and write the document.
-        html_doc = head + body + scripts + constants.HTML_END
-        if self.session_id is None:
-            self.write_html(html_doc, "executive_summary_%s.html" % (self.subject_id))
-        else:
-            self.write_html(
-                html_doc,
-                "executive_summary_%s_%s.html" % (self.subject_id, self.session_id),
-            )
+        out.write(constants.HTML_END)
+
+        # The page is not put in place until its thumbnails are all there.
+        with tracing.span("thumbnails", "layout", count=len(thumbnails.futures)):
+            thumbnails.wait()
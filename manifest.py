@@ -0,0 +1,176 @@
+__doc__ = """
+Keeps track of the inputs used to make each output image, so that images are
+only made again when their inputs change. The manifest is a JSON file kept
+in the executivesummary directory. Inputs are compared by size and
+modification time and, optionally, by a hash of their content.
+
+The preprocessor checks each job against the manifest before it runs it (see
+jobs.JobGraph), records the inputs of the outputs it makes, and prunes the
+outputs whose inputs are gone.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+MANIFEST_NAME = ".manifest.json"
+
+# Read files in chunks of this many bytes when hashing.
+HASH_CHUNK = 1 << 20
+
+
+def file_hash(file_path):
+    """
+    Gets the sha1 of the content of a file.
+
+    :parameter: file_path: path to the file.
+    :return: hex digest.
+    """
+    sha = hashlib.sha1()
+    with open(file_path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(HASH_CHUNK), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def signature(input_path, use_hash=False):
+    """
+    Gets the signature of an input: its size, its modification time and,
+    if use_hash is True, the hash of its content. For a directory, the size
+    is the number of entries.
+
+    :parameter: input_path: path to the input.
+    :parameter: use_hash: if True, include the hash of the content.
+    :return: dict, or None if the input does not exist.
+    """
+    try:
+        st = os.stat(input_path)
+    except OSError:
+        return None
+
+    if os.path.isdir(input_path):
+        return {"size": len(os.listdir(input_path)), "mtime": st.st_mtime_ns}
+
+    sig = {"size": st.st_size, "mtime": st.st_mtime_ns}
+    if use_hash:
+        sig["hash"] = file_hash(input_path)
+    return sig
+
+
+class Manifest(object):
+    # The manifest is a dictionary keyed by the absolute path of each output.
+    # The value is a dictionary keyed by the absolute path of each input used
+    # to make the output, with the signature of the input when the output
+    # was made.
+    #
+    # The object may be shared by threads; every access to the entries is
+    # made while holding the lock.
+    #
+    def __init__(self, manifest_path, use_hash=False):
+
+        self.manifest_path = manifest_path
+        self.use_hash = use_hash
+        self.lock = threading.Lock()
+        self.entries = {}
+
+        if os.path.isfile(manifest_path):
+            try:
+                with open(manifest_path) as fd:
+                    self.entries = json.load(fd)
+            except (OSError, ValueError) as err:
+                print("Unable to read manifest %s; starting over." % manifest_path)
+                print("Error: {0}".format(err))
+                self.entries = {}
+
+    def is_current(self, output, inputs):
+        """
+        Checks whether output exists and was made from the same inputs, none
+        of which have changed since.
+
+        :parameter: output: path to the output.
+        :parameter: inputs: list of paths to the inputs.
+        :return: True if output need not be made again.
+        """
+        output = os.path.abspath(output)
+        # An input may be given more than once (e.g., the T1 standing in for
+        # a missing T2); it is recorded once.
+        inputs = sorted(set(os.path.abspath(i) for i in inputs))
+
+        with self.lock:
+            recorded = self.entries.get(output)
+        if recorded is None or not os.path.exists(output):
+            return False
+        if sorted(recorded) != inputs:
+            return False
+
+        for input_path in inputs:
+            old_sig = recorded[input_path]
+            new_sig = signature(input_path)
+            if new_sig is None:
+                return False
+            if new_sig["size"] != old_sig["size"]:
+                return False
+            if new_sig["mtime"] != old_sig["mtime"]:
+                # Touched, or copied, but maybe not changed. Only the content
+                # hash can tell.
+                if not (self.use_hash and "hash" in old_sig):
+                    return False
+                if file_hash(input_path) != old_sig["hash"]:
+                    return False
+
+        return True
+
+    def record(self, output, inputs):
+        """
+        Records the current signatures of the inputs used to make output.
+
+        :parameter: output: path to the output.
+        :parameter: inputs: list of paths to the inputs.
+        :return: None
+        """
+        sigs = {}
+        for input_path in inputs:
+            input_path = os.path.abspath(input_path)
+            sig = signature(input_path, self.use_hash)
+            if sig is not None:
+                sigs[input_path] = sig
+
+        with self.lock:
+            self.entries[os.path.abspath(output)] = sigs
+
+    def prune(self):
+        """
+        Removes outputs for which any of the inputs no longer exist, and
+        forgets outputs that no longer exist.
+
+        :return: list of the outputs that were removed.
+        """
+        removed = []
+        with self.lock:
+            for output, recorded in list(self.entries.items()):
+                if not os.path.exists(output):
+                    del self.entries[output]
+                elif any(not os.path.exists(i) for i in recorded):
+                    print("Inputs are gone; removing %s" % output)
+                    if os.path.isdir(output):
+                        shutil.rmtree(output)
+                    else:
+                        os.remove(output)
+                    del self.entries[output]
+                    removed.append(output)
+        return removed
+
+    def save(self):
+        """
+        Writes the manifest. It is written to a temporary file first and then
+        renamed, so an interrupted run never leaves a partial manifest.
+
+        :return: None
+        """
+        tmp_path = "%s.%d.tmp" % (self.manifest_path, os.getpid())
+        with self.lock:
+            with open(tmp_path, "w") as fd:
+                json.dump(self.entries, fd, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,277 @@
+__doc__ = """
+Builds the mosaic used by the BrainSprite viewer, either from a directory of
+anatomical frames rendered by workbench, or directly from a volume.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from math import sqrt
+from re import split
+
+import nibabel as nib
+import numpy as np
+from PIL import Image
+
+import tracing
+from helpers import available_cpus
+from slices import robust_range
+from volumes import load_volume
+
+# Each frame is shrunk to fit in a square tile of this many pixels.
+IMAGE_DIM = 218
+
+JPEG_QUALITY = 95
+
+# Number of sagittal slices in a mosaic made directly from a volume. This is
+# the same as the number of scenes in parasagittal_Tx_169_template.scene.
+SPRITE_SLICES = 169
+
+
+def natural_sort(l):
+    # Need this function so frames sort in correct order.
+    convert = lambda text: int(text) if text.isdigit() else text.lower()
+    alphanum_key = lambda key: [convert(c) for c in split("([0-9]+)", key)]
+    return sorted(l, key=alphanum_key)
+
+
+def thumbnail_size(width, height, image_dim=IMAGE_DIM):
+    # Largest size that fits in the tile and keeps the aspect ratio.
+    scale = min(image_dim / width, image_dim / height, 1.0)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def block_factor(size, step):
+    # Largest whole number of pixels, no more than step, that evenly divides
+    # size.
+    for factor in range(max(1, int(step)), 0, -1):
+        if size % factor == 0:
+            return factor
+    return 1
+
+
+def block_sum(data, axis, factor, dtype=np.uint32):
+    # Sum each run of factor pixels along axis, with one strided add per
+    # pixel of the run.
+    index = [slice(None)] * data.ndim
+    total = None
+    for offset in range(factor):
+        index[axis] = slice(offset, None, factor)
+        part = data[tuple(index)]
+        if total is None:
+            total = part.astype(dtype)
+        else:
+            total += part
+    return total
+
+
+def fractional_resample(sums, axis, out_size):
+    # Resample along axis, where output pixels may cover fractions of input
+    # pixels, using differences of the running sum of the input.
+    in_size = sums.shape[axis]
+    step = in_size / out_size
+
+    # Running sum, with a leading 0, so that running[i] is the sum of the
+    # pixels before pixel i.
+    pad = [(0, 0)] * sums.ndim
+    pad[axis] = (1, 0)
+    running = np.pad(np.cumsum(sums, axis=axis, dtype=np.float32), pad, "constant")
+
+    # Sum up to each (fractional) edge of the output pixels.
+    edges = np.arange(out_size + 1) * step
+    whole = np.minimum(np.floor(edges).astype(np.intp), in_size - 1)
+    shape = [1] * sums.ndim
+    shape[axis] = out_size + 1
+    frac = (edges - whole).astype(np.float32).reshape(shape)
+    below = np.take(running, whole, axis=axis)
+    above = np.take(running, whole + 1, axis=axis)
+
+    return np.diff(below + frac * (above - below), axis=axis)
+
+
+def downsample(frames, out_h, out_w):
+    """
+    Downsamples a batch of frames by averaging over the area covered by each
+    output pixel, which keeps the result free of aliasing.
+
+    Blocks of whole pixels are summed first, which shrinks the batch cheaply;
+    the fractional remainder of the step is then taken care of on the much
+    smaller array of block sums.
+
+    :parameter: frames: (n, height, width, channels) uint8 array.
+    :parameter: out_h: height of each frame after downsampling.
+    :parameter: out_w: width of each frame after downsampling.
+    :return: (n, out_h, out_w, channels) uint8 array.
+    """
+    sizes = [(1, out_h), (2, out_w)]
+    factors = [
+        block_factor(frames.shape[ax], frames.shape[ax] / size) for ax, size in sizes
+    ]
+    scale = frames.shape[1] / out_h * frames.shape[2] / out_w
+
+    # Use 16 bit sums when they cannot overflow; they are faster.
+    dtype = np.uint16 if 255 * factors[0] * factors[1] <= 0xFFFF else np.uint32
+
+    # Whole blocks first, for both axes, while the data is still big.
+    for (axis, _), factor in zip(sizes, factors):
+        frames = block_sum(frames, axis, factor, dtype)
+
+    for axis, out_size in sizes:
+        frames = fractional_resample(frames, axis, out_size)
+
+    return np.clip(np.rint(frames / scale), 0, 255).astype(np.uint8)
+
+
+def read_frame(frame_path, shape):
+    # Decode a frame as RGB. Frames of an unexpected size are scaled to the
+    # size of the first frame so that all frames can share the same buffer.
+    with Image.open(frame_path) as img:
+        img = img.convert("RGB")
+        if (img.height, img.width) != shape:
+            img = img.resize((shape[1], shape[0]), resample=Image.BILINEAR)
+        return np.asarray(img)
+
+
+@tracing.traced("make_mosaic")
+def make_mosaic(png_path, mosaic_path, workers=None, batch_size=16):
+    """
+    Takes path to .png anatomical slices, creates a mosaic that can be used
+    in a BrainSprite viewer, and saves to a specified filename.
+
+    Frames are decoded by a pool of threads, a batch at a time, into a
+    preallocated buffer. While one batch is flipped and downsampled, the
+    next batch is being read.
+
+    :parameter: png_path: directory of frames.
+    :parameter: mosaic_path: path to which to write the JPEG mosaic.
+    :parameter: workers: number of threads used to read frames. Default is
+                the number of CPUs available to this process.
+    :parameter: batch_size: number of frames downsampled at a time.
+    :return: None
+    """
+    if workers is None:
+        workers = available_cpus()
+    workers = max(1, workers)
+
+    # Skip hidden files, e.g., frames that are still being written.
+    files = natural_sort([f for f in os.listdir(png_path) if not f.startswith(".")])
+    files = [os.path.join(png_path, name) for name in files[::-1]]
+    if not files:
+        print("There are no frames in path: %s." % png_path)
+        return
+
+    images_per_side = int(sqrt(len(files)))
+    square_dim = IMAGE_DIM * images_per_side
+    mosaic = np.zeros((square_dim, square_dim, 3), dtype=np.uint8)
+
+    # Only as many frames as fit in the square are used.
+    files = files[: images_per_side * images_per_side]
+
+    with Image.open(files[0]) as first:
+        width, height = first.size
+    shape = (height, width)
+    thumb_w, thumb_h = thumbnail_size(width, height)
+
+    batch_size = max(1, batch_size)
+    buffers = [
+        np.empty((batch_size, height, width, 3), dtype=np.uint8) for _ in range(2)
+    ]
+
+    def read_batch(start, buf):
+        batch = files[start : start + batch_size]
+        for idx, frame in enumerate(pool.map(lambda f: read_frame(f, shape), batch)):
+            buf[idx] = frame
+        return len(batch)
+
+    with ThreadPoolExecutor(max_workers=workers + 1) as pool:
+        starts = list(range(0, len(files), batch_size))
+        pending = pool.submit(read_batch, starts[0], buffers[0])
+
+        for batch_num, start in enumerate(starts):
+            count = pending.result()
+            buf = buffers[batch_num % 2]
+
+            # Start reading the next batch before working on this one.
+            if batch_num + 1 < len(starts):
+                pending = pool.submit(
+                    read_batch, starts[batch_num + 1], buffers[(batch_num + 1) % 2]
+                )
+
+            # Downsample the whole batch, one axis at a time; then flip left
+            # to right.
+            thumbs = downsample(buf[:count], thumb_h, thumb_w)[:, :, ::-1]
+
+            for offset in range(count):
+                index = start + offset
+                x = index % images_per_side * IMAGE_DIM
+                y = index // images_per_side * IMAGE_DIM
+                mosaic[y : y + thumb_h, x : x + thumb_w] = thumbs[offset]
+
+    Image.fromarray(mosaic, "RGB").save(mosaic_path, "JPEG", quality=JPEG_QUALITY)
+
+
+@tracing.traced("make_mosaic_from_volume")
+def make_mosaic_from_volume(
+    volume_path, mosaic_path, window=None, num_slices=SPRITE_SLICES, batch_size=16
+):
+    """
+    Creates a mosaic that can be used in a BrainSprite viewer directly from a
+    volume, without rendering frames with workbench. There are no surfaces in
+    this mosaic, only the anatomy.
+
+    Sagittal slices are evenly spaced from right to left, and are read from
+    the volume a batch at a time, windowed, shrunk to fit the tiles, and
+    written straight into the mosaic.
+
+    :parameter: volume_path: path to the volume (e.g., T1w_restore.nii.gz).
+    :parameter: mosaic_path: path to which to write the JPEG mosaic.
+    :parameter: window: optional (low, high) intensities shown as black and
+                white. Default is the 2nd to 98th percentile of the volume.
+    :parameter: num_slices: number of sagittal slices in the mosaic.
+    :parameter: batch_size: number of slices processed at a time.
+    :return: None
+    """
+    # Use RAS orientation so that slices, and the axes in them, are always in
+    # the same order, no matter how the volume was stored.
+    img = nib.as_closest_canonical(nib.Nifti1Image(*load_volume(volume_path)))
+    data = np.asarray(img.dataobj)
+    zooms = img.header.get_zooms()[:3]
+
+    if window is None:
+        window = robust_range(data)
+    low, high = window
+    if high <= low:
+        high = low + 1.0
+
+    # Keep the physical aspect ratio of the slices (y by z).
+    extent_y = data.shape[1] * zooms[1]
+    extent_z = data.shape[2] * zooms[2]
+    scale = IMAGE_DIM / max(extent_y, extent_z)
+    thumb_w = max(1, min(IMAGE_DIM, int(round(extent_y * scale))))
+    thumb_h = max(1, min(IMAGE_DIM, int(round(extent_z * scale))))
+
+    images_per_side = int(sqrt(num_slices))
+    num_slices = images_per_side * images_per_side
+    square_dim = IMAGE_DIM * images_per_side
+    mosaic = np.zeros((square_dim, square_dim, 3), dtype=np.uint8)
+
+    # From right (highest x) to left.
+    indices = np.rint(np.linspace(data.shape[0] - 1, 0, num_slices)).astype(np.intp)
+
+    for start in range(0, num_slices, max(1, batch_size)):
+        batch = indices[start : start + batch_size]
+
+        # (n, y, z) -> (n, z, y), superior at the top and anterior on the right.
+        planes = data[batch].transpose(0, 2, 1)[:, ::-1, :]
+        planes = (planes - low) * (255.0 / (high - low))
+        planes = np.clip(planes, 0, 255).astype(np.uint8)
+
+        # Gray, so a single channel is downsampled and then repeated.
+        thumbs = downsample(planes[..., np.newaxis], thumb_h, thumb_w)
+
+        for offset, thumb in enumerate(thumbs):
+            index = start + offset
+            x = index % images_per_side * IMAGE_DIM
+            y = index // images_per_side * IMAGE_DIM
+            mosaic[y : y + thumb_h, x : x + thumb_w] = thumb
+
+    Image.fromarray(mosaic, "RGB").save(mosaic_path, "JPEG", quality=JPEG_QUALITY)
@@ -0,0 +1,802 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Makes the images used by the Executive Summary: the atlas registration rows,
+the named T1/T2 pngs, the BrainSprite frames and mosaics, the subcortical
+rows, the task registration rows, and slices of the BOLD and SBRef (or
+scout) series.
+
+Each image (or group of images) is a job in a graph, with the files it reads
+and the files it makes. The jobs are run by jobs.JobGraph, so images that do
+not depend on each other are made at the same time, and images whose inputs
+have not changed since the last run are not made again.
+"""
+
+import argparse
+import fnmatch
+import glob
+import os
+import re
+import shutil
+import socket
+import sys
+
+import render_cache
+import resample
+import tools
+import tracing
+import volumes
+from helpers import available_cpus
+from jobs import CURRENT, DONE, Job, JobGraph, log
+from manifest import MANIFEST_NAME, Manifest
+from mosaic import make_mosaic, make_mosaic_from_volume
+from scenes import brainsprite_frames, render_frame
+from slices import make_default_slices_row, make_series_slices, make_subcortical_rows
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(SCRIPT_DIR, "templates")
+
+ATLAS_SPACE_FOLDER = "MNINonLinear"
+DEFAULT_ATLAS = os.path.join(TEMPLATE_DIR, "MNI152_T1_1mm_brain.nii.gz")
+DEFAULT_PNGS_TEMPLATE = os.path.join(TEMPLATE_DIR, "image_template_temp.scene")
+DEFAULT_BRAINSPRITE_TEMPLATE = os.path.join(
+    TEMPLATE_DIR, "parasagittal_Tx_169_template.scene"
+)
+
+# The shell script sets the group and the workbench directory by host name;
+# the same choices are read from it, so they are kept in one place.
+SETUP_ENV = os.path.join(SCRIPT_DIR, "setup_env.sh")
+
+# Group that is given access to the output, when setup_env.sh has none.
+DEFAULT_GROUP = "fnl_lab"
+
+# Names of the pngs made from the scenes of the pngs template, in the order
+# of the scenes. T1 and T2 alternate.
+PNGS_IMAGE_NAMES = [
+    "T1-Axial-InferiorTemporal-Cerebellum",
+    "T2-Axial-InferiorTemporal-Cerebellum",
+    "T1-Axial-BasalGangila-Putamen",
+    "T2-Axial-BasalGangila-Putamen",
+    "T1-Axial-SuperiorFrontal",
+    "T2-Axial-SuperiorFrontal",
+    "T1-Coronal-PosteriorParietal-Lingual",
+    "T2-Coronal-PosteriorParietal-Lingual",
+    "T1-Coronal-Caudate-Amygdala",
+    "T2-Coronal-Caudate-Amygdala",
+    "T1-Coronal-OrbitoFrontal",
+    "T2-Coronal-OrbitoFrontal",
+    "T1-Sagittal-Insula-FrontoTemporal",
+    "T2-Sagittal-Insula-FrontoTemporal",
+    "T1-Sagittal-CorpusCallosum",
+    "T2-Sagittal-CorpusCallosum",
+    "T1-Sagittal-Insula-Temporal-HippocampalSulcus",
+    "T2-Sagittal-Insula-Temporal-HippocampalSulcus",
+]
+
+
+def host_defaults(hostname=None, setup_env=SETUP_ENV):
+    """
+    Reads the defaults that setup_env.sh gives to a host: the GROUP, and
+    the CARET7DIR used when the environment has none. Only the case on the
+    host name at the top of the script is read.
+
+    :parameter: hostname: name of the host. Default is this host.
+    :parameter: setup_env: path to the shell script.
+    :return: dict of variable name to value; empty if the script is missing.
+    """
+    if hostname is None:
+        hostname = socket.gethostname()
+    try:
+        with open(setup_env) as fd:
+            lines = fd.read().splitlines()
+    except OSError:
+        return {}
+
+    defaults = {}
+    in_case = matched = False
+    for line in lines:
+        line = line.strip()
+        if line.startswith("case ") and "hostname" in line:
+            in_case = True
+        elif not in_case:
+            continue
+        elif line == "esac":
+            break
+        elif line.endswith(")") and not matched:
+            patterns = line[:-1].split("|")
+            matched = any(fnmatch.fnmatch(hostname, p.strip()) for p in patterns)
+        elif line == ";;":
+            if matched:
+                break
+        elif matched:
+            m = re.match(r'^(?:export\s+)?(GROUP|CARET7DIR)="?([^"\s]*)"?$', line)
+            if m:
+                defaults[m.group(1)] = m.group(2)
+    return defaults
+
+
+def find_wb_command():
+    # Same places setup_env.sh looks: $wb_command, then $CARET7DIR, then the
+    # CARET7DIR that setup_env.sh gives this host, if it is there on this one.
+    wb_command = os.environ.get("wb_command")
+    if wb_command:
+        return wb_command
+    caret7dir = os.environ.get("CARET7DIR")
+    if caret7dir:
+        return os.path.join(caret7dir, "wb_command")
+    caret7dir = host_defaults().get("CARET7DIR")
+    if caret7dir and os.path.exists(os.path.join(caret7dir, "wb_command")):
+        return os.path.join(caret7dir, "wb_command")
+    return "wb_command"
+
+
+def share_with_group(dir_path, group=None):
+    """
+    Gives the group read and write access to a directory. Like the chown
+    and chmod of the shell script, this is best effort; errors are ignored.
+
+    :parameter: dir_path: path to the directory.
+    :parameter: group: name of the group. Default: $GROUP, then the group
+                setup_env.sh gives this host, then fnl_lab.
+    :return: None
+    """
+    if group is None:
+        group = os.environ.get("GROUP") or host_defaults().get("GROUP") or DEFAULT_GROUP
+    try:
+        shutil.chown(dir_path, group=group)
+    except (LookupError, OSError):
+        pass
+    try:
+        os.chmod(dir_path, 0o770)
+    except OSError:
+        pass
+
+
+def build_scene(template, scene_file, replacements):
+    """
+    Makes a scene file from a template, by replacing the placeholders in the
+    template with paths and file names. The scene is written to a temporary
+    file and renamed, so a partial scene is never found at scene_file.
+
+    :parameter: template: path to the scene template.
+    :parameter: scene_file: path to which to write the scene.
+    :parameter: replacements: list of (placeholder, text) tuples, replaced
+                in order.
+    :return: None
+    """
+    with open(template) as fd:
+        scene = fd.read()
+    for placeholder, text in replacements:
+        scene = scene.replace(placeholder, text)
+
+    tmp_file = "%s.%d.tmp" % (scene_file, os.getpid())
+    with open(tmp_file, "w") as fd:
+        fd.write(scene)
+    os.replace(tmp_file, scene_file)
+
+
+def pngs_replacements(t2, t1, rp, lp, rw, lw):
+    # Placeholders of the pngs template: <TEMPLATE>_PATH and <TEMPLATE>_NAME.
+    replacements = []
+    templates = ["T2_IMG", "T1_IMG", "RPIAL", "LPIAL", "RWHITE", "LWHITE"]
+    for template, file_path in zip(templates, [t2, t1, rp, lp, rw, lw]):
+        replacements.append((template + "_PATH", file_path))
+        replacements.append((template + "_NAME", os.path.basename(file_path)))
+    return replacements
+
+
+def brainsprite_replacements(tx_img, rp, lp, rw, lw):
+    # Placeholders of the brainsprite template: <TEMPLATE>_NAME_and_PATH
+    # and <TEMPLATE>_NAME.
+    replacements = []
+    templates = ["TX_IMG", "R_PIAL", "L_PIAL", "R_WHITE", "L_WHITE"]
+    for template, file_path in zip(templates, [tx_img, rp, lp, rw, lw]):
+        replacements.append((template + "_NAME_and_PATH", file_path))
+        replacements.append((template + "_NAME", os.path.basename(file_path)))
+    return replacements
+
+
+def png_name(series):
+    # Name of the png made from a series: the same, with .png.
+    name = os.path.basename(series)
+    name = name.replace(".nii.gz", ".png", 1)
+    return name.replace(".nii", ".png", 1)
+
+
+class Preprocessor(object):
+    # Builds the graph of jobs that make the images for one subject (and
+    # session). Each add_* method adds the jobs for one kind of image;
+    # images whose inputs do not exist are left out, with a message.
+    #
+    def __init__(
+        self,
+        output_dir,
+        subject_id,
+        html_path=None,
+        session_id=None,
+        bids_input=None,
+        atlas=None,
+        brainsprite_template=None,
+        pngs_template=None,
+        nprocs=None,
+        volume_sprite=False,
+        skip_sprite=False,
+        wb_command=None,
+    ):
+
+        self.processed_files = output_dir
+        self.subject_id = subject_id
+        self.session_id = session_id
+        self.bids_input = bids_input
+        self.atlas = atlas or DEFAULT_ATLAS
+        self.brainsprite_template = brainsprite_template or DEFAULT_BRAINSPRITE_TEMPLATE
+        self.pngs_template = pngs_template or DEFAULT_PNGS_TEMPLATE
+        self.nprocs = nprocs
+        self.volume_sprite = volume_sprite
+        self.skip_sprite = skip_sprite
+        self.wb_command = wb_command or find_wb_command()
+
+        if html_path is None or html_path == "NONE":
+            html_path = os.path.join(output_dir, "executivesummary")
+        self.html_path = html_path
+        self.images_path = os.path.join(html_path, "img")
+        self.working = os.path.join(html_path, "temp_files")
+
+        atlas_space_path = os.path.join(output_dir, ATLAS_SPACE_FOLDER)
+        self.atlas_space_path = atlas_space_path
+        self.results = os.path.join(atlas_space_path, "Results")
+        self.rois = os.path.join(atlas_space_path, "ROIs")
+
+        self.images_pre = os.path.join(self.images_path, "sub-" + subject_id)
+        if session_id:
+            self.images_pre += "_ses-" + session_id
+
+        self.t1_brain = os.path.join(atlas_space_path, "T1w_restore_brain.nii.gz")
+        self.t2_brain = os.path.join(atlas_space_path, "T2w_restore_brain.nii.gz")
+        self.t1 = os.path.join(atlas_space_path, "T1w_restore.nii.gz")
+        self.t2 = os.path.join(atlas_space_path, "T2w_restore.nii.gz")
+        self.has_t2 = os.path.exists(self.t2)
+        if not self.has_t2:
+            log("t2 not found; using t1")
+            self.t2 = self.t1
+
+        surf_dir = os.path.join(atlas_space_path, "fsaverage_LR32k")
+        surf = os.path.join(surf_dir, subject_id + ".%s.%s.32k_fs_LR.surf.gii")
+        self.rw = surf % ("R", "white")
+        self.rp = surf % ("R", "pial")
+        self.lw = surf % ("L", "white")
+        self.lp = surf % ("L", "pial")
+
+        # Problems found while building the graph; any of them fails the run.
+        self.errors = []
+
+        self.graph = JobGraph()
+
+    def setup(self, hash_inputs=False):
+        # Make the directories for the output, and lose images whose
+        # inputs are gone.
+        for dir_path in [self.html_path, self.images_path, self.working]:
+            if not os.path.isdir(dir_path):
+                os.makedirs(dir_path)
+                share_with_group(dir_path)
+
+        self.manifest = Manifest(
+            os.path.join(self.html_path, MANIFEST_NAME), hash_inputs
+        )
+        log("Remove images whose inputs no longer exist.")
+        self.manifest.prune()
+
+    def add_atlas_rows(self):
+        if not os.path.exists(self.atlas):
+            log("Missing %s" % self.atlas)
+            log("Cannot create atlas-in-t1 or t1-in-atlas")
+            return
+
+        # The slices of the atlas, and its edges on the slices of the T1w,
+        # are the same for every subject, and may be taken from the render
+        # cache of the study.
+        rows = [
+            (self.t1_brain, "_desc-AtlasInT1w.gif", self.atlas, False),
+            (self.atlas, "_desc-T1wInAtlas.gif", self.t1_brain, True),
+        ]
+        for base_img, suffix, red_img, atlas_base in rows:
+            out_gif = self.images_pre + suffix
+            self.graph.add(
+                Job(
+                    os.path.basename(out_gif),
+                    make_default_slices_row,
+                    (base_img, out_gif, red_img),
+                    {"shared_base": atlas_base, "shared_red": not atlas_base},
+                    inputs=[base_img, red_img],
+                    outputs=[out_gif],
+                )
+            )
+
+    def add_pngs_scenes(self):
+        # Named pngs to show specific anatomical areas.
+        if not os.path.exists(self.pngs_template):
+            log("Missing %s" % self.pngs_template)
+            log("Cannot create the T1 and T2 pngs.")
+            return
+
+        pngs_scene = os.path.join(self.processed_files, "pngs_scene.scene")
+        scene_volumes = [self.t2, self.t1, self.rp, self.lp, self.rw, self.lw]
+        self.graph.add(
+            Job(
+                "pngs scene",
+                build_scene,
+                (self.pngs_template, pngs_scene, pngs_replacements(*scene_volumes)),
+                inputs=[self.pngs_template] + scene_volumes,
+                outputs=[pngs_scene],
+            )
+        )
+
+        for idx, image_name in enumerate(PNGS_IMAGE_NAMES):
+            scene_num = idx + 1
+            if not self.has_t2 and scene_num % 2 == 0:
+                # There is no t2 image.
+                continue
+            out_png = "%s_%s.png" % (self.images_pre, image_name)
+            self.graph.add(
+                Job(
+                    os.path.basename(out_png),
+                    render_frame,
+                    (self.wb_command, pngs_scene, scene_num, out_png),
+                    inputs=[pngs_scene],
+                    outputs=[out_png],
+                )
+            )
+
+    def add_brainsprite(self, tx):
+        # Frames for the brainsprite of tx, and the mosaic made from them.
+        tx_img = self.t1 if tx == "T1" else self.t2
+        pngs_dir = os.path.join(self.processed_files, tx + "_pngs")
+        mosaic_path = os.path.join(self.images_path, tx + "_mosaic.jpg")
+
+        if self.volume_sprite:
+            # The mosaic is made straight from the volume; no scenes to render.
+            volume = os.path.join(self.atlas_space_path, tx + "w_restore.nii.gz")
+            if os.path.isfile(volume):
+                self.graph.add(
+                    Job(
+                        os.path.basename(mosaic_path),
+                        make_mosaic_from_volume,
+                        (volume, mosaic_path),
+                        inputs=[volume],
+                        outputs=[mosaic_path],
+                    )
+                )
+            return
+
+        frame_jobs = []
+        if self.skip_sprite:
+            log("Skip brainsprite processing per user request.")
+        elif not os.path.exists(self.brainsprite_template):
+            log("Missing %s" % self.brainsprite_template)
+            log("Cannot perform processing needed for brainsprite.")
+        else:
+            if not os.path.isdir(pngs_dir):
+                os.makedirs(pngs_dir)
+                share_with_group(pngs_dir)
+
+            scene_file = os.path.join(
+                self.processed_files, tx.lower() + "_bs_scene.scene"
+            )
+            scene_volumes = [tx_img, self.rp, self.lp, self.rw, self.lw]
+            self.graph.add(
+                Job(
+                    "%s brainsprite scene" % tx,
+                    build_scene,
+                    (
+                        self.brainsprite_template,
+                        scene_file,
+                        brainsprite_replacements(*scene_volumes),
+                    ),
+                    inputs=[self.brainsprite_template] + scene_volumes,
+                    outputs=[scene_file],
+                )
+            )
+
+            # The frames are counted in the template, as the scene is not
+            # made until the graph is run.
+            frames = brainsprite_frames(tx, self.brainsprite_template, pngs_dir)
+            for _, scene_num, out_png in frames:
+                job = self.graph.add(
+                    Job(
+                        "%s frame %d" % (tx, scene_num),
+                        render_frame,
+                        (self.wb_command, scene_file, scene_num, out_png),
+                        inputs=[scene_file],
+                        outputs=[out_png],
+                    )
+                )
+                frame_jobs.append(job.name)
+
+        # If there are pngs for tx, make the mosaic file for the brainsprite.
+        # If not, no problem. Layout will use the mosaic if it is there.
+        if frame_jobs or os.path.isdir(pngs_dir):
+            self.graph.add(
+                Job(
+                    os.path.basename(mosaic_path),
+                    make_mosaic,
+                    (pngs_dir, mosaic_path),
+                    {"workers": self.nprocs},
+                    inputs=[pngs_dir],
+                    outputs=[mosaic_path],
+                    after=frame_jobs,
+                )
+            )
+
+    def add_subcorticals(self):
+        subcort_sub = os.path.join(self.rois, "sub2atl_ROI.2.nii.gz")
+        subcort_atl = os.path.join(self.rois, "Atlas_ROIs.2.nii.gz")
+        if not os.path.exists(subcort_sub):
+            log("Missing %s." % subcort_sub)
+            log("No subcorticals will be included.")
+            return
+        if not os.path.exists(subcort_atl):
+            log("Missing %s." % subcort_atl)
+            log("Cannot create atlas-in-subcort or subcort-in-atlas.")
+            return
+
+        # The default slices are not as nice for subcorticals as they are
+        # for a whole brain; see slices.SUBCORT_SLICES. Both rows are made
+        # at once, from one read of each volume.
+        sub_gif = self.images_pre + "_desc-AtlasInSubcort.gif"
+        atl_gif = self.images_pre + "_desc-SubcortInAtlas.gif"
+        self.graph.add(
+            Job(
+                "subcorticals",
+                make_subcortical_rows,
+                (subcort_sub, subcort_atl, sub_gif, atl_gif),
+                inputs=[subcort_sub, subcort_atl],
+                outputs=[sub_gif, atl_gif],
+            )
+        )
+
+    def add_tasks(self):
+        # The brains are resampled onto the grid of each task. Runs usually
+        # share the same grid, so resampled brains are kept, by grid, and
+        # each grid is only resampled once: the resample jobs are named by
+        # their output, so runs that share a grid share the job.
+        resample_dir = os.path.join(self.processed_files, "resampled")
+
+        brains = [("T1", self.t1_brain)]
+        if self.has_t2:
+            brains.append(("T2", self.t2_brain))
+
+        task_dirs = sorted(glob.glob(os.path.join(self.results, "*task-*", "")))
+        for task_dir in task_dirs:
+            fmri_name = os.path.basename(os.path.dirname(task_dir))
+            task_img = os.path.join(task_dir, fmri_name + ".nii.gz")
+            fmri_pre = os.path.join(
+                self.images_path, "sub-%s_%s" % (self.subject_id, fmri_name)
+            )
+            if not os.path.exists(task_img):
+                log("Missing %s." % task_img)
+                self.errors.append("Missing %s" % task_img)
+                continue
+
+            for tx, brain in brains:
+                if not os.path.exists(brain):
+                    log("Missing %s." % brain)
+                    self.errors.append("Missing %s" % brain)
+                    continue
+
+                _, tx_2_brain = resample.cached_path(brain, task_img, resample_dir)
+                self.graph.add(
+                    Job(
+                        "resample " + os.path.basename(tx_2_brain),
+                        resample.resample_cached,
+                        (brain, task_img, resample_dir),
+                        inputs=[brain, task_img],
+                        outputs=[tx_2_brain],
+                        use_manifest=False,
+                    )
+                )
+
+                rows = [
+                    (task_img, "_desc-%sInTask.gif" % tx, tx_2_brain),
+                    (tx_2_brain, "_desc-TaskIn%s.gif" % tx, task_img),
+                ]
+                for base_img, suffix, red_img in rows:
+                    out_gif = fmri_pre + suffix
+                    self.graph.add(
+                        Job(
+                            os.path.basename(out_gif),
+                            make_default_slices_row,
+                            (base_img, out_gif, red_img),
+                            inputs=[base_img, red_img],
+                            outputs=[out_gif],
+                        )
+                    )
+
+    def add_series(self, series, out_png):
+        self.graph.add(
+            Job(
+                os.path.basename(out_png),
+                make_series_slices,
+                (series, out_png),
+                inputs=[series],
+                outputs=[out_png],
+            )
+        )
+
+    def add_bold_and_refs(self):
+        # If the bids-input was supplied and there are func files, slice
+        # the bold and sbrefs into pngs so we can display them. Only the
+        # first volume of each is read, and each is its own job, so all of
+        # the runs are sliced at the same time.
+        if not self.bids_input or not os.path.isdir(self.bids_input):
+            log("No func files. Neither BOLD nor SBREF will be shown.")
+            return
+
+        bolds = sorted(glob.glob(os.path.join(self.bids_input, "*task-*_bold*.nii*")))
+        for bold in bolds:
+            self.add_series(bold, os.path.join(self.images_path, png_name(bold)))
+
+        sbrefs = sorted(glob.glob(os.path.join(self.bids_input, "*task-*_sbref*.nii*")))
+        if sbrefs:
+            for sbref in sbrefs:
+                self.add_series(sbref, os.path.join(self.images_path, png_name(sbref)))
+            return
+
+        # There are no SBRefs; use scout files for references.
+        pattern = os.path.join(self.processed_files, "*task-*", "Scout_orig.nii.gz")
+        for scout in sorted(glob.glob(pattern)):
+            # Get the task name and number from the parent.
+            task_name = os.path.basename(os.path.dirname(scout))
+            name = "sub-%s_%s_ref.png" % (self.subject_id, task_name)
+            self.add_series(scout, os.path.join(self.images_path, name))
+
+    def build(self):
+        self.add_atlas_rows()
+        self.add_pngs_scenes()
+        self.add_brainsprite("T1")
+        if self.has_t2:
+            self.add_brainsprite("T2")
+        self.add_subcorticals()
+        self.add_tasks()
+        self.add_bold_and_refs()
+
+    def run(self, hash_inputs=False):
+        """
+        Builds the graph and runs the jobs.
+
+        :parameter: hash_inputs: if True, compare inputs by content as well
+                    as by size and time.
+        :return: True if all of the images were made (or are up to date).
+        """
+        log("START: executive summary image preprocessing")
+
+        with tracing.span("setup", "preproc"):
+            self.setup(hash_inputs)
+        with tracing.span("build graph", "preproc") as args:
+            self.build()
+            args["jobs"] = len(self.graph.jobs)
+
+        workers = self.nprocs if self.nprocs else available_cpus()
+        log("Running %d jobs with %d workers." % (len(self.graph.jobs), workers))
+        try:
+            with tracing.span("run jobs", "preproc", workers=workers):
+                status = self.graph.run(workers, self.manifest)
+        finally:
+            self.manifest.save()
+            # Clean up the working directory.
+            shutil.rmtree(self.working, ignore_errors=True)
+
+        ok = not self.errors and all(
+            result in [DONE, CURRENT] for result in status.values()
+        )
+        log("DONE: executive summary prep")
+        return ok
+
+
+def preprocess(output_dir, subject_id, hash_inputs=False, **kwargs):
+    """
+    Makes the images for the Executive Summary of a subject (and session).
+
+    :parameter: output_dir: path to processed files, ending at files.
+    :parameter: subject_id: subject id without sub- prefix.
+    :parameter: hash_inputs: if True, compare inputs by content as well as
+                by size and time when deciding whether images are up to date.
+    :parameter: kwargs: other arguments of Preprocessor.
+    :return: True if all of the images were made (or are up to date).
+    """
+    if not os.path.isdir(output_dir):
+        log("Directory does not exist: %s" % output_dir)
+        return False
+    with tracing.span("preprocess", "preproc", subject=subject_id):
+        return Preprocessor(output_dir, subject_id, **kwargs).run(hash_inputs)
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+        prog="preproc",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--output-dir",
+        "-o",
+        dest="output_dir",
+        required=True,
+        help="Path to processed files, ending at files.",
+    )
+    parser.add_argument(
+        "--subject-id",
+        "-s",
+        dest="subject_id",
+        required=True,
+        help="Subject ID without sub- prefix.",
+    )
+    parser.add_argument(
+        "--html-path",
+        "-w",
+        dest="html_path",
+        help="Path to which to write executive summary. Default is "
+        "<output-dir>/executivesummary.",
+    )
+    parser.add_argument(
+        "--bids-input",
+        "-i",
+        dest="bids_input",
+        help="Path to unprocessed data set, ending at func. If not supplied, no "
+        "task data will be processed.",
+    )
+    parser.add_argument(
+        "--session-id",
+        "-v",
+        dest="session_id",
+        help="Session (visit) ID without ses- prefix.",
+    )
+    parser.add_argument(
+        "--atlas",
+        "-a",
+        dest="atlas",
+        help="Atlas file for generation of rest image. Overrides adult MNI 1mm atlas.",
+    )
+    parser.add_argument(
+        "--brainsprite-template",
+        "-b",
+        dest="brainsprite_template",
+        help="Path to template that has all of the scenes for the brainsprite "
+        "(usually 169).",
+    )
+    parser.add_argument(
+        "--pngs-template",
+        "-p",
+        dest="pngs_template",
+        help="Path to template with scenes for Tx pngs (these are named, so "
+        "should agree).",
+    )
+    parser.add_argument(
+        "--nprocs",
+        "-n",
+        dest="nprocs",
+        type=int,
+        help="Maximum number of jobs to run at once. Default is the number of "
+        "CPUs allocated to the job.",
+    )
+    parser.add_argument(
+        "--volume-sprite",
+        "-m",
+        dest="volume_sprite",
+        action="store_true",
+        help="Brainsprite mosaics will be made from the volumes, so do not "
+        "render the brainsprite scenes.",
+    )
+    parser.add_argument(
+        "--hash-inputs",
+        "-H",
+        dest="hash_inputs",
+        action="store_true",
+        help="Compare inputs by content as well as by size and time when "
+        "deciding whether images from prior runs are up to date.",
+    )
+    parser.add_argument(
+        "--trace",
+        dest="trace",
+        metavar="TRACE_JSON",
+        help="Write a trace of where the time goes (Chrome trace event "
+        "format; open it in Perfetto or chrome://tracing) to this file.",
+    )
+    parser.add_argument(
+        "--tools",
+        dest="tools",
+        metavar="MODE[:DIR]",
+        help="How to run wb_command and the FSL tools: real (the default), "
+        "record:DIR to run them and record each call in DIR, or replay[:DIR] "
+        "to stand in for them with the calls recorded in DIR. See tools.py.",
+    )
+    parser.add_argument(
+        "--tool-latency",
+        dest="tool_latency",
+        type=float,
+        metavar="SECONDS",
+        help="With --tools replay, the time each call takes. Default is the "
+        "time the call took when it was recorded.",
+    )
+    parser.add_argument(
+        "--tool-limit",
+        dest="tool_limits",
+        action="append",
+        metavar="TOOL=N",
+        help="Most calls of a tool to run at once (e.g., wb_command=2). May be "
+        "given for more than one tool. See tools.py.",
+    )
+    parser.add_argument(
+        "--tool-timeout",
+        dest="tool_timeout",
+        type=float,
+        metavar="SECONDS",
+        help="Seconds a call of a tool may take before it is killed. Default "
+        "is 3600.",
+    )
+    parser.add_argument(
+        "--volume-cache-mb",
+        dest="volume_cache_mb",
+        type=float,
+        metavar="MB",
+        help="Most megabytes of decoded volumes to keep in memory, so that "
+        "each volume is only read once. Default is 2048. See volumes.py.",
+    )
+    parser.add_argument(
+        "--render-cache",
+        dest="render_cache",
+        metavar="DIR",
+        help="Directory, shared by all of the subjects of a study, in which to "
+        "keep the slices of the atlas. See render_cache.py.",
+    )
+    # Stealth arg used only for debug.
+    parser.add_argument(
+        "--skip_sprite",
+        "-x",
+        dest="skip_sprite",
+        action="store_true",
+        help=argparse.SUPPRESS,
+    )
+
+    return parser
+
+
+def _cli():
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    kwargs = vars(args)
+    output_dir = kwargs.pop("output_dir")
+    subject_id = kwargs.pop("subject_id")
+    trace_path = kwargs.pop("trace")
+    tools_spec = kwargs.pop("tools")
+    tool_latency = kwargs.pop("tool_latency")
+    try:
+        tool_limits = tools.parse_limits(",".join(kwargs.pop("tool_limits") or []))
+    except ValueError as err:
+        parser.error(str(err))
+    tool_timeout = kwargs.pop("tool_timeout")
+    volume_cache_mb = kwargs.pop("volume_cache_mb")
+    render_cache_dir = kwargs.pop("render_cache")
+
+    if tools_spec or tool_latency is not None or tool_limits or tool_timeout:
+        tools.configure(tools_spec, tool_latency, tool_limits, tool_timeout)
+    if volume_cache_mb is not None:
+        volumes.configure(volume_cache_mb)
+    if render_cache_dir:
+        render_cache.configure(render_cache_dir)
+
+    if trace_path:
+        tracing.start()
+    try:
+        ok = preprocess(output_dir, subject_id, **kwargs)
+    finally:
+        if trace_path:
+            tracing.stop(trace_path)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    _cli()
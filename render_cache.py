@@ -0,0 +1,171 @@
+__doc__ = """
+Keeps what is drawn from the volumes that every subject of a study shares
+(the atlas, and the atlas ROIs of the subcortical rows), so that they are
+only read and rendered once for the study: their gray slices, where they are
+the base of a row, and the red edges of their masks on the slices of the
+subject's volume, where they are the outline. Only the subject's own volumes
+are read for each subject.
+
+These are kept in a directory that all of the subjects (and all of the
+worker processes of batch.py) share, one .npz file per volume, kind, and set
+of slices (and, for edges, the grid of the volume they are drawn on). The
+name of the file is made from the content of the volume (its sha1, so a copy
+of the atlas in another place is the same atlas), the slices, and
+RENDER_VERSION, which changes when the slices would be drawn differently.
+The sha1 of a volume is kept in the directory too, by its path, size, and
+time, so that each volume is only hashed once for the study.
+
+The directory is chosen with --render-cache DIR, or with the
+EXECSUMMARY_RENDER_CACHE environment variable, which is how worker processes
+get it. With neither, nothing is kept.
+"""
+
+import hashlib
+import io
+import os
+import threading
+
+import numpy as np
+
+from manifest import file_hash
+from resample import grid_key
+
+RENDER_CACHE_ENV = "EXECSUMMARY_RENDER_CACHE"
+
+# Change this when the gray slices would come out differently (the palette,
+# the intensity range, or the orientation), so old files are not used.
+RENDER_VERSION = 2
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class RenderCache(object):
+    # The hashes of the volumes are kept by path, size, and time, in memory
+    # and in the directory, so that a volume is only hashed once for the
+    # study, however many processes look it up.
+    #
+    def __init__(self, cache_dir):
+
+        self.cache_dir = cache_dir
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+    def volume_hash(self, img_path):
+        st = os.stat(img_path)
+        key = (os.path.abspath(img_path), st.st_size, st.st_mtime_ns)
+        with self.lock:
+            sha = self.hashes.get(key)
+        if sha is not None:
+            return sha
+
+        key_name = hashlib.sha1(repr(key).encode()).hexdigest()[:20]
+        hash_path = os.path.join(self.cache_dir, "hash_%s.txt" % key_name)
+        try:
+            with open(hash_path) as fd:
+                sha = fd.read().strip()
+        except OSError:
+            sha = None
+        if not sha:
+            sha = file_hash(img_path)
+            self.write(hash_path, sha.encode())
+        with self.lock:
+            self.hashes[key] = sha
+        return sha
+
+    def file_path(self, img_path, geometry, kind="base", grid=None):
+        """
+        Gets the path of the file that keeps the slices of a volume.
+
+        :parameter: img_path: path to the volume.
+        :parameter: geometry: the slices, as a list of (axis, index) tuples.
+        :parameter: kind: what is kept: "base" for the gray slices of the
+                    volume, or the name of the mask whose edges are kept.
+        :parameter: grid: for edges, the shape and affine of the volume whose
+                    slices they are drawn on.
+        :return: path.
+        """
+        sha = hashlib.sha1()
+        sha.update(("%d %s " % (RENDER_VERSION, self.volume_hash(img_path))).encode())
+        sha.update(repr([(int(axis), int(index)) for axis, index in geometry]).encode())
+        if grid is not None:
+            sha.update(grid_key(*grid).encode())
+        return os.path.join(self.cache_dir, "%s_%s.npz" % (kind, sha.hexdigest()[:20]))
+
+    def load(self, img_path, geometry, kind="base", grid=None):
+        """
+        Gets the slices of a volume, if they have been kept.
+
+        :parameter: img_path: path to the volume.
+        :parameter: geometry: the slices, as a list of (axis, index) tuples.
+        :parameter: kind: see file_path.
+        :parameter: grid: see file_path.
+        :return: list of 2D arrays, or None.
+        """
+        try:
+            with np.load(self.file_path(img_path, geometry, kind, grid)) as npz:
+                return [npz["arr_%d" % idx] for idx in range(len(geometry))]
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, img_path, geometry, planes, kind="base", grid=None):
+        """
+        Keeps the slices of a volume.
+
+        :parameter: img_path: path to the volume.
+        :parameter: geometry: the slices, as a list of (axis, index) tuples.
+        :parameter: planes: list of 2D arrays, one for each slice.
+        :parameter: kind: see file_path.
+        :parameter: grid: see file_path.
+        :return: None
+        """
+        buf = io.BytesIO()
+        np.savez(buf, *planes)
+        self.write(self.file_path(img_path, geometry, kind, grid), buf.getvalue())
+
+    def write(self, file_path, data):
+        # The file is written to a temporary file and renamed, so that other
+        # processes never find half of it.
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = "%s.%d.%d.tmp" % (file_path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, "wb") as fd:
+                fd.write(data)
+            os.replace(tmp_path, file_path)
+        except OSError:
+            # It will be made again next time; that is all.
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def configure(cache_dir=None):
+    """
+    Chooses the directory of the cache. The choice is put in the environment,
+    so that processes started from this one use the same directory.
+
+    :parameter: cache_dir: directory shared by the subjects of a study.
+                Default is the EXECSUMMARY_RENDER_CACHE environment variable.
+    :return: the cache, or None if there is no directory.
+    """
+    global _cache
+
+    if cache_dir is None:
+        cache_dir = os.environ.get(RENDER_CACHE_ENV) or None
+    cache = None
+    if cache_dir is not None:
+        cache_dir = os.path.abspath(cache_dir)
+        os.environ[RENDER_CACHE_ENV] = cache_dir
+        cache = RenderCache(cache_dir)
+
+    with _cache_lock:
+        _cache = cache
+    return cache
+
+
+def get_cache():
+    # The cache of this process, or None.
+    with _cache_lock:
+        cache = _cache
+    if cache is None and os.environ.get(RENDER_CACHE_ENV):
+        cache = configure()
+    return cache
@@ -0,0 +1,255 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Resamples a volume onto the voxel grid of a reference volume, using the
+affines of both, with trilinear interpolation. This takes the place of
+flirt -applyxfm (with no transform) for volumes that are already in the same
+space.
+
+Resampled volumes are kept in a cache directory, named by a key made from
+the input file and the reference grid (its shape and affine). All of the
+runs of a session usually share one grid, so the input is resampled only
+once and then found in the cache for every other run. When the input
+changes, it is resampled again, and the copies made from older versions of
+it, onto the same grid, are removed.
+
+The preprocessor uses it in-process. cached_path gives the path that the
+resampled volume has in the cache (the output of the job that makes it), and
+resample_cached makes it, unless it is there already:
+    _, t1_2_brain = cached_path(t1_brain, task_img, cache_dir)
+    resample_cached(t1_brain, task_img, cache_dir)
+From the command line, the path of the resampled volume is printed.
+"""
+
+import argparse
+import glob
+import hashlib
+import os
+import sys
+import threading
+
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+from volumes import load_volume
+
+# Trilinear, as used by flirt by default.
+INTERP_ORDER = 1
+
+# Affines are rounded to this many decimals before they are hashed, so that
+# grids that differ only by floating point noise share the same key.
+AFFINE_DECIMALS = 4
+
+# Resampled volumes made by this process, by cache key. The cache directory
+# may be shared by several processes; this avoids even looking at it twice.
+_resampled = {}
+_lock = threading.Lock()
+
+
+def grid_key(shape, affine):
+    """
+    Makes a key for a voxel grid from its shape and affine.
+
+    :parameter: shape: shape of the volume (only the first 3 dims are used).
+    :parameter: affine: 4x4 affine of the volume.
+    :return: hex string.
+    """
+    sha = hashlib.sha1()
+    sha.update(repr(tuple(int(dim) for dim in shape[:3])).encode())
+    sha.update(
+        np.round(np.asarray(affine, dtype=np.float64), AFFINE_DECIMALS).tobytes()
+    )
+    return sha.hexdigest()
+
+
+def cache_key(in_path, ref_shape, ref_affine):
+    """
+    Makes a key from the input file (its path, size, and modification time)
+    and the reference grid. When the input changes, so does the key.
+
+    :parameter: in_path: path to the volume to be resampled.
+    :parameter: ref_shape: shape of the reference volume.
+    :parameter: ref_affine: affine of the reference volume.
+    :return: hex string.
+    """
+    st = os.stat(in_path)
+    sha = hashlib.sha1()
+    sha.update(os.path.abspath(in_path).encode())
+    sha.update(("%d %d" % (st.st_size, st.st_mtime_ns)).encode())
+    sha.update(grid_key(ref_shape, ref_affine).encode())
+    return sha.hexdigest()[:16]
+
+
+def volume_stem(img_path):
+    # Name of the volume without the directory and the extension.
+    name = os.path.basename(img_path)
+    for ext in [".nii.gz", ".nii"]:
+        if name.endswith(ext):
+            return name[: -len(ext)]
+    return os.path.splitext(name)[0]
+
+
+def resample_to_grid(data, affine, ref_shape, ref_affine, order=INTERP_ORDER):
+    """
+    Resamples a volume onto a voxel grid. Voxels of the grid that fall
+    outside of the volume are 0.
+
+    :parameter: data: 3D array.
+    :parameter: affine: 4x4 affine of data.
+    :parameter: ref_shape: shape of the grid (only the first 3 dims are used).
+    :parameter: ref_affine: 4x4 affine of the grid.
+    :parameter: order: order of the spline interpolation (1 is trilinear).
+    :return: float32 array with shape ref_shape[:3].
+    """
+    # Voxel of the grid -> world -> voxel of the volume.
+    mapping = np.linalg.inv(affine).dot(ref_affine)
+    return ndimage.affine_transform(
+        np.asarray(data, dtype=np.float32),
+        mapping[:3, :3],
+        offset=mapping[:3, 3],
+        output_shape=tuple(int(dim) for dim in ref_shape[:3]),
+        order=order,
+        mode="constant",
+        cval=0.0,
+    )
+
+
+def resample_image(in_path, ref_path, out_path):
+    """
+    Resamples the volume in in_path onto the grid of the volume in ref_path,
+    and writes it to out_path. Only the header of the reference is read.
+
+    :parameter: in_path: path to the volume to be resampled.
+    :parameter: ref_path: path to the reference volume.
+    :parameter: out_path: path to which to write the resampled volume.
+    :return: None
+    """
+    # Only the headers are read here; the data comes from the volume cache.
+    in_img = nib.load(in_path)
+    ref_img = nib.load(ref_path)
+
+    data, affine = load_volume(in_path)
+    resampled = resample_to_grid(data, affine, ref_img.shape, ref_img.affine)
+
+    out_img = nib.Nifti1Image(resampled, ref_img.affine)
+    out_img.header.set_xyzt_units(*in_img.header.get_xyzt_units())
+    out_img.set_qform(ref_img.affine, code=1)
+    out_img.set_sform(ref_img.affine, code=1)
+
+    # Write to a temporary file and rename it, so that another process
+    # sharing the cache never finds a partial volume.
+    out_dir, out_name = os.path.split(out_path)
+    tmp_path = os.path.join(out_dir, ".tmp_%d_%s" % (os.getpid(), out_name))
+    try:
+        nib.save(out_img, tmp_path)
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def cached_path(in_path, ref_path, cache_dir):
+    """
+    Gets the path at which the volume in in_path, resampled onto the grid of
+    ref_path, is kept in the cache. Only the header of the reference is read.
+
+    :parameter: in_path: path to the volume to be resampled.
+    :parameter: ref_path: path to the reference volume.
+    :parameter: cache_dir: directory in which resampled volumes are kept.
+    :return: tuple of cache key and path.
+    """
+    ref_img = nib.load(ref_path)
+    key = cache_key(in_path, ref_img.shape, ref_img.affine)
+
+    # The name also has a key of the input's path and the grid alone, which
+    # every version of the input shares, so older copies can be found.
+    sha = hashlib.sha1()
+    sha.update(os.path.abspath(in_path).encode())
+    sha.update(grid_key(ref_img.shape, ref_img.affine).encode())
+    out_name = "%s_%s_%s.nii.gz" % (volume_stem(in_path), sha.hexdigest()[:8], key)
+    return key, os.path.join(cache_dir, out_name)
+
+
+def remove_stale(out_path):
+    """
+    Removes the copies of a volume, resampled onto the same grid, that were
+    made from older versions of it. Copies that are already gone (removed
+    by another process) are ignored.
+
+    :parameter: out_path: path to the copy made from the current version.
+    :return: list of the paths removed.
+    """
+    prefix = out_path[: -len(".nii.gz")].rsplit("_", 1)[0]
+    removed = []
+    for old_path in glob.glob(glob.escape(prefix) + "_*.nii.gz"):
+        if old_path == out_path:
+            continue
+        try:
+            os.remove(old_path)
+        except OSError:
+            continue
+        removed.append(old_path)
+    return removed
+
+
+def resample_cached(in_path, ref_path, cache_dir):
+    """
+    Gets the volume in in_path resampled onto the grid of ref_path, from the
+    cache if it has been resampled onto that grid before.
+
+    :parameter: in_path: path to the volume to be resampled.
+    :parameter: ref_path: path to the reference volume.
+    :parameter: cache_dir: directory in which resampled volumes are kept.
+    :return: path to the resampled volume.
+    """
+    key, out_path = cached_path(in_path, ref_path, cache_dir)
+
+    with _lock:
+        if key in _resampled and os.path.isfile(_resampled[key]):
+            return _resampled[key]
+
+    if not os.path.isfile(out_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        resample_image(in_path, ref_path, out_path)
+        remove_stale(out_path)
+
+    with _lock:
+        _resampled[key] = out_path
+    return out_path
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+        prog="resample",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("in_path", metavar="INPUT", help="volume to be resampled.")
+    parser.add_argument("ref_path", metavar="REFERENCE", help="volume with the grid.")
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        required=True,
+        metavar="CACHE_DIR",
+        help="directory in which resampled volumes are kept.",
+    )
+
+    return parser
+
+
+def _cli():
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    out_path = resample_cached(args.in_path, args.ref_path, args.cache_dir)
+
+    # Only the path goes to stdout, so the caller can capture it.
+    print(out_path)
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+
+    _cli()
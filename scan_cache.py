@@ -0,0 +1,126 @@
+__doc__ = """
+Keeps the listings of directories between runs, so that directories that have
+not changed are not walked again. This matters on network file systems, where
+every listdir and stat is a round trip to the metadata server, and the layout
+of a whole study may be rebuilt many times.
+
+A listing is reused as long as the modification time of its directory has not
+changed. Adding, removing, or renaming an entry changes the modification time
+of the directory; changing the content of a file does not, and does not need
+to, since only names and types are kept.
+"""
+
+import json
+import os
+import threading
+import time
+
+SCAN_CACHE_NAME = ".scan_cache.json"
+
+# A directory modified this soon before it was listed may be modified again
+# within the resolution of its timestamp, and the change would be missed. Such
+# listings are not reused.
+RACY_NS = 2 * 10**9
+
+
+class ScanCache(object):
+    # The cache is a dictionary keyed by the absolute path of each directory.
+    # The value is a dictionary with the modification time of the directory,
+    # the time at which it was listed, and the entries as [name, is_dir].
+    #
+    # The object may be shared by threads; every access to the entries is
+    # made while holding the lock.
+    #
+    def __init__(self, cache_path=None):
+
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.dirs = {}
+        self.changed = False
+
+        if cache_path is not None and os.path.isfile(cache_path):
+            try:
+                with open(cache_path) as fd:
+                    self.dirs = json.load(fd)
+            except (OSError, ValueError) as err:
+                print("Unable to read scan cache %s; starting over." % cache_path)
+                print("Error: {0}".format(err))
+                self.dirs = {}
+
+    def scandir(self, dir_path):
+        """
+        Lists a directory, from the cache if the directory has not changed
+        since it was last listed, else with os.scandir.
+
+        :parameter: dir_path: path to the directory.
+        :return: sorted list of (name, is_dir) tuples. is_dir follows
+                 symbolic links, as os.stat does.
+        """
+        key = os.path.abspath(dir_path)
+        mtime = os.stat(key).st_mtime_ns
+
+        with self.lock:
+            cached = self.dirs.get(key)
+        if (
+            cached is not None
+            and cached["mtime"] == mtime
+            and cached["scanned"] - mtime > RACY_NS
+        ):
+            return [(name, is_dir) for name, is_dir in cached["entries"]]
+
+        scanned = time.time_ns()
+        entries = []
+        with os.scandir(key) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                entries.append((entry.name, is_dir))
+        entries.sort()
+
+        with self.lock:
+            self.dirs[key] = {"mtime": mtime, "scanned": scanned, "entries": entries}
+            self.changed = True
+        return entries
+
+    def listdir(self, dir_path):
+        """
+        Lists the names in a directory, like os.listdir.
+
+        :parameter: dir_path: path to the directory.
+        :return: sorted list of names.
+        """
+        return [name for name, _ in self.scandir(dir_path)]
+
+    def subdirs(self, dir_path):
+        """
+        Lists the names of the subdirectories of a directory.
+
+        :parameter: dir_path: path to the directory.
+        :return: sorted list of names.
+        """
+        return [name for name, is_dir in self.scandir(dir_path) if is_dir]
+
+    def save(self):
+        """
+        Writes the cache, if anything was listed again. It is written to a
+        temporary file first and then renamed, so an interrupted run never
+        leaves a partial cache.
+
+        :return: None
+        """
+        if self.cache_path is None or not self.changed:
+            return
+
+        tmp_path = "%s.%d.tmp" % (self.cache_path, os.getpid())
+        try:
+            with self.lock:
+                with open(tmp_path, "w") as fd:
+                    json.dump(self.dirs, fd, sort_keys=True)
+                self.changed = False
+            os.replace(tmp_path, self.cache_path)
+        except OSError as err:
+            # The cache only saves time; never fail the run because of it.
+            print("Unable to write scan cache %s." % self.cache_path)
+            print("Error: {0}".format(err))
@@ -0,0 +1,76 @@
+__doc__ = """
+Lists and renders the frames of workbench scene files, one
+wb_command -show-scene call per frame. The preprocessor makes each frame a
+job of its own, so frames from all of the scene files (the T1 and T2
+brainsprite frames, for example) are rendered at the same time.
+"""
+
+import os
+
+import tools
+
+# Size, in pixels, of each frame rendered from a scene.
+FRAME_WIDTH = 900
+FRAME_HEIGHT = 800
+
+
+def count_scenes(scene_file):
+    """
+    Counts the scenes in a workbench scene file.
+
+    :parameter: scene_file: path to .scene file.
+    :return: number of scenes.
+    """
+    with open(scene_file) as fd:
+        return sum(1 for line in fd if "SceneInfo Index=" in line)
+
+
+def brainsprite_frames(tx, scene_file, out_dir):
+    """
+    Lists the frames to be rendered for the brainsprite of tx. The frames are
+    named P_<tx>_frame_<scene number>.png.
+
+    :parameter: tx: T1 or T2.
+    :parameter: scene_file: path to the brainsprite .scene file for tx.
+    :parameter: out_dir: directory to which to write the frames.
+    :return: list of (scene_file, scene number, output path) tuples.
+    """
+    frames = []
+    for scene_num in range(1, count_scenes(scene_file) + 1):
+        out_png = os.path.join(out_dir, "P_%s_frame_%d.png" % (tx, scene_num))
+        frames.append((scene_file, scene_num, out_png))
+    return frames
+
+
+def render_frame(wb_command, scene_file, scene_num, out_png):
+    """
+    Renders one scene to a png. The image is written to a temporary file in
+    the same directory, and renamed when complete, so that a partially
+    written frame is never found at out_png.
+
+    :parameter: wb_command: path to wb_command.
+    :parameter: scene_file: path to .scene file.
+    :parameter: scene_num: number of the scene (starting at 1).
+    :parameter: out_png: path to which to write the frame.
+    :return: None
+    """
+    out_dir, out_name = os.path.split(out_png)
+    # wb_command picks the image format from the extension, so keep it.
+    tmp_png = os.path.join(out_dir, ".tmp_%d_%s" % (os.getpid(), out_name))
+
+    try:
+        tools.run(
+            [
+                wb_command,
+                "-show-scene",
+                scene_file,
+                str(scene_num),
+                tmp_png,
+                str(FRAME_WIDTH),
+                str(FRAME_HEIGHT),
+            ]
+        )
+        os.replace(tmp_png, out_png)
+    finally:
+        if os.path.exists(tmp_png):
+            os.remove(tmp_png)
@@ -0,0 +1,497 @@
+#! /usr/bin/env python
+
+__doc__ = """
+Renders rows of orthogonal slices from NIfTI volumes, with an optional red
+outline of a second volume drawn on top. This does the same job as FSL's
+slicesdir (and slicesdir -p), but reads each volume once and builds the row
+in memory instead of copying volumes into a working directory and appending
+slicer output with pngappend. The subcortical rows (slicer at fixed slices,
+with a binarized copy of the other ROI volume as the outline), and the middle
+slices of the first volume of the BOLD and SBRef series (slicer -a) are made
+the same way.
+"""
+
+import argparse
+import os
+
+import nibabel as nib
+import numpy as np
+from PIL import Image
+
+import render_cache
+from volumes import load_volume, read_volume
+
+# The slices used by slicesdir: 40%, 50%, and 60% of the way through each of
+# the sagittal, coronal, and axial dimensions.
+DEFAULT_SLICES = (0.4, 0.5, 0.6)
+
+# Index 255 of the palette is reserved for the red outline; 0-254 are gray.
+GRAY_LEVELS = 255
+RED_INDEX = 255
+
+# The slice used for the BOLD and SBRef (or scout) series: the middle of each
+# dimension, like slicer -a.
+MIDDLE_SLICE = (0.5,)
+
+# Slices of the subcortical rows, in world coordinates (mm): the axis
+# (0=sagittal, 1=coronal, 2=axial) and the position along it. These are the
+# slices slicer was given (as voxel numbers of the 2 mm MNI grid: x 36, 45,
+# 52; y 43, 54, 65; z 23, 33, 39), so they are found through the affine of
+# whatever grid the ROIs are on.
+SUBCORT_SLICES = [
+    (0, 18.0),
+    (0, 0.0),
+    (0, -14.0),
+    (1, -40.0),
+    (1, -18.0),
+    (1, 4.0),
+    (2, -26.0),
+    (2, -6.0),
+    (2, 6.0),
+]
+
+# Voxels brighter than this proportion of the range of the outline volume
+# are considered "inside" when the red edges are found.
+EDGE_THRESHOLD = 0.1
+
+
+def robust_range(data):
+    """
+    Gets the 2nd and 98th percentiles of the non-zero voxels, so that a few
+    very bright voxels do not wash out the image.
+
+    :parameter: data: array of intensities.
+    :return: tuple of low and high intensity.
+    """
+    nonzero = data[data != 0]
+    if nonzero.size == 0:
+        return 0.0, 1.0
+    low, high = np.percentile(nonzero, (2, 98))
+    if high <= low:
+        high = low + 1.0
+    return float(low), float(high)
+
+
+def to_gray_indices(data, low, high):
+    """
+    Scales intensities into the gray part of the palette.
+
+    :parameter: data: array of intensities.
+    :parameter: low: intensity shown as black.
+    :parameter: high: intensity shown as white.
+    :return: uint8 array of palette indices.
+    """
+    scaled = (data - low) * ((GRAY_LEVELS - 1) / (high - low))
+    return np.clip(scaled, 0, GRAY_LEVELS - 1).astype(np.uint8)
+
+
+def edge_outline(mask):
+    """
+    Finds the edges of a 2D binary mask: voxels that are in the mask, but
+    have at least one of their 4 neighbors outside of the mask.
+
+    :parameter: mask: 2D boolean array.
+    :return: 2D boolean array that is True on the edges.
+    """
+    padded = np.pad(mask, 1, mode="constant", constant_values=False)
+    interior = (
+        padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+    )
+    return mask & ~interior
+
+
+def slice_index(fraction, dim):
+    # Same rounding that slicer uses for fractional slice positions.
+    return min(max(int(fraction * dim), 0), dim - 1)
+
+
+def world_index(axis, mm, shape, affine):
+    # Index of the slice through mm along axis, on the grid of affine,
+    # kept inside of the volume.
+    voxel = np.linalg.inv(affine).dot(
+        [mm if ax == axis else 0.0 for ax in range(3)] + [1]
+    )
+    return min(max(int(np.rint(voxel[axis])), 0), shape[axis] - 1)
+
+
+def orient(plane):
+    # Volumes are stored with the second (in-plane) axis increasing toward
+    # superior or anterior. Show those at the top of the picture.
+    return np.flipud(plane.T)
+
+
+def sample_plane(axis, index, shape, affine, data, data_affine):
+    """
+    Samples a volume with nearest neighbor interpolation on the voxel grid of
+    a plane of another volume. Voxels outside of the volume are 0.
+
+    :parameter: axis: axis of the plane (0=sagittal, 1=coronal, 2=axial).
+    :parameter: index: voxel index of the plane along that axis.
+    :parameter: shape: shape of the volume that defines the plane.
+    :parameter: affine: affine of the volume that defines the plane.
+    :parameter: data: volume to be sampled.
+    :parameter: data_affine: affine of the volume to be sampled.
+    :return: 2D array with the in-plane shape of the plane.
+    """
+    in_plane = [ax for ax in range(3) if ax != axis]
+    grids = np.meshgrid(
+        np.arange(shape[in_plane[0]]), np.arange(shape[in_plane[1]]), indexing="ij"
+    )
+    coords = np.empty((4,) + grids[0].shape)
+    coords[axis] = index
+    coords[in_plane[0]] = grids[0]
+    coords[in_plane[1]] = grids[1]
+    coords[3] = 1
+
+    # Voxel of the plane -> world -> voxel of the sampled volume.
+    mapping = np.linalg.inv(data_affine).dot(affine)
+    voxels = np.rint(np.tensordot(mapping[:3], coords, axes=1)).astype(np.intp)
+
+    inside = np.ones(grids[0].shape, dtype=bool)
+    for ax in range(3):
+        inside &= (voxels[ax] >= 0) & (voxels[ax] < data.shape[ax])
+
+    plane = np.zeros(grids[0].shape, dtype=data.dtype)
+    plane[inside] = data[tuple(v[inside] for v in voxels)]
+    return plane
+
+
+def get_plane(axis, index, shape, affine, data, data_affine):
+    # Get the plane from data. When data is on the same grid as the plane,
+    # no resampling is needed.
+    if data.shape == tuple(shape) and np.allclose(affine, data_affine):
+        return np.take(data, index, axis=axis)
+    return sample_plane(axis, index, shape, affine, data, data_affine)
+
+
+def fraction_geometry(shape, slices=DEFAULT_SLICES):
+    # Sagittal, coronal, and axial slices at each fraction in slices, as a
+    # list of (axis, index) tuples.
+    return [
+        (axis, slice_index(fraction, shape[axis]))
+        for axis in range(3)
+        for fraction in slices
+    ]
+
+
+def world_geometry(shape, affine, positions):
+    # Slices through world positions (see SUBCORT_SLICES), as a list of
+    # (axis, index) tuples.
+    return [(axis, world_index(axis, mm, shape, affine)) for axis, mm in positions]
+
+
+def gray_planes(base, geometry):
+    """
+    Renders slices of a volume in gray.
+
+    :parameter: base: 3D array of the volume.
+    :parameter: geometry: list of (axis, index) tuples of the slices.
+    :return: list of 2D uint8 arrays of palette indices.
+    """
+    low, high = robust_range(base)
+    return [
+        orient(to_gray_indices(np.take(base, index, axis=axis), low, high))
+        for axis, index in geometry
+    ]
+
+
+def red_mask(red):
+    # Voxels of the red volume that are inside, for finding its edges.
+    red_min = float(red.min())
+    red_max = float(red.max())
+    return red > red_min + EDGE_THRESHOLD * (red_max - red_min)
+
+
+def labels_mask(labels):
+    # Every labeled voxel of an ROI volume is inside (as with fslmaths -bin).
+    return labels > 0
+
+
+# The masks whose edges are drawn in red, by name (the name is part of the
+# key of the edges in the render cache).
+MASKS = {"red": red_mask, "labels": labels_mask}
+
+
+def outline_planes(geometry, shape, affine, mask, mask_affine):
+    """
+    Finds the edges of a mask on slices of a volume.
+
+    :parameter: geometry: list of (axis, index) tuples of the slices.
+    :parameter: shape: shape of the sliced volume.
+    :parameter: affine: affine of the sliced volume.
+    :parameter: mask: 3D boolean array to outline.
+    :parameter: mask_affine: affine of the mask.
+    :return: list of 2D boolean arrays, oriented as the slices.
+    """
+    return [
+        orient(edge_outline(get_plane(axis, index, shape, affine, mask, mask_affine)))
+        for axis, index in geometry
+    ]
+
+
+def paint_outlines(planes, outlines):
+    # Draws the edges in red over the slices. The slices are not changed
+    # (they may be shared); new ones are returned.
+    outlined = []
+    for plane, edges in zip(planes, outlines):
+        plane = plane.copy()
+        plane[edges] = RED_INDEX
+        outlined.append(plane)
+    return outlined
+
+
+def draw_outlines(planes, geometry, shape, affine, mask, mask_affine):
+    """
+    Draws the edges of a mask in red over slices of a volume. The slices
+    are not changed (they may be shared); new ones are returned.
+
+    :parameter: planes: list of 2D uint8 arrays, from gray_planes.
+    :parameter: geometry: list of (axis, index) tuples of the slices.
+    :parameter: shape: shape of the sliced volume.
+    :parameter: affine: affine of the sliced volume.
+    :parameter: mask: 3D boolean array to outline.
+    :parameter: mask_affine: affine of the mask.
+    :return: list of 2D uint8 arrays of palette indices.
+    """
+    return paint_outlines(
+        planes, outline_planes(geometry, shape, affine, mask, mask_affine)
+    )
+
+
+def render_slices(base, base_affine, red=None, red_affine=None, slices=DEFAULT_SLICES):
+    """
+    Renders sagittal, coronal, and axial slices of the base volume, at each
+    fraction in slices, with the edges of the red volume outlined in red.
+
+    :parameter: base: 3D array of the base volume.
+    :parameter: base_affine: affine of the base volume.
+    :parameter: red: optional 3D array of the volume to outline.
+    :parameter: red_affine: affine of the volume to outline.
+    :parameter: slices: fractions of each dimension at which to slice.
+    :return: list of 2D uint8 arrays of palette indices.
+    """
+    geometry = fraction_geometry(base.shape, slices)
+    planes = gray_planes(base, geometry)
+    if red is not None:
+        planes = draw_outlines(
+            planes, geometry, base.shape, base_affine, red_mask(red), red_affine
+        )
+    return planes
+
+
+def base_layer(img_path, geometry_of, shared=False):
+    """
+    Gets the gray slices of a volume. The slices of a volume that all of
+    the subjects of a study share (e.g., the atlas) are kept in the render
+    cache, if there is one, and only rendered by the first subject; the
+    others only read the header of the volume.
+
+    :parameter: img_path: path to the volume.
+    :parameter: geometry_of: function that takes the shape and affine of
+                the volume and returns the (axis, index) tuples of the
+                slices.
+    :parameter: shared: if True, the volume is shared by the study.
+    :return: tuple of the slices (list of 2D uint8 arrays), the geometry,
+             and the shape and affine of the volume.
+    """
+    cache = render_cache.get_cache() if shared else None
+    if cache is None:
+        data, affine = load_volume(img_path)
+        geometry = geometry_of(data.shape, affine)
+        return gray_planes(data, geometry), geometry, data.shape, affine
+
+    img = nib.load(img_path)
+    shape, affine = img.shape[:3], img.affine
+    geometry = geometry_of(shape, affine)
+    planes = cache.load(img_path, geometry)
+    if planes is None:
+        data, _ = load_volume(img_path)
+        planes = gray_planes(data, geometry)
+        cache.save(img_path, geometry, planes)
+    return planes, geometry, shape, affine
+
+
+def red_layer(img_path, mask_name, geometry, shape, affine, shared=False):
+    """
+    Gets the edges of a mask of a volume on slices of another volume. The
+    edges of a volume that all of the subjects of a study share (e.g., the
+    atlas) are kept in the render cache, if there is one, by the slices and
+    the grid they are drawn on, so the volume is only read by the first
+    subject.
+
+    :parameter: img_path: path to the volume to outline.
+    :parameter: mask_name: name, in MASKS, of the mask of the volume.
+    :parameter: geometry: list of (axis, index) tuples of the slices.
+    :parameter: shape: shape of the sliced volume.
+    :parameter: affine: affine of the sliced volume.
+    :parameter: shared: if True, the volume is shared by the study.
+    :return: list of 2D boolean arrays, oriented as the slices.
+    """
+    cache = render_cache.get_cache() if shared else None
+    grid = (shape, affine)
+    if cache is not None:
+        outlines = cache.load(img_path, geometry, mask_name, grid)
+        if outlines is not None:
+            return outlines
+
+    data, data_affine = load_volume(img_path)
+    outlines = outline_planes(
+        geometry, shape, affine, MASKS[mask_name](data), data_affine
+    )
+    if cache is not None:
+        cache.save(img_path, geometry, outlines, mask_name, grid)
+    return outlines
+
+
+def append_horizontally(planes):
+    """
+    Lays the planes out in a single row, from left to right, aligned at the
+    top, with black filling the space under shorter planes.
+
+    :parameter: planes: list of 2D uint8 arrays.
+    :return: 2D uint8 array.
+    """
+    height = max(plane.shape[0] for plane in planes)
+    width = sum(plane.shape[1] for plane in planes)
+    row = np.zeros((height, width), dtype=np.uint8)
+
+    x = 0
+    for plane in planes:
+        h, w = plane.shape
+        row[:h, x : x + w] = plane
+        x += w
+
+    return row
+
+
+def palette_image(indices):
+    """
+    Makes a palette image from an array of palette indices.
+
+    :parameter: indices: 2D uint8 array.
+    :return: PIL Image in mode 'P'.
+    """
+    gray = np.linspace(0, 255, GRAY_LEVELS).astype(np.uint8)
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    palette[:GRAY_LEVELS] = gray[:, np.newaxis]
+    palette[RED_INDEX] = (255, 0, 0)
+
+    img = Image.fromarray(indices, mode="P")
+    img.putpalette(palette.ravel().tolist())
+    return img
+
+
+def make_default_slices_row(
+    base_img, out_img, red_img=None, shared_base=False, shared_red=False
+):
+    """
+    Makes a row of 9 slices of base_img (the same slices as slicesdir), and
+    outlines red_img, if supplied, in red. The format of the output is taken
+    from the extension of out_img (.gif or .png).
+
+    :parameter: base_img: path to volume to be sliced.
+    :parameter: out_img: path to which to write the image.
+    :parameter: red_img: optional path to volume to outline in red.
+    :parameter: shared_base: if True, base_img is shared by all of the
+                subjects of a study (the atlas), and its slices are taken
+                from the render cache.
+    :parameter: shared_red: if True, red_img is shared by all of the
+                subjects of a study, and its edges are taken from the
+                render cache.
+    :return: None
+    """
+    planes, geometry, shape, affine = base_layer(
+        base_img, lambda shape, affine: fraction_geometry(shape), shared_base
+    )
+    if red_img is not None:
+        outlines = red_layer(red_img, "red", geometry, shape, affine, shared_red)
+        planes = paint_outlines(planes, outlines)
+    palette_image(append_horizontally(planes)).save(out_img)
+
+
+def make_series_slices(series, out_img):
+    """
+    Makes a row of the middle sagittal, coronal, and axial slices of the
+    first volume of a series (BOLD, SBRef, or scout), as slicer -a did,
+    without reading the rest of the series.
+
+    :parameter: series: path to a 3D or 4D volume.
+    :parameter: out_img: path to which to write the image.
+    :return: None
+    """
+    # Nothing else reads the series, so it is not kept in the cache.
+    data, affine = read_volume(series)
+    planes = render_slices(data, affine, slices=MIDDLE_SLICE)
+    palette_image(append_horizontally(planes)).save(out_img)
+
+
+def make_subcortical_rows(sub_img, atl_img, sub_out, atl_out, positions=SUBCORT_SLICES):
+    """
+    Makes the two subcortical rows: the subject's subcorticals with the edges
+    of the atlas ROIs in red (sub_out), and the atlas ROIs with the edges of
+    the subject's subcorticals in red (atl_out). Each volume is read once
+    (and the atlas ROIs, with a render cache, once for the study), and
+    serves as the base of one row and the outline of the other. The ROIs
+    are labels, some with low values, so every labeled voxel is in the
+    outline (as with fslmaths -bin).
+
+    :parameter: sub_img: path to the subject's subcorticals in atlas space.
+    :parameter: atl_img: path to the atlas ROIs.
+    :parameter: sub_out: path to which to write the row of sub_img.
+    :parameter: atl_out: path to which to write the row of atl_img.
+    :parameter: positions: list of (axis, mm) tuples of the slices.
+    :return: None
+    """
+
+    def geometry_of(shape, affine):
+        return world_geometry(shape, affine, positions)
+
+    # The atlas side is the same for every subject: its slices, and its
+    # edges on the slices of the subject, may be in the render cache, and
+    # then the atlas ROIs are not read at all.
+    rows = [
+        (base_layer(sub_img, geometry_of), atl_img, True, sub_out),
+        (base_layer(atl_img, geometry_of, shared=True), sub_img, False, atl_out),
+    ]
+    for (planes, geometry, shape, affine), red_img, shared, out_img in rows:
+        outlines = red_layer(red_img, "labels", geometry, shape, affine, shared)
+        planes = paint_outlines(planes, outlines)
+        palette_image(append_horizontally(planes)).save(out_img)
+
+
+def generate_parser():
+
+    parser = argparse.ArgumentParser(
+        prog="slices",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("base_img", help="path to the volume to be sliced.")
+    parser.add_argument(
+        "out_img", help="path to which to write the row of slices (.gif or .png)."
+    )
+    parser.add_argument(
+        "--red",
+        "-p",
+        dest="red_img",
+        metavar="RED_IMG",
+        help="Optional. Path to a volume whose edges are outlined in red.",
+    )
+
+    return parser
+
+
+def _cli():
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    for img in [args.base_img, args.red_img]:
+        if img is not None:
+            assert os.path.exists(img), img + " does not exist!"
+
+    make_default_slices_row(args.base_img, args.out_img, args.red_img)
+
+
+if __name__ == "__main__":
+
+    _cli()
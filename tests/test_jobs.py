@@ -0,0 +1,120 @@
+import os
+
+from jobs import CURRENT, DONE, Job, JobGraph
+from manifest import Manifest
+
+
+def write(file_path, text):
+    with open(file_path, "w") as fd:
+        fd.write(text)
+
+
+def concat(out_path, *in_paths):
+    # A job function: writes the inputs, one after another, to out_path.
+    text = ""
+    for in_path in in_paths:
+        with open(in_path) as fd:
+            text += fd.read()
+    write(out_path, text)
+
+
+def run_graph(tmp_path, inputs, output):
+    manifest = Manifest(str(tmp_path / ".manifest.json"))
+    graph = JobGraph()
+    graph.add(Job("concat", concat, [output] + inputs, inputs=inputs, outputs=[output]))
+    status = graph.run(workers=1, manifest=manifest)
+    manifest.save()
+    return status["concat"]
+
+
+def test_rerun_is_skipped_when_inputs_are_unchanged(tmp_path):
+    a = str(tmp_path / "a.txt")
+    out = str(tmp_path / "out.txt")
+    write(a, "a")
+
+    assert run_graph(tmp_path, [a], out) == DONE
+    assert run_graph(tmp_path, [a], out) == CURRENT
+
+
+def test_rerun_when_an_input_changes(tmp_path):
+    a = str(tmp_path / "a.txt")
+    out = str(tmp_path / "out.txt")
+    write(a, "a")
+    assert run_graph(tmp_path, [a], out) == DONE
+
+    write(a, "changed")
+    assert run_graph(tmp_path, [a], out) == DONE
+    with open(out) as fd:
+        assert fd.read() == "changed"
+
+
+def test_rerun_when_the_output_is_gone(tmp_path):
+    a = str(tmp_path / "a.txt")
+    out = str(tmp_path / "out.txt")
+    write(a, "a")
+    assert run_graph(tmp_path, [a], out) == DONE
+
+    os.remove(out)
+    assert run_graph(tmp_path, [a], out) == DONE
+
+
+def test_duplicate_inputs_are_current_on_rerun(tmp_path):
+    # As when the T1 stands in for a missing T2.
+    t1 = str(tmp_path / "t1.txt")
+    out = str(tmp_path / "out.txt")
+    write(t1, "t1")
+
+    assert run_graph(tmp_path, [t1, t1], out) == DONE
+    assert run_graph(tmp_path, [t1, t1], out) == CURRENT
+
+
+def test_manifest_duplicate_inputs(tmp_path):
+    a = str(tmp_path / "a.txt")
+    out = str(tmp_path / "out.txt")
+    write(a, "a")
+    write(out, "out")
+
+    manifest = Manifest(str(tmp_path / ".manifest.json"))
+    manifest.record(out, [a, a])
+    assert manifest.is_current(out, [a, a])
+    assert manifest.is_current(out, [a])
+
+
+def test_prune_removes_outputs_whose_inputs_are_gone(tmp_path):
+    a = str(tmp_path / "a.txt")
+    b = str(tmp_path / "b.txt")
+    out_a = str(tmp_path / "out_a.txt")
+    out_b = str(tmp_path / "out_b.txt")
+    for file_path in [a, b, out_a, out_b]:
+        write(file_path, "x")
+
+    manifest = Manifest(str(tmp_path / ".manifest.json"))
+    manifest.record(out_a, [a])
+    manifest.record(out_b, [b])
+    os.remove(a)
+
+    assert manifest.prune() == [os.path.abspath(out_a)]
+    assert not os.path.exists(out_a)
+    assert os.path.exists(out_b)
+    assert manifest.is_current(out_b, [b])
+
+
+def test_dependent_job_runs_when_its_dependency_runs(tmp_path):
+    a = str(tmp_path / "a.txt")
+    mid = str(tmp_path / "mid.txt")
+    out = str(tmp_path / "out.txt")
+    write(a, "a")
+
+    def run():
+        manifest = Manifest(str(tmp_path / ".manifest.json"))
+        graph = JobGraph()
+        graph.add(Job("mid", concat, [mid, a], inputs=[a], outputs=[mid]))
+        graph.add(Job("out", concat, [out, mid], inputs=[mid], outputs=[out]))
+        status = graph.run(workers=2, manifest=manifest)
+        manifest.save()
+        return status
+
+    assert run() == {"mid": DONE, "out": DONE}
+    assert run() == {"mid": CURRENT, "out": CURRENT}
+    write(a, "changed")
+    assert run() == {"mid": DONE, "out": DONE}
@@ -0,0 +1,43 @@
+import os
+
+import nibabel as nib
+import numpy as np
+from PIL import Image
+
+import mosaic
+
+
+def test_mosaic_of_frames(tmp_path):
+    # 12 frames make a 3 by 3 mosaic; the rest do not fit.
+    frames_dir = tmp_path / "frames"
+    frames_dir.mkdir()
+    for idx in range(1, 13):
+        frame = np.full((80, 90, 3), idx * 20, dtype=np.uint8)
+        Image.fromarray(frame).save(str(frames_dir / ("P_T1_frame_%d.png" % idx)))
+    # Frames still being written are skipped.
+    (frames_dir / ".tmp_1_P_T1_frame_13.png").write_bytes(b"")
+
+    mosaic_path = str(tmp_path / "mosaic.jpg")
+    mosaic.make_mosaic(str(frames_dir), mosaic_path, workers=2, batch_size=4)
+
+    with Image.open(mosaic_path) as img:
+        assert img.format == "JPEG"
+        assert img.size == (3 * mosaic.IMAGE_DIM, 3 * mosaic.IMAGE_DIM)
+
+
+def test_mosaic_of_a_volume(tmp_path):
+    volume_path = str(tmp_path / "T1w.nii.gz")
+    data = np.random.RandomState(0).rand(30, 40, 20).astype(np.float32)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), volume_path)
+
+    mosaic_path = str(tmp_path / "mosaic.jpg")
+    mosaic.make_mosaic_from_volume(volume_path, mosaic_path, num_slices=16)
+
+    with Image.open(mosaic_path) as img:
+        assert img.size == (4 * mosaic.IMAGE_DIM, 4 * mosaic.IMAGE_DIM)
+
+
+def test_no_frames(tmp_path):
+    mosaic_path = str(tmp_path / "mosaic.jpg")
+    mosaic.make_mosaic(str(tmp_path), mosaic_path)
+    assert not os.path.exists(mosaic_path)
@@ -0,0 +1,70 @@
+import os
+
+import nibabel as nib
+import numpy as np
+
+import resample
+
+
+def ramp(shape=(10, 10, 10)):
+    # Each voxel is 100 x + 10 y + z, so it says where it came from.
+    x, y, z = np.meshgrid(*[np.arange(dim) for dim in shape], indexing="ij")
+    return (100 * x + 10 * y + z).astype(np.float32)
+
+
+def test_same_grid_is_unchanged():
+    data = ramp()
+    out = resample.resample_to_grid(data, np.eye(4), data.shape, np.eye(4))
+    assert out.dtype == np.float32
+    assert np.allclose(out, data)
+
+
+def test_shifted_grid():
+    # The grid starts 2 mm further along x, so its voxel i is voxel i + 2 of
+    # the volume; the last 2 fall outside of it, and are 0.
+    data = ramp()
+    ref_affine = np.eye(4)
+    ref_affine[0, 3] = 2.0
+    out = resample.resample_to_grid(data, np.eye(4), data.shape, ref_affine)
+    assert np.allclose(out[:8], data[2:])
+    assert np.all(out[8:] == 0)
+
+
+def test_coarser_grid():
+    # 2 mm voxels with the same origin land on every other voxel.
+    data = ramp()
+    out = resample.resample_to_grid(
+        data, np.eye(4), (5, 5, 5), np.diag([2.0, 2.0, 2.0, 1.0])
+    )
+    assert out.shape == (5, 5, 5)
+    assert np.allclose(out, data[::2, ::2, ::2])
+
+
+def test_trilinear_between_voxels():
+    # Half a voxel along x is the mean of the two voxels on either side.
+    data = ramp()
+    ref_affine = np.eye(4)
+    ref_affine[0, 3] = 0.5
+    out = resample.resample_to_grid(data, np.eye(4), (9, 10, 10), ref_affine)
+    assert np.allclose(out, (data[:-1] + data[1:]) / 2)
+
+
+def test_cached_copy_is_made_once_and_replaced_when_the_input_changes(tmp_path):
+    in_path = str(tmp_path / "in.nii.gz")
+    ref_path = str(tmp_path / "ref.nii.gz")
+    cache_dir = str(tmp_path / "cache")
+    nib.save(nib.Nifti1Image(ramp(), np.eye(4)), in_path)
+    nib.save(
+        nib.Nifti1Image(np.zeros((5, 5, 5), np.float32), np.diag([2, 2, 2, 1])),
+        ref_path,
+    )
+
+    first = resample.resample_cached(in_path, ref_path, cache_dir)
+    assert resample.resample_cached(in_path, ref_path, cache_dir) == first
+    assert np.allclose(nib.load(first).get_fdata(), ramp()[::2, ::2, ::2])
+
+    nib.save(nib.Nifti1Image(ramp() + 1, np.eye(4)), in_path)
+    os.utime(in_path, ns=(1, 1))
+    second = resample.resample_cached(in_path, ref_path, cache_dir)
+    assert second != first
+    assert os.listdir(cache_dir) == [os.path.basename(second)]
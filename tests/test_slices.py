@@ -0,0 +1,118 @@
+import numpy as np
+import nibabel as nib
+from PIL import Image
+
+import render_cache
+import slices
+
+# The 2 mm MNI grid that slicer was given voxel numbers on.
+MNI_2MM_SHAPE = (91, 109, 91)
+MNI_2MM_AFFINE = np.array(
+    [
+        [-2.0, 0.0, 0.0, 90.0],
+        [0.0, 2.0, 0.0, -126.0],
+        [0.0, 0.0, 2.0, -72.0],
+        [0.0, 0.0, 0.0, 1.0],
+    ]
+)
+
+
+def test_world_index_finds_the_voxels_slicer_was_given():
+    # x 36, 45, 52; y 43, 54, 65; z 23, 33, 39 (see slices.SUBCORT_SLICES).
+    geometry = slices.world_geometry(
+        MNI_2MM_SHAPE, MNI_2MM_AFFINE, slices.SUBCORT_SLICES
+    )
+    assert geometry == [
+        (0, 36),
+        (0, 45),
+        (0, 52),
+        (1, 43),
+        (1, 54),
+        (1, 65),
+        (2, 23),
+        (2, 33),
+        (2, 39),
+    ]
+
+
+def test_world_index_follows_the_affine():
+    # On a 1 mm grid with the same origin, the same positions are twice as
+    # many voxels from it.
+    affine = np.diag([-1.0, 1.0, 1.0, 1.0])
+    affine[:3, 3] = [90.0, -126.0, -72.0]
+    assert slices.world_index(0, 18.0, (182, 218, 182), affine) == 72
+    assert slices.world_index(2, -26.0, (182, 218, 182), affine) == 46
+
+
+def test_world_index_stays_inside_the_volume():
+    assert slices.world_index(0, 500.0, MNI_2MM_SHAPE, MNI_2MM_AFFINE) == 0
+    assert slices.world_index(0, -500.0, MNI_2MM_SHAPE, MNI_2MM_AFFINE) == 90
+
+
+def test_slice_index_rounds_like_slicer():
+    assert slices.slice_index(0.4, 91) == 36
+    assert slices.slice_index(0.5, 91) == 45
+    assert slices.slice_index(0.6, 91) == 54
+    assert slices.slice_index(1.0, 91) == 90
+
+
+def test_get_plane_samples_another_grid():
+    # A volume on a grid twice as fine, with the same origin: voxel i of the
+    # coarse grid is voxel 2i of the fine one.
+    fine = np.arange(8 * 8 * 8, dtype=np.float32).reshape(8, 8, 8)
+    fine_affine = np.eye(4)
+    coarse_affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    plane = slices.get_plane(0, 1, (4, 4, 4), coarse_affine, fine, fine_affine)
+    assert np.array_equal(plane, fine[2, ::2, ::2])
+
+
+def test_default_slices_row_is_nine_slices_with_a_red_outline(tmp_path):
+    data = np.zeros((20, 20, 20), dtype=np.float32)
+    data[5:15, 5:15, 5:15] = 100.0
+    base_img = str(tmp_path / "base.nii.gz")
+    nib.save(nib.Nifti1Image(data, np.eye(4)), base_img)
+    out_img = str(tmp_path / "row.png")
+
+    slices.make_default_slices_row(base_img, out_img, red_img=base_img)
+
+    with Image.open(out_img) as img:
+        assert img.size == (9 * 20, 20)
+        indices = np.asarray(img)
+    assert (indices == slices.RED_INDEX).any()
+
+
+def test_render_cache_gives_the_same_rows(tmp_path, monkeypatch):
+    data = np.zeros((91, 109, 91), dtype=np.float32)
+    data[30:60, 30:80, 20:50] = 1.0
+    atlas = str(tmp_path / "atlas.nii.gz")
+    nib.save(nib.Nifti1Image(data, MNI_2MM_AFFINE), atlas)
+    sub = str(tmp_path / "sub.nii.gz")
+    nib.save(nib.Nifti1Image(np.roll(data, 3, axis=0), MNI_2MM_AFFINE), sub)
+
+    def rows(name):
+        sub_out = str(tmp_path / ("%s_sub.png" % name))
+        atl_out = str(tmp_path / ("%s_atl.png" % name))
+        slices.make_subcortical_rows(sub, atlas, sub_out, atl_out)
+        return [np.asarray(Image.open(path)) for path in [sub_out, atl_out]]
+
+    monkeypatch.delenv(render_cache.RENDER_CACHE_ENV, raising=False)
+    render_cache.configure(None)
+    expected = rows("plain")
+
+    render_cache.configure(str(tmp_path / "cache"))
+    try:
+        first = rows("first")
+
+        # The second time, the atlas is not read at all.
+        def load_volume(path):
+            assert path != atlas
+            return slices.read_volume(path)
+
+        monkeypatch.setattr(slices, "load_volume", load_volume)
+        second = rows("second")
+    finally:
+        render_cache.configure(None)
+        monkeypatch.delenv(render_cache.RENDER_CACHE_ENV, raising=False)
+
+    for got in [first, second]:
+        assert all(np.array_equal(a, b) for a, b in zip(expected, got))
@@ -0,0 +1,94 @@
+import os
+import stat
+import subprocess
+
+import nibabel as nib
+import numpy as np
+import pytest
+from PIL import Image
+
+import tools
+
+FAKE_WB_COMMAND = """#!/bin/sh
+# -show-scene <scene file> <scene number> <image> <width> <height>
+python3 -c "
+import sys
+from PIL import Image
+Image.new('RGB', (int(sys.argv[3]), int(sys.argv[4])), (10, 20, 30)).save(sys.argv[2])
+" "$2" "$4" "$5" "$6"
+"""
+
+
+@pytest.fixture
+def wb_command(tmp_path):
+    file_path = tmp_path / "bin" / "wb_command"
+    file_path.parent.mkdir()
+    file_path.write_text(FAKE_WB_COMMAND)
+    file_path.chmod(file_path.stat().st_mode | stat.S_IXUSR)
+    return str(file_path)
+
+
+def show_scene(wb_command, out_png):
+    return [wb_command, "-show-scene", "brainsprite.scene", "3", out_png, "90", "80"]
+
+
+def test_replay_makes_placeholders_without_a_recording(tmp_path):
+    runner = tools.ReplayRunner()
+    out_png = str(tmp_path / "frame.png")
+    runner.run(show_scene("wb_command", out_png))
+    with Image.open(out_png) as img:
+        assert img.size == (90, 80)
+
+    # Volumes are made from the first volume the call reads.
+    in_path = str(tmp_path / "in.nii.gz")
+    nib.save(nib.Nifti1Image(np.ones((4, 4, 4), np.float32), np.eye(4)), in_path)
+    out_path = str(tmp_path / "out.nii.gz")
+    runner.run(["flirt", "-in", in_path, "-ref", in_path, "-out", out_path])
+    assert os.path.isfile(out_path)
+
+
+def test_replay_gives_back_what_was_recorded(tmp_path, wb_command):
+    record_dir = str(tmp_path / "recorded")
+    recorded_png = str(tmp_path / "recorded.png")
+    tools.RecordingRunner(record_dir).run(show_scene(wb_command, recorded_png))
+    assert os.path.isfile(os.path.join(record_dir, tools.RECORDINGS_NAME))
+
+    # The same call, made somewhere else, by a wb_command that is not there.
+    replayed_png = str(tmp_path / "elsewhere" / "replayed.png")
+    os.makedirs(os.path.dirname(replayed_png))
+    runner = tools.ReplayRunner(record_dir, latency=0)
+    runner.run(show_scene("/nowhere/wb_command", replayed_png))
+
+    with open(recorded_png, "rb") as fd:
+        recorded = fd.read()
+    with open(replayed_png, "rb") as fd:
+        assert fd.read() == recorded
+
+
+def test_replay_fails_when_the_recording_failed(tmp_path):
+    record_dir = str(tmp_path / "recorded")
+    # As for most tools, the output is the last argument.
+    argv = ["false", str(tmp_path / "out.txt")]
+    with pytest.raises(subprocess.CalledProcessError):
+        tools.RecordingRunner(record_dir).run(argv)
+    with pytest.raises(subprocess.CalledProcessError):
+        tools.ReplayRunner(record_dir, latency=0).run(argv)
+
+
+def test_timeout_kills_the_tool_and_what_it_started():
+    loop = tools.ToolLoop({tools.OTHER_TOOLS: 2}, timeout=0.5)
+    try:
+        result = loop.submit(["sh", "-c", "sleep 30 & sleep 30"]).result(10)
+    finally:
+        loop.close()
+    assert result["timed_out"]
+    assert result["returncode"] == -9
+
+
+def test_parse_limits():
+    assert tools.parse_limits("wb_command=2,slicer=8") == {
+        "wb_command": 2,
+        "slicer": 8,
+    }
+    with pytest.raises(ValueError):
+        tools.parse_limits("wb_command")
@@ -0,0 +1,175 @@
+__doc__ = """
+Makes reduced-size copies (thumbnails) of the images shown in the rows of the
+page, in a pool of threads, while the page is being laid out. Rows show the
+thumbnails, with srcset so that the browser picks the width it needs; the
+full-size images are only loaded in the modal containers, when they are
+opened.
+
+Thumbnails are kept in img/thumbs, named <image>.w<width>.<ext>, and are only
+made again when the image is newer than the thumbnail.
+"""
+
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageSequence
+
+from helpers import available_cpus
+
+THUMBS_DIR = "thumbs"
+
+# Widths, in pixels, of the thumbnails of each image. Only widths smaller
+# than the image are made.
+THUMB_WIDTHS = [400, 800, 1200]
+
+JPEG_QUALITY = 85
+
+
+def thumbnail_path(image_file, width):
+    """
+    Gets the path of the thumbnail of an image.
+
+    :parameter: image_file: path to the image.
+    :parameter: width: width of the thumbnail.
+    :return: path to the thumbnail, relative to the same directory as
+             image_file.
+    """
+    dir_path, name = os.path.split(image_file)
+    stem, ext = os.path.splitext(name)
+    return os.path.join(dir_path, THUMBS_DIR, "%s.w%d%s" % (stem, width, ext))
+
+
+def shrink(img, width):
+    # Resizes one frame to width, keeping the aspect ratio.
+    height = max(1, int(round(img.height * width / float(img.width))))
+    if img.mode not in ["RGB", "RGBA", "L"]:
+        img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+    return img.resize((width, height), resample=Image.LANCZOS)
+
+
+def make_thumbnail(image_file, thumb_file, width):
+    """
+    Makes a thumbnail of an image, unless there is one that is newer than
+    the image. Animated GIFs keep all of their frames. The thumbnail is
+    written to a temporary file and renamed.
+
+    :parameter: image_file: path to the image.
+    :parameter: thumb_file: path to which to write the thumbnail.
+    :parameter: width: width of the thumbnail.
+    :return: None
+    """
+    if (
+        os.path.exists(thumb_file)
+        and os.stat(thumb_file).st_mtime_ns >= os.stat(image_file).st_mtime_ns
+    ):
+        return
+
+    dir_path, name = os.path.split(thumb_file)
+    os.makedirs(dir_path, exist_ok=True)
+    tmp_file = os.path.join(dir_path, ".tmp_%d_%s" % (os.getpid(), name))
+    ext = os.path.splitext(name)[1].lower()
+
+    try:
+        with Image.open(image_file) as img:
+            if ext == ".gif":
+                # Each frame gets a palette made from its own colors, which
+                # keeps the grays and the red outline.
+                frames = [
+                    shrink(frame, width).convert("P", palette=Image.ADAPTIVE)
+                    for frame in ImageSequence.Iterator(img)
+                ]
+                frames[0].save(
+                    tmp_file,
+                    "GIF",
+                    save_all=len(frames) > 1,
+                    append_images=frames[1:],
+                    duration=img.info.get("duration", 100),
+                    loop=img.info.get("loop", 0),
+                )
+            elif ext in [".jpg", ".jpeg"]:
+                shrink(img, width).convert("RGB").save(
+                    tmp_file, "JPEG", quality=JPEG_QUALITY
+                )
+            else:
+                shrink(img, width).save(tmp_file)
+        os.replace(tmp_file, thumb_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+class Thumbnailer(object):
+    # Hands out the srcset of each image as the rows are written, and makes
+    # the thumbnails in a pool of threads, so the layout does not wait for
+    # them until the end. The futures are kept by thumbnail, with the path
+    # of the image.
+    #
+    # Image paths are relative to base_dir (the directory of the HTML), as
+    # they are in the page.
+    #
+    def __init__(self, base_dir, workers=None, widths=THUMB_WIDTHS):
+
+        if workers is None:
+            workers = available_cpus()
+        self.base_dir = base_dir
+        self.widths = widths
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.futures = {}
+
+    def srcset(self, image_file):
+        """
+        Gets the src and srcset for a row showing image_file, and starts
+        making its thumbnails. Images that are no wider than the smallest
+        thumbnail are used as they are.
+
+        :parameter: image_file: path to the image, relative to base_dir.
+        :return: tuple of src and srcset.
+        """
+        try:
+            with Image.open(os.path.join(self.base_dir, image_file)) as img:
+                # Only the header is read.
+                image_width = img.width
+        except (OSError, ValueError):
+            return image_file, image_file
+
+        widths = [width for width in self.widths if width < image_width]
+        if not widths:
+            return image_file, image_file
+
+        candidates = []
+        for width in widths:
+            thumb_file = thumbnail_path(image_file, width)
+            if thumb_file not in self.futures:
+                image_path = os.path.join(self.base_dir, image_file)
+                future = self.pool.submit(
+                    make_thumbnail,
+                    image_path,
+                    os.path.join(self.base_dir, thumb_file),
+                    width,
+                )
+                self.futures[thumb_file] = (image_path, future)
+            candidates.append("%s %dw" % (thumb_file, width))
+
+        return thumbnail_path(image_file, widths[0]), ", ".join(candidates)
+
+    def wait(self):
+        """
+        Waits for all of the thumbnails to be made.
+
+        :return: list of the thumbnails that could not be made.
+        """
+        failed = []
+        for thumb_file, (image_path, future) in self.futures.items():
+            try:
+                future.result()
+            except (OSError, ValueError) as err:
+                print("Unable to make thumbnail %s: %s" % (thumb_file, err))
+                failed.append(thumb_file)
+                # The row still needs something to show; use the image.
+                try:
+                    shutil.copyfile(image_path, os.path.join(self.base_dir, thumb_file))
+                except OSError:
+                    pass
+        self.pool.shutdown()
+        return failed
@@ -0,0 +1,590 @@
+__doc__ = """
+Runs the command line tools used by the preprocessor (wb_command, and FSL
+tools such as slicer, fslmaths, and pngappend) through a runner that can be
+swapped:
+
+    real     runs the tools. This is the default.
+    record   runs the tools, and records each call: its arguments, the files
+             it made, and how long it took.
+    replay   stands in for the tools: makes the files each call would have
+             made, from a recording of the same call if there is one, and
+             takes as long as that call took (or a given latency).
+
+With replay, the preprocessor can be run, profiled, and benchmarked where
+the neuroimaging tools are not installed. Replayed images are only as good as
+the recordings; a call that was never recorded makes a placeholder (a gray
+image, or a copy of the input volume).
+
+The runner is chosen with --tools MODE[:DIR], or with the EXECSUMMARY_TOOLS
+environment variable (e.g., EXECSUMMARY_TOOLS=replay:/path/to/recordings),
+which is how worker processes, such as those of batch.py, get it.
+
+Tools that are run (real and record) are run by an asyncio event loop, in a
+thread of its own, that any thread may hand calls to. Each call is an argv
+list; nothing goes through a shell. Each tool has a limit on how many of its
+calls run at once (wb_command, which takes a lot of memory, gets half of the
+CPUs; other tools get twice as many calls as there are CPUs), and every call
+has a timeout, after which it is killed. The output of each call is printed
+as it comes, a line at a time, tagged with the tool and the number of the
+call, so the output of many calls at once can still be told apart:
+
+    [wb_command 12] ...
+
+The limits and the timeout are set with --tool-limit TOOL=N and
+--tool-timeout SECONDS, or with the EXECSUMMARY_TOOL_LIMITS (e.g.,
+wb_command=2,slicer=8) and EXECSUMMARY_TOOL_TIMEOUT environment variables.
+"""
+
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import tracing
+from helpers import available_cpus
+
+TOOLS_ENV = "EXECSUMMARY_TOOLS"
+LATENCY_ENV = "EXECSUMMARY_TOOL_LATENCY"
+LIMITS_ENV = "EXECSUMMARY_TOOL_LIMITS"
+TIMEOUT_ENV = "EXECSUMMARY_TOOL_TIMEOUT"
+
+# Seconds a call may take before it is killed.
+DEFAULT_TIMEOUT = 3600.0
+
+# Name of the limit of the tools that have none of their own.
+OTHER_TOOLS = "*"
+
+# Seconds to wait for the rest of the output of a call once it has ended
+# (a process it started may still hold the pipe).
+DRAIN_SECONDS = 5.0
+
+RECORDINGS_NAME = "recordings.jsonl"
+BLOBS_DIR = "blobs"
+
+IMAGE_EXTS = [".png", ".gif", ".jpg", ".ppm"]
+VOLUME_EXTS = [".nii.gz", ".nii"]
+
+# Files being written are named .tmp_<pid>_<name>; the pid is not part of
+# what a call does.
+TMP_RE = re.compile(r"^\.tmp_\d+_")
+
+# Planes of slicer that are followed by a position and an output file.
+SLICER_PLANES = ["-x", "-y", "-z"]
+
+_runner = None
+_runner_lock = threading.Lock()
+_loop = None
+_loop_lock = threading.Lock()
+_print_lock = threading.Lock()
+
+
+def log(message):
+    # Print whole lines, even when many threads (and tools) print at once.
+    with _print_lock:
+        print(message)
+        sys.stdout.flush()
+
+
+def default_limits():
+    cpus = available_cpus()
+    return {"wb_command": max(1, cpus // 2), OTHER_TOOLS: max(1, 2 * cpus)}
+
+
+def parse_limits(text):
+    """
+    Reads limits written as TOOL=N[,TOOL=N]... (e.g., wb_command=2,slicer=8).
+
+    :parameter: text: the limits, as text.
+    :return: dictionary of the limit of each tool.
+    """
+    limits = {}
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        tool, _, limit = item.partition("=")
+        if not tool.strip() or not limit.strip().isdigit() or int(limit) < 1:
+            raise ValueError("Limits must be TOOL=N, with N at least 1: %s" % item)
+        limits[tool.strip()] = int(limit)
+    return limits
+
+
+def format_limits(limits):
+    return ",".join("%s=%d" % item for item in sorted(limits.items()))
+
+
+def file_ext(file_path):
+    for ext in VOLUME_EXTS:
+        if file_path.endswith(ext):
+            return ext
+    return os.path.splitext(file_path)[1]
+
+
+def output_indices(argv):
+    """
+    Finds the arguments of a call that are the files it makes.
+
+    :parameter: argv: list of the program and its arguments.
+    :return: list of indices into argv.
+    """
+    tool = os.path.basename(argv[0])
+    if tool == "wb_command":
+        if "-show-scene" in argv:
+            # -show-scene <scene file> <scene number> <image> <width> <height>
+            return [argv.index("-show-scene") + 3]
+        return []
+    if tool == "slicer":
+        # slicer <base> [<red>] [-x|-y|-z <position> <png>]... [-a <png>]
+        return [
+            idx
+            for idx in range(2, len(argv))
+            if argv[idx - 1] == "-a" or argv[idx - 2] in SLICER_PLANES
+        ]
+    # fslmaths, pngappend, and most tools: the output comes last.
+    return [len(argv) - 1]
+
+
+def existing_output(file_path):
+    # FSL tools add .nii.gz when the output is named without an extension.
+    for candidate in [file_path] + [file_path + ext for ext in VOLUME_EXTS]:
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def call_key(argv, outputs):
+    """
+    Makes a key for a call that does not depend on where it was run: paths
+    are reduced to their names, and outputs to their extensions.
+
+    :parameter: argv: list of the program and its arguments.
+    :parameter: outputs: indices of the outputs in argv.
+    :return: string.
+    """
+    parts = [os.path.basename(argv[0])]
+    for idx, arg in enumerate(argv[1:], 1):
+        if idx in outputs:
+            parts.append("<out%s>" % file_ext(arg))
+        elif os.sep in arg:
+            parts.append(TMP_RE.sub("", os.path.basename(arg)))
+        else:
+            parts.append(arg)
+    return json.dumps(parts)
+
+
+class ToolLoop(object):
+    # An event loop, in a thread of its own, that runs the tools. Calls are
+    # handed to it with submit(), from any thread, and wait for the
+    # semaphore of their tool before they start.
+    #
+    # Processes are waited for with os.wait4, in a pool of threads for each
+    # tool, so that the CPU time of each is known, even when many run at
+    # once. The loop itself only starts processes and reads their output.
+    #
+    def __init__(self, limits, timeout):
+
+        self.limits = limits
+        self.timeout = timeout
+        self.semaphores = {}
+        self.waiters = {}
+        self.numbers = itertools.count(1)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="tools", daemon=True
+        )
+        self.thread.start()
+
+    def semaphore(self, tool):
+        # Only called in the thread of the loop. Each tool gets one waiter
+        # thread for each of its processes that may be running, so a process
+        # is always waited for as soon as it starts, and its timeout is never
+        # spent in the queue of the pool.
+        if tool not in self.semaphores:
+            limit = self.limits.get(tool) or self.limits[OTHER_TOOLS]
+            self.semaphores[tool] = asyncio.Semaphore(limit)
+            self.waiters[tool] = ThreadPoolExecutor(
+                max_workers=limit, thread_name_prefix="tool-wait"
+            )
+        return self.semaphores[tool]
+
+    def submit(self, argv, cwd=None):
+        """
+        Hands a call to the loop.
+
+        :parameter: argv: list of the program and its arguments.
+        :parameter: cwd: optional directory in which to run the tool.
+        :return: concurrent.futures.Future of a dictionary with the
+                 returncode of the call, whether it timed out, and the
+                 milliseconds it waited for its turn and of CPU it took.
+        """
+        return asyncio.run_coroutine_threadsafe(self.call(argv, cwd), self.loop)
+
+    async def call(self, argv, cwd):
+        tool = os.path.basename(argv[0])
+        tag = "[%s %d]" % (tool, next(self.numbers))
+        queued = time.perf_counter()
+        async with self.semaphore(tool):
+            result = {"queued_ms": round((time.perf_counter() - queued) * 1e3, 3)}
+            proc = subprocess.Popen(
+                argv,
+                cwd=cwd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                # A group of its own, so that a timeout kills whatever the
+                # tool started as well.
+                start_new_session=True,
+            )
+            reader = asyncio.StreamReader()
+            transport, _ = await self.loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader), proc.stdout
+            )
+            printer = asyncio.ensure_future(self.print_lines(reader, tag))
+
+            waited = self.loop.run_in_executor(self.waiters[tool], self.wait, proc)
+            try:
+                returncode, usage = await asyncio.wait_for(
+                    asyncio.shield(waited), self.timeout
+                )
+                result["timed_out"] = False
+            except asyncio.TimeoutError:
+                log("%s killed after %g seconds" % (tag, self.timeout))
+                # Not proc.kill(), which would poll, and might reap the
+                # process out from under wait(). Until wait() returns, the
+                # pid is still the process's, and so is the group, whose
+                # other members would otherwise keep running and hold the
+                # pipe open.
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                returncode, usage = await waited
+                result["timed_out"] = True
+
+            try:
+                await asyncio.wait_for(printer, DRAIN_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            transport.close()
+
+        result["returncode"] = returncode
+        if usage is not None:
+            result["child_ms"] = round((usage.ru_utime + usage.ru_stime) * 1e3, 3)
+        return result
+
+    @staticmethod
+    def wait(proc):
+        # Runs in a thread of the pool. Returns the returncode, and the
+        # resource usage of the process where there is os.wait4.
+        if not hasattr(os, "wait4"):
+            return proc.wait(), None
+        _, status, usage = os.wait4(proc.pid, 0)
+        # The process has been reaped; let Popen know how it ended.
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        return proc.returncode, usage
+
+    @staticmethod
+    async def print_lines(reader, tag):
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            log("%s %s" % (tag, line.decode("utf-8", "replace").rstrip()))
+
+    def close(self):
+        # Stops the loop. Only done when the tools are configured again,
+        # before calls are handed to the new loop.
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        for waiters in list(self.waiters.values()):
+            waiters.shutdown(wait=False)
+
+
+def get_loop():
+    global _loop
+
+    with _loop_lock:
+        if _loop is None:
+            limits = default_limits()
+            limits.update(parse_limits(os.environ.get(LIMITS_ENV) or ""))
+            timeout = float(os.environ.get(TIMEOUT_ENV) or DEFAULT_TIMEOUT)
+            _loop = ToolLoop(limits, timeout)
+        return _loop
+
+
+class ToolRunner(object):
+    # Runs the tools on the tool loop, each in a tracing span of the thread
+    # that waits for it.
+    #
+    def run(self, argv, cwd=None):
+        tool = os.path.basename(argv[0])
+        with tracing.span(tool, "tool", argv=" ".join(argv)) as args:
+            result = get_loop().submit(argv, cwd).result()
+            args.update(result)
+        if result["timed_out"]:
+            raise subprocess.TimeoutExpired(argv, get_loop().timeout)
+        if result["returncode"] != 0:
+            raise subprocess.CalledProcessError(result["returncode"], argv)
+
+
+class RecordingRunner(ToolRunner):
+    # Runs the tools, and appends a line to recordings.jsonl for each call.
+    # The files made are kept in blobs/, named by the hash of their
+    # content, so that identical outputs are kept once.
+    #
+    # Worker threads (and processes) may record at the same time; each line
+    # is appended with a single write.
+    #
+    def __init__(self, record_dir):
+
+        self.record_dir = record_dir
+        self.blobs_dir = os.path.join(record_dir, BLOBS_DIR)
+        os.makedirs(self.blobs_dir, exist_ok=True)
+
+    def run(self, argv, cwd=None):
+        start = time.perf_counter()
+        try:
+            ToolRunner.run(self, argv, cwd)
+        except subprocess.CalledProcessError as err:
+            self.record(argv, cwd, time.perf_counter() - start, err.returncode)
+            raise
+        self.record(argv, cwd, time.perf_counter() - start, 0)
+
+    def store(self, file_path):
+        # Copies a file into the blobs, and returns the name of the blob.
+        sha = hashlib.sha1()
+        with open(file_path, "rb") as fd:
+            for block in iter(lambda: fd.read(1 << 20), b""):
+                sha.update(block)
+        name = sha.hexdigest() + file_ext(file_path)
+        blob = os.path.join(self.blobs_dir, name)
+        if not os.path.exists(blob):
+            tmp_path = "%s.%d.%d.tmp" % (blob, os.getpid(), threading.get_ident())
+            shutil.copyfile(file_path, tmp_path)
+            os.replace(tmp_path, blob)
+        return name
+
+    def record(self, argv, cwd, seconds, returncode):
+        indices = output_indices(argv)
+        outputs = []
+        for idx in indices:
+            file_path = argv[idx]
+            if cwd is not None:
+                file_path = os.path.join(cwd, file_path)
+            made = existing_output(file_path)
+            if made is None:
+                continue
+            outputs.append(
+                {
+                    "index": idx,
+                    "suffix": made[len(file_path) :],
+                    "blob": self.store(made),
+                }
+            )
+
+        entry = {
+            "key": call_key(argv, indices),
+            "argv": argv,
+            "seconds": round(seconds, 4),
+            "returncode": returncode,
+            "outputs": outputs,
+        }
+        line = (json.dumps(entry) + "\n").encode()
+        fd = os.open(
+            os.path.join(self.record_dir, RECORDINGS_NAME),
+            os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+            0o664,
+        )
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+
+class ReplayRunner(ToolRunner):
+    # Stands in for the tools. Calls are matched to recordings by key; if
+    # there is no recording of the same call, by a recording of the same
+    # tool with as many arguments and its outputs in the same places;
+    # failing that, the outputs are made up.
+    #
+    # latency is the time each call takes, in seconds. If it is None, each
+    # call takes as long as it did when it was recorded (and no time, when
+    # there is no recording).
+    #
+    def __init__(self, record_dir=None, latency=None):
+
+        self.record_dir = record_dir
+        self.latency = latency
+        self.by_key = {}
+        self.by_tool = {}
+
+        recordings = None
+        if record_dir is not None:
+            recordings = os.path.join(record_dir, RECORDINGS_NAME)
+        if recordings is not None and os.path.isfile(recordings):
+            with open(recordings) as fd:
+                for line in fd:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    tool = os.path.basename(entry["argv"][0])
+                    self.by_key[entry["key"]] = entry
+                    self.by_tool.setdefault(tool, []).append(entry)
+
+    def find(self, argv, indices):
+        # The recording of this call, or of a call like it, or None.
+        entry = self.by_key.get(call_key(argv, indices))
+        if entry is not None:
+            return entry
+        for entry in self.by_tool.get(os.path.basename(argv[0]), []):
+            if (
+                len(entry["argv"]) == len(argv)
+                and [output["index"] for output in entry["outputs"]] == indices
+            ):
+                return entry
+        return None
+
+    def run(self, argv, cwd=None):
+        argv = [str(arg) for arg in argv]
+        indices = output_indices(argv)
+        with tracing.span(
+            os.path.basename(argv[0]), "tool", argv=" ".join(argv)
+        ) as args:
+            entry = self.find(argv, indices)
+            args["replayed"] = "recording" if entry is not None else "placeholder"
+            for idx in indices:
+                file_path = argv[idx]
+                if cwd is not None:
+                    file_path = os.path.join(cwd, file_path)
+                self.make_output(argv, idx, file_path, entry)
+
+            seconds = self.latency
+            if seconds is None:
+                seconds = entry["seconds"] if entry is not None else 0.0
+            if seconds > 0:
+                time.sleep(seconds)
+
+        returncode = entry["returncode"] if entry is not None else 0
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, argv)
+
+    def make_output(self, argv, idx, file_path, entry):
+        if entry is not None:
+            for output in entry["outputs"]:
+                if output["index"] == idx:
+                    blob = os.path.join(self.record_dir, BLOBS_DIR, output["blob"])
+                    shutil.copyfile(blob, file_path + output["suffix"])
+                    return
+
+        # There is no recording of this output; make a placeholder.
+        ext = file_ext(file_path)
+        if ext in IMAGE_EXTS:
+            size = (256, 256)
+            if os.path.basename(argv[0]) == "wb_command":
+                size = (int(argv[idx + 1]), int(argv[idx + 2]))
+            Image.new("RGB", size, (128, 128, 128)).save(file_path)
+            return
+
+        volumes = [arg for arg in argv[1:idx] if file_ext(arg) in VOLUME_EXTS]
+        if volumes:
+            if ext not in VOLUME_EXTS:
+                file_path += ".nii.gz"
+            shutil.copyfile(volumes[0], file_path)
+            return
+
+        with open(file_path, "wb"):
+            pass
+
+
+def configure(spec=None, latency=None, limits=None, timeout=None):
+    """
+    Chooses the runner used by run(), and the limits and timeout of the
+    tools. The choices are put in the environment, so that processes started
+    from this one use the same ones.
+
+    :parameter: spec: "real", "record:DIR", or "replay[:DIR]". Default is
+                the EXECSUMMARY_TOOLS environment variable, or "real".
+    :parameter: latency: seconds each replayed call takes. Default is the
+                EXECSUMMARY_TOOL_LATENCY environment variable, or the time
+                each call took when it was recorded.
+    :parameter: limits: optional dictionary of the most calls of each tool
+                to run at once, added to those of EXECSUMMARY_TOOL_LIMITS.
+    :parameter: timeout: seconds a call may take. Default is the
+                EXECSUMMARY_TOOL_TIMEOUT environment variable, or
+                DEFAULT_TIMEOUT.
+    :return: the runner.
+    """
+    global _runner, _loop
+
+    if spec is None:
+        spec = os.environ.get(TOOLS_ENV) or "real"
+    if latency is None and os.environ.get(LATENCY_ENV):
+        latency = float(os.environ[LATENCY_ENV])
+
+    mode, _, record_dir = spec.partition(":")
+    record_dir = os.path.abspath(record_dir) if record_dir else None
+    if mode == "real":
+        runner = ToolRunner()
+    elif mode == "record":
+        if record_dir is None:
+            raise ValueError("record needs a directory: record:DIR")
+        runner = RecordingRunner(record_dir)
+    elif mode == "replay":
+        runner = ReplayRunner(record_dir, latency)
+    else:
+        raise ValueError("Unknown tools mode: %s" % spec)
+
+    if record_dir is not None:
+        spec = "%s:%s" % (mode, record_dir)
+    os.environ[TOOLS_ENV] = spec
+    if latency is not None:
+        os.environ[LATENCY_ENV] = str(latency)
+
+    if limits:
+        merged = parse_limits(os.environ.get(LIMITS_ENV) or "")
+        merged.update(limits)
+        os.environ[LIMITS_ENV] = format_limits(merged)
+    if timeout is not None:
+        os.environ[TIMEOUT_ENV] = str(timeout)
+
+    with _runner_lock:
+        _runner = runner
+    # The loop is made again, with the new limits, when it is next used.
+    with _loop_lock:
+        loop, _loop = _loop, None
+    if loop is not None:
+        loop.close()
+    return runner
+
+
+def get_runner():
+    with _runner_lock:
+        runner = _runner
+    if runner is None:
+        runner = configure()
+    return runner
+
+
+def run(argv, cwd=None):
+    """
+    Runs a tool with the current runner, like subprocess.run(argv, cwd=cwd,
+    check=True), and waits for it. Raises subprocess.TimeoutExpired if the
+    call was killed for taking too long.
+
+    :parameter: argv: list of the program and its arguments.
+    :parameter: cwd: optional directory in which to run the tool.
+    :return: None
+    """
+    get_runner().run([str(arg) for arg in argv], cwd=cwd)
@@ -0,0 +1,187 @@
+__doc__ = """
+Records where the time of a run goes, as nested spans, and writes them in the
+Chrome trace event format, which can be opened in Perfetto
+(https://ui.perfetto.dev) or chrome://tracing.
+
+Tracing is off unless it is started (e.g., with --trace out.json); until then
+span() does nothing but yield. Each span is a complete ("X") event on the
+track of the thread that made it, with these args:
+    cpu_ms:          CPU time of that thread during the span.
+    process_cpu_ms:  CPU time of all threads of this process.
+    child_ms:        CPU time of child processes. For a tool call, this is the
+                     time of that tool alone; for any other span, it is the
+                     time of every child process, run by any thread, that
+                     finished during the span.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_tracer = None
+
+
+class Tracer(object):
+    # The events, in the order the spans ended. Times are kept in
+    # microseconds from the start of the trace, as the format wants.
+    #
+    # Spans may be made by many threads at once; events are added while
+    # holding the lock. Each thread gets a small id and a named track.
+    #
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.events = []
+        self.threads = {}
+        self.pid = os.getpid()
+        self.start = time.perf_counter()
+
+    def now(self):
+        return (time.perf_counter() - self.start) * 1e6
+
+    def thread_id(self):
+        thread = threading.current_thread()
+        with self.lock:
+            tid = self.threads.get(thread.ident)
+            if tid is None:
+                tid = len(self.threads) + 1
+                self.threads[thread.ident] = tid
+                self.events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": self.pid,
+                        "tid": tid,
+                        "args": {"name": thread.name},
+                    }
+                )
+        return tid
+
+    def add(self, name, cat, ts, dur, tid, args):
+        with self.lock:
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": cat,
+                    "ph": "X",
+                    "ts": round(ts, 1),
+                    "dur": round(dur, 1),
+                    "pid": self.pid,
+                    "tid": tid,
+                    "args": args,
+                }
+            )
+
+    def save(self, trace_path):
+        """
+        Writes the trace. It is written to a temporary file first and then
+        renamed, so an interrupted run never leaves a partial trace.
+
+        :parameter: trace_path: path to the JSON file.
+        :return: None
+        """
+        with self.lock:
+            trace = {
+                "traceEvents": list(self.events),
+                "displayTimeUnit": "ms",
+                "otherData": {"pid": self.pid},
+            }
+
+        tmp_path = "%s.%d.tmp" % (trace_path, os.getpid())
+        try:
+            with open(tmp_path, "w") as fd:
+                json.dump(trace, fd)
+            os.replace(tmp_path, trace_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def start():
+    """
+    Starts tracing. Spans made before this are not recorded.
+
+    :return: the Tracer.
+    """
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop(trace_path):
+    """
+    Stops tracing, and writes the spans recorded since start().
+
+    :parameter: trace_path: path to the JSON file.
+    :return: None
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.save(trace_path)
+        print("Trace written to: %s" % trace_path)
+
+
+def enabled():
+    return _tracer is not None
+
+
+def children_time():
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+@contextmanager
+def span(name, cat="run", **args):
+    """
+    Records the block in a span. The args are shown with the span; the block
+    may add more to the dictionary it is given.
+
+    :parameter: name: name of the span.
+    :parameter: cat: category of the span (e.g., job, tool, layout).
+    :parameter: args: values to show with the span.
+    :return: dictionary of the args of the span.
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield args
+        return
+
+    tid = tracer.thread_id()
+    ts = tracer.now()
+    cpu = time.thread_time()
+    process_cpu = time.process_time()
+    children = children_time()
+    try:
+        yield args
+    finally:
+        end = tracer.now()
+        args.setdefault("child_ms", round((children_time() - children) * 1e3, 3))
+        args["cpu_ms"] = round((time.thread_time() - cpu) * 1e3, 3)
+        args["process_cpu_ms"] = round((time.process_time() - process_cpu) * 1e3, 3)
+        tracer.add(name, cat, ts, end - ts, tid, args)
+
+
+def traced(name, cat="run"):
+    """
+    Decorator that records each call of a function in a span.
+
+    :parameter: name: name of the span.
+    :parameter: cat: category of the span.
+    :return: decorator.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with span(name, cat):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,174 @@
+__doc__ = """
+Keeps the volumes read by the preprocessor in memory, so that each NIfTI file
+is decompressed at most once in a run, however many images are made from it
+(the T1w brain, for example, is read for the atlas rows and for the grid of
+every task, and the atlas is read for both of its rows).
+
+Volumes are kept decoded (the first volume of a series, as float32), by path,
+size, and modification time, so a file that changes is read again. When the
+volumes kept would take more than the ceiling, those used least recently are
+let go. The ceiling is set with the EXECSUMMARY_VOLUME_CACHE_MB environment
+variable (default 2048; 0 keeps nothing), which is how worker processes, such
+as those of batch.py, get it.
+
+The arrays handed out are shared, so they are read-only.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import nibabel as nib
+import numpy as np
+
+import tracing
+
+CACHE_MB_ENV = "EXECSUMMARY_VOLUME_CACHE_MB"
+DEFAULT_CACHE_MB = 2048
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def file_key(img_path):
+    # A file is the same volume as long as its size and time do not change.
+    st = os.stat(img_path)
+    return os.path.abspath(img_path), st.st_size, st.st_mtime_ns
+
+
+def read_volume(img_path):
+    """
+    Reads the data and affine of a NIfTI volume. For a 4D series only the
+    first volume is read: volumes are stored one after another, so a .nii is
+    memory-mapped and only the pages of the first volume are touched, and a
+    .nii.gz is decompressed as a stream that stops at the end of the first
+    volume, rather than all of the series.
+
+    :parameter: img_path: path to a .nii or .nii.gz file.
+    :return: tuple of 3D float32 array and 4x4 affine.
+    """
+    img = nib.load(img_path, mmap="r")
+    if len(img.shape) > 3:
+        data = img.dataobj[..., 0]
+    else:
+        data = img.dataobj
+    data = np.asarray(data, dtype=np.float32)
+
+    # Drop any trailing singleton dimensions.
+    while data.ndim > 3:
+        data = data[..., 0]
+
+    return data, img.affine
+
+
+class VolumeCache(object):
+    # Decoded volumes, by file key, least recently used first. A volume
+    # being read is kept in self.loading, with an event, so that threads
+    # that want it at the same time wait for the one reading it instead of
+    # reading it again.
+    #
+    def __init__(self, max_bytes):
+
+        self.max_bytes = max_bytes
+        self.volumes = OrderedDict()
+        self.loading = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def load(self, img_path):
+        """
+        Gets a volume from the cache, reading it if it is not there.
+
+        :parameter: img_path: path to a .nii or .nii.gz file.
+        :return: tuple of read-only 3D float32 array and 4x4 affine.
+        """
+        key = file_key(img_path)
+        while True:
+            with self.lock:
+                if key in self.volumes:
+                    self.volumes.move_to_end(key)
+                    self.hits += 1
+                    return self.volumes[key]
+                event = self.loading.get(key)
+                if event is None:
+                    self.loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # Another thread is reading it. If that fails, or the volume is
+            # too large to keep, try again.
+            event.wait()
+
+        try:
+            with tracing.span("read_volume", "volume", path=img_path):
+                data, affine = read_volume(img_path)
+            data.setflags(write=False)
+            affine.setflags(write=False)
+            self.put(key, (data, affine))
+            return data, affine
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def put(self, key, volume):
+        # Keeps a volume, and lets go of the least recently used ones until
+        # the rest fit. A volume larger than the ceiling is not kept.
+        nbytes = volume[0].nbytes
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            # Older versions of the same file will not be asked for again.
+            for old_key in [k for k in self.volumes if k[0] == key[0]]:
+                self.nbytes -= self.volumes.pop(old_key)[0].nbytes
+            self.volumes[key] = volume
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (old_data, _) = self.volumes.popitem(last=False)
+                self.nbytes -= old_data.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.volumes.clear()
+            self.nbytes = 0
+
+
+def configure(max_mb=None):
+    """
+    Makes a new cache with a ceiling. The ceiling is put in the environment,
+    so that processes started from this one use the same one.
+
+    :parameter: max_mb: most megabytes of volumes to keep. Default is the
+                EXECSUMMARY_VOLUME_CACHE_MB environment variable, or
+                DEFAULT_CACHE_MB.
+    :return: the cache.
+    """
+    global _cache
+
+    if max_mb is None:
+        max_mb = float(os.environ.get(CACHE_MB_ENV) or DEFAULT_CACHE_MB)
+    os.environ[CACHE_MB_ENV] = "%g" % max_mb
+
+    cache = VolumeCache(int(max_mb * 1024 * 1024))
+    with _cache_lock:
+        _cache = cache
+    return cache
+
+
+def get_cache():
+    with _cache_lock:
+        cache = _cache
+    if cache is None:
+        cache = configure()
+    return cache
+
+
+def load_volume(img_path):
+    """
+    Gets the data and affine of a volume (the first volume, of a series),
+    from the cache of this process.
+
+    :parameter: img_path: path to a .nii or .nii.gz file.
+    :return: tuple of read-only 3D float32 array and 4x4 affine.
+    """
+    return get_cache().load(img_path)